@@ -0,0 +1,119 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+# Usage analytics. Closed visits are folded into hourly rollups (visits started and person-seconds
+# per location, day, hour and user type), a per-hour peak occupancy and a per-day visitor list, so
+# reports over long ranges only read the rollups. The database side lives in checkIn.py; these
+# helpers only do the arithmetic.
+
+
+def hour_buckets(start, end):
+    # split [start, end) into (hour, seconds spent in that hour) pieces
+    t = start
+    while t < end:
+        bucket = t.replace(minute=0, second=0, microsecond=0)
+        step = min(bucket + timedelta(hours=1), end)
+        yield bucket, (step - t).total_seconds()
+        t = step
+
+
+def visit_contributions(visits):
+    # visits are (location_id, sid, type_id, timeIn, timeOut); returns the hourly rollup deltas keyed
+    # by (location_id, day, hour, type_id) -> [visits, seconds] and the (location_id, day, sid) visitors
+    hourly = defaultdict(lambda: [0, 0])
+    visitors = set()
+    for location_id, sid, type_id, time_in, time_out in visits:
+        if time_out is None or time_out < time_in:
+            continue
+        start = time_in.replace(minute=0, second=0, microsecond=0)
+        hourly[(location_id, start.date(), start.hour, type_id)][0] += 1
+        for bucket, seconds in hour_buckets(time_in, time_out):
+            hourly[(location_id, bucket.date(), bucket.hour, type_id)][1] += int(seconds)
+        visitors.add((location_id, time_in.date(), sid))
+    return hourly, visitors
+
+
+def peak_occupancy(intervals):
+    # highest number of people in the lab during each hour, from (timeIn, timeOut) pairs;
+    # returns (day, hour) -> peak
+    events = []
+    for time_in, time_out in intervals:
+        if time_out is None or time_out < time_in:
+            continue
+        events.append((time_in, 1))
+        events.append((time_out, -1))
+    # leaving before arriving at the same instant, so back-to-back visits don't overlap
+    events.sort()
+
+    peaks = defaultdict(int)
+    current = 0
+    previous = None
+    for when, change in events:
+        # whoever was in the lab since the last event counts towards every hour until this one
+        if previous is not None and current > 0:
+            for bucket, _ in hour_buckets(previous, when):
+                key = (bucket.date(), bucket.hour)
+                peaks[key] = max(peaks[key], current)
+        current += change
+        previous = when
+    return dict(peaks)
+
+
+def period_start(day, group):
+    if group == 'week':
+        return day - timedelta(days=day.weekday())
+    elif group == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def summarize(hourly, peaks, visitors, types, group='day'):
+    # hourly: (day, hour, type_id, visits, seconds); peaks: (day, hour, peak); visitors: (day, sid);
+    # types: type_id -> name. Returns one row per period, oldest first, plus an hour-of-day profile.
+    periods = defaultdict(lambda: {'visits': 0, 'hours': 0.0, 'peak': 0, 'users': set(),
+                                   'hours_by_type': defaultdict(float)})
+    by_hour = defaultdict(lambda: {'visits': 0, 'hours': 0.0, 'peak': 0})
+
+    for day, hour, type_id, visits, seconds in hourly:
+        period = periods[period_start(day, group)]
+        period['visits'] += visits
+        period['hours'] += seconds / 3600.0
+        period['hours_by_type'][types.get(type_id, 'Unknown')] += seconds / 3600.0
+        by_hour[hour]['visits'] += visits
+        by_hour[hour]['hours'] += seconds / 3600.0
+    for day, hour, peak in peaks:
+        periods[period_start(day, group)]['peak'] = max(periods[period_start(day, group)]['peak'], peak)
+        by_hour[hour]['peak'] = max(by_hour[hour]['peak'], peak)
+    for day, sid in visitors:
+        periods[period_start(day, group)]['users'].add(sid)
+
+    rows = []
+    for start in sorted(periods):
+        period = periods[start]
+        rows.append({
+            'period': start,
+            'visits': period['visits'],
+            'unique_users': len(period['users']),
+            'person_hours': round(period['hours'], 1),
+            'peak': period['peak'],
+            'hours_by_type': dict((name, round(hours, 1)) for name, hours in period['hours_by_type'].items()),
+        })
+    hours = [dict(by_hour[hour], hour=hour, hours=round(by_hour[hour]['hours'], 1)) for hour in sorted(by_hour)]
+    return rows, hours
+
+
+def parse_day(value, default):
+    if not value:
+        return default
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def day_range(start, end):
+    # inclusive range of days as datetimes bounding [start 00:00, end+1 00:00)
+    return datetime.combine(start, datetime.min.time()), \
+           datetime.combine(end + timedelta(days=1), datetime.min.time())
+
+
+def default_range(today=None):
+    today = today or date.today()
+    return today - timedelta(days=27), today
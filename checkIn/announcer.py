@@ -0,0 +1,175 @@
+import itertools
+import threading
+import time
+from collections import deque
+
+# Announcer commands. Each location's announcer gets one long-lived client and a worker that sends
+# queued commands one at a time, so an admin page only ever waits on putting a command in the queue.
+# A command that fails is retried on a fresh connection every `retry_delay` seconds until it succeeds,
+# runs out of `retries` or passes its `deadline`, and one whose deadline passed while it waited is failed
+# without being sent; every change of state is passed to on_status. The queue holds at most
+# `queue_size` commands. Urgent ones (evacuations) are never turned away and wait in a lane of their
+# own that is always emptied first, in the order they were submitted, so a start_evac queued before a
+# stop_evac is still sent before it. If given, timer(method) returns a context manager wrapped around
+# each call.
+
+QUEUED = 'queued'
+SENDING = 'sending'
+RETRYING = 'retrying'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    pass
+
+
+def zerorpc_client(address, timeout):
+    import zerorpc
+    client = zerorpc.Client(timeout=timeout)
+    client.connect(address)
+    return client
+
+
+class Announcer:
+    ids = itertools.count(1)
+
+    def __init__(self, address, connect=zerorpc_client, timeout=5, queue_size=20, retries=3, retry_delay=1,
+                 deadline=30, on_status=None, start_task=None, sleep=time.sleep, timer=None):
+        self.address = address
+        self.connect = connect
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.deadline = deadline
+        self.on_status = on_status
+        self.start_task = start_task or (lambda task: threading.Thread(target=task, daemon=True).start())
+        self.sleep = sleep
+        self.timer = timer
+        self.client = None
+        self.queue = deque()
+        self.urgent = deque()
+        self.recent = deque(maxlen=10)
+        self.ready = threading.Condition()
+        self.started = False
+
+    def submit(self, method, *args, urgent=False):
+        command = {'id': next(self.ids), 'method': method, 'args': list(args), 'status': QUEUED, 'attempts': 0,
+                   'error': None, 'deadline': time.monotonic() + self.deadline}
+        with self.ready:
+            if not urgent and len(self.queue) >= self.queue_size:
+                raise QueueFull('%d announcer commands are already waiting' % len(self.queue))
+            (self.urgent if urgent else self.queue).append(command)
+            self.recent.append(command)
+            # reported before the worker can pick it up, so 'queued' always comes first
+            self._report(command)
+            start = not self.started
+            self.started = True
+            self.ready.notify()
+        if start:
+            self.start_task(self._run)
+        return command
+
+    def _run(self):
+        while True:
+            with self.ready:
+                while not self.urgent and not self.queue:
+                    self.ready.wait()
+                command = (self.urgent or self.queue).popleft()
+            self._send(command)
+
+    def _send(self, command):
+        if time.monotonic() > command['deadline']:
+            command['status'] = FAILED
+            command['error'] = 'deadline passed while queued'
+            self._report(command)
+            return
+        while True:
+            command['attempts'] += 1
+            command['status'] = SENDING
+            self._report(command)
+            try:
+                if self.client is None:
+                    self.client = self.connect(self.address, self.timeout)
+                if self.timer:
+                    with self.timer(command['method']):
+                        getattr(self.client, command['method'])(*command['args'])
+                else:
+                    getattr(self.client, command['method'])(*command['args'])
+                command['status'] = DONE
+                command['error'] = None
+                self._report(command)
+                return
+            except Exception as e:
+                command['error'] = str(e) or type(e).__name__
+                self._disconnect()
+            if command['attempts'] > self.retries or time.monotonic() + self.retry_delay > command['deadline']:
+                command['status'] = FAILED
+                self._report(command)
+                return
+            command['status'] = RETRYING
+            self._report(command)
+            self.sleep(self.retry_delay)
+
+    def _disconnect(self):
+        client, self.client = self.client, None
+        try:
+            if client is not None:
+                client.close()
+        except Exception:
+            pass
+
+    def _report(self, command):
+        if self.on_status:
+            self.on_status(status(command))
+
+
+def status(command):
+    # the parts of a command worth showing an admin
+    return dict((k, command[k]) for k in ('id', 'method', 'status', 'attempts', 'error'))
+
+
+# Stand-in for the announcer Pi. Pass `connect=lambda address, timeout: StandIn()` to an Announcer,
+# or run `python announcer.py tcp://127.0.0.1:4242` and point a location's announcer at that address.
+class StandIn:
+    def __init__(self, delay=0, fail=0):
+        # the first `fail` calls raise, and every call takes `delay` seconds
+        self.delay = delay
+        self.fail = fail
+        self.calls = list()
+
+    def _call(self, method, *args):
+        time.sleep(self.delay)
+        self.calls.append((method,) + args)
+        print('announcer: %s%r' % (method, args))
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError('stand-in failure')
+
+    def test(self):
+        self._call('test')
+
+    def tools_prohibited(self, h, m, am):
+        self._call('tools_prohibited', h, m, am)
+
+    def cancel_tools_prohibited(self):
+        self._call('cancel_tools_prohibited')
+
+    def start_evac(self, emergency, emergency_exit):
+        self._call('start_evac', emergency, emergency_exit)
+
+    def stop_evac(self):
+        self._call('stop_evac')
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    import sys
+    import zerorpc
+
+    server = zerorpc.Server(StandIn())
+    server.bind(sys.argv[1] if len(sys.argv) > 1 else 'tcp://127.0.0.1:4242')
+    server.run()
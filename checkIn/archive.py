@@ -0,0 +1,26 @@
+import sqlalchemy as sa
+from datetime import datetime, timedelta
+
+# Archival of old access and scan log rows. Rows past the horizon are moved to archive tables with the
+# same columns and ids, batch_size rows at a time; each batch is copied and deleted in one
+# transaction, so an interrupted run loses nothing and can simply be run again. The archive tables use
+# compressed rows on MariaDB and only have the indexes exports need, so the live tables (and their
+# indexes) stay small.
+
+
+def horizon(days, now=None):
+    return (now or datetime.now()) - timedelta(days=days)
+
+
+def move_rows(engine, live, archive, where, batch_size=1000):
+    # moves rows of live matching where into archive, oldest ids first; returns how many were moved
+    moved = 0
+    columns = [column.name for column in archive.columns]
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(sa.select([live]).where(where).order_by(live.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return moved
+            conn.execute(archive.insert(), [dict((name, row[name]) for name in columns) for row in rows])
+            conn.execute(live.delete().where(live.c.id.in_([row['id'] for row in rows])))
+        moved += len(rows)
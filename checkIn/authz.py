@@ -0,0 +1,53 @@
+import threading
+import time
+
+
+# In-memory training matrix: for each location, the set of machines each user is trained on. It's
+# built from the database the first time a location is asked about (or with rebuild()) and then kept
+# current by the training add/remove paths, so machine interlocks can be answered without a query.
+# loader(location_id) returns (sid, machine_id) pairs for every training at that location.
+class TrainingMatrix:
+    def __init__(self, loader, max_age=None):
+        self.loader = loader
+        # seconds before a location's matrix is reloaded; None keeps it until invalidated, which is
+        # only safe when this process is the only one recording trainings
+        self.max_age = max_age
+        self.locations = dict()
+        self.built = dict()
+        self.lock = threading.Lock()
+
+    def _matrix(self, location_id):
+        matrix = self.locations.get(location_id)
+        if matrix is None or (self.max_age is not None and
+                              time.monotonic() - self.built.get(location_id, 0) > self.max_age):
+            matrix = self.rebuild(location_id)
+        return matrix
+
+    def rebuild(self, location_id):
+        matrix = dict()
+        for sid, machine_id in self.loader(location_id):
+            matrix.setdefault(sid, set()).add(machine_id)
+        with self.lock:
+            self.locations[location_id] = matrix
+            self.built[location_id] = time.monotonic()
+        return matrix
+
+    def trained(self, location_id, sid, machine_id):
+        return machine_id in self._matrix(location_id).get(sid, ())
+
+    def update(self, location_id, sid, machine_id, trained):
+        with self.lock:
+            matrix = self.locations.get(location_id)
+            if matrix is None:
+                return
+            if trained:
+                matrix.setdefault(sid, set()).add(machine_id)
+            else:
+                matrix.get(sid, set()).discard(machine_id)
+
+    def invalidate(self, location_id=None):
+        with self.lock:
+            if location_id is None:
+                self.locations.clear()
+            else:
+                self.locations.pop(location_id, None)
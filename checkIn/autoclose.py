@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+# Automatic check-out of forgotten visits. A location can close every visit at its daily closing
+# time, after a maximum session length, or both; a visit is closed at whichever comes first after it
+# started. Visits closed this way are flagged as auto-closed so usage reports can leave them out.
+
+BATCH_SIZE = 500
+
+
+def parse_closing_time(value):
+    # 'HH:MM' (24 hour) -> time, '' -> None
+    value = (value or '').strip()
+    return datetime.strptime(value, '%H:%M').time() if value else None
+
+
+def last_closing(now, closing_time):
+    # the most recent closing at or before now
+    closing = datetime.combine(now.date(), closing_time)
+    return closing if closing <= now else closing - timedelta(days=1)
+
+
+def next_closing(time_in, closing_time):
+    # the first closing after time_in
+    closing = datetime.combine(time_in.date(), closing_time)
+    return closing if closing > time_in else closing + timedelta(days=1)
+
+
+def cutoff(now, closing_time, max_session_hours):
+    # open visits that started before this are stale; None if the location doesn't auto-close
+    cutoffs = list()
+    if closing_time:
+        cutoffs.append(last_closing(now, closing_time))
+    if max_session_hours:
+        cutoffs.append(now - timedelta(hours=max_session_hours))
+    return max(cutoffs) if cutoffs else None
+
+
+def close_time(time_in, closing_time, max_session_hours):
+    times = list()
+    if closing_time:
+        times.append(next_closing(time_in, closing_time))
+    if max_session_hours:
+        times.append(time_in + timedelta(hours=max_session_hours))
+    return min(times)
@@ -4,33 +4,56 @@ import os, sys
 sys.path.insert(0, os.path.abspath(".."))
 
 import os
-import hashlib
+import codecs
 import hmac
 import random
 import argparse
-import zerorpc
-from flask import Flask, request, session, g, redirect, url_for, render_template, abort
+import threading
+import atexit
+import time
+import functools
+import uuid
+from flask import Flask, Blueprint, Response, current_app, jsonify, request, session, g, redirect, url_for, \
+    render_template, abort, stream_with_context
 from flask_bootstrap import Bootstrap
-from flask_socketio import SocketIO, emit
+from werkzeug.exceptions import HTTPException
+from flask_socketio import SocketIO, emit, join_room
 import sqlalchemy as sa
-from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker, contains_eager
 from sqlalchemy.ext.declarative import declarative_base
-from iitlookup import IITLookup
-from collections import defaultdict
-from datetime import datetime
+from sqlalchemy.dialects import mysql
+from iitlookup import CachedIITLookup
+from occupancy import OccupancyCache, make_backend
+from hashing import Hasher, LEGACY_ROUNDS
+import migrations
+from scanlog import ScanLogBuffer
+import analytics
+import export
+import roster
+import search
+from authz import TrainingMatrix
+import ingest
+from replica import Replica
+from coordination import make_coordinator
+import metrics
+import announcer
+import autoclose
+import archive
+import itertools
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta
 
 version = "1.0.0"
 
-app = Flask(__name__, static_url_path='/static', static_folder='static')  # create the application instance :)
-socketio = SocketIO(app, manage_session=True)
-app.config.from_object(__name__)
-app.config.from_pyfile('config.cfg')
-app.config.from_envvar('FLASKR_SETTINGS', silent=True)
-app.config['BOOTSTRAP_SERVE_LOCAL'] = True
+# Importing this module has no side effects: the app is built from config by create_app() at the bottom.
+# Routes are registered on this blueprint and Socket.IO handlers on socketio, which create_app() binds to
+# the app (and to SOCKETIO_MESSAGE_QUEUE, so several workers can reach each other's kiosks).
+views = Blueprint('checkin', __name__)
+socketio = SocketIO()
 
-Bootstrap(app)
-
-engine = sa.create_engine(app.config['DB'], pool_recycle=3600, encoding='utf-8')
+# set up by create_app()
+hasher = None
+engine = None
 Base = declarative_base()
 
 
@@ -42,15 +65,25 @@ class Location(Base):
     secret = sa.Column(sa.Binary(length=16), nullable=False)
     salt = sa.Column(sa.Binary(length=16), nullable=False)
     announcer = sa.Column(sa.String(length=50), nullable=True)
+    secret_rounds = sa.Column(sa.Integer, nullable=True)
+    # open visits are closed automatically at closing_time and/or after max_session_hours
+    closing_time = sa.Column(sa.Time, nullable=True)
+    max_session_hours = sa.Column(sa.Integer, nullable=True)
 
     def set_secret(self, secret):
         self.salt = os.urandom(16)
-        # 100,000 rounds of sha256 w/ a random salt
-        self.secret = hashlib.pbkdf2_hmac('sha256', bytearray(secret, 'utf-8'), self.salt, 100000)
+        # PBKDF2_ROUNDS rounds of sha256 w/ a random salt
+        self.secret_rounds = hasher.rounds
+        self.secret = hasher.hash(secret, self.salt, self.secret_rounds)
 
     def verify_secret(self, attempt):
-        digest = hashlib.pbkdf2_hmac('sha256', bytearray(attempt, 'utf-8'), self.salt, 100000)
-        return hmac.compare_digest(self.secret, digest)
+        rounds = self.secret_rounds or LEGACY_ROUNDS
+        if not hasher.verify(attempt, self.secret, self.salt, rounds):
+            return False
+        # rehash with the configured round count; saved when the caller commits
+        if rounds != hasher.rounds:
+            self.set_secret(attempt)
+        return True
 
     def __repr__(self):
         return "<Location %s>" % self.name
@@ -68,6 +101,10 @@ class Training(Base):
     trainer = relationship('User', foreign_keys=[trainer_id])
     machine = relationship('Machine', foreign_keys=[machine_id])
 
+    __table_args__ = (
+        sa.Index('ix_safetyTraining_trainee_machine', trainee_id, machine_id),
+    )
+
     def __repr__(self):
         return "<%s trained %s on %s, time=%s>" % \
                (self.trainee.name, self.trainer.name, self.machine.name, str(self.date))
@@ -83,15 +120,22 @@ class User(Base):
     location_id = sa.Column(sa.INTEGER, sa.ForeignKey('locations.id'), nullable=False, primary_key=True)
     pin = sa.Column(sa.Binary(length=16))
     pin_salt = sa.Column(sa.Binary(length=16))
+    pin_rounds = sa.Column(sa.Integer, nullable=True)
 
     def set_pin(self, pin):
         self.pin_salt = os.urandom(16)
-        # 100,000 rounds of sha256 w/ a random salt
-        self.pin = hashlib.pbkdf2_hmac('sha256', bytearray(pin, 'utf-8'), self.pin_salt, 100000)
+        # PBKDF2_ROUNDS rounds of sha256 w/ a random salt
+        self.pin_rounds = hasher.rounds
+        self.pin = hasher.hash(pin, self.pin_salt, self.pin_rounds)
 
     def verify_pin(self, attempt):
-        digest = hashlib.pbkdf2_hmac('sha256', bytearray(attempt, 'utf-8'), self.pin_salt, 100000)
-        return hmac.compare_digest(self.pin, digest)
+        rounds = self.pin_rounds or LEGACY_ROUNDS
+        if not hasher.verify(attempt, self.pin, self.pin_salt, rounds):
+            return False
+        # rehash with the configured round count; saved when the caller commits
+        if rounds != hasher.rounds:
+            self.set_pin(attempt)
+        return True
 
     def __repr__(self):
         return "<Location %s>" % self.name
@@ -115,6 +159,11 @@ class Kiosk(Base):
 
     location = relationship('Location')
 
+    __table_args__ = (
+        # card_read looks kiosks up by hardware id alone
+        sa.Index('ix_kiosks_hardware_id', hardware_id),
+    )
+
 
 class Type(Base):
     __tablename__ = 'types'
@@ -134,13 +183,17 @@ class Access(Base):
     timeIn = sa.Column(sa.DateTime, nullable=False)
     timeOut = sa.Column(sa.DateTime, default=None)
     location_id = sa.Column(sa.Integer, nullable=False)
+    # closed by the auto-checkout or by clearing the lab rather than by the user tapping out
+    auto_closed = sa.Column(sa.Boolean, nullable=False, default=False, server_default=sa.false())
 
     user = relationship('User')
     location = relationship('Location', foreign_keys=[location_id], viewonly=True)
 
     __table_args__ = (
         sa.ForeignKeyConstraint([sid, location_id], [User.sid, User.location_id]),
-        sa.ForeignKeyConstraint([location_id], [Location.id])
+        sa.ForeignKeyConstraint([location_id], [Location.id]),
+        # who is in the lab / is this user checked in
+        sa.Index('ix_access_location_open', location_id, timeOut, sid)
     )
 
     def __repr__(self):
@@ -183,9 +236,14 @@ class Machine(Base):
 
 
 
+# SQLite only numbers INTEGER PRIMARY KEY columns itself (a kiosk replica is SQLite), so the log tables'
+# ids are plain INTEGERs there
+LOG_ID = sa.BigInteger().with_variant(sa.Integer, 'sqlite')
+
+
 class AdminLog(Base):
     __tablename__ = 'adminLog'
-    id = sa.Column(sa.BigInteger, primary_key=True, autoincrement=True)
+    id = sa.Column(LOG_ID, primary_key=True, autoincrement=True)
     admin_id = sa.Column(sa.BigInteger)
     action = sa.Column(sa.String(length=50))
     target_id = sa.Column(sa.BigInteger)
@@ -208,7 +266,7 @@ class AdminLog(Base):
 
 class CardScan(Base):
     __tablename__ = 'scanLog'
-    id = sa.Column(sa.BigInteger, primary_key=True, autoincrement=True)
+    id = sa.Column(LOG_ID, primary_key=True, autoincrement=True)
     card_id = sa.Column(sa.BigInteger, nullable=False)
     time = sa.Column(sa.DateTime)
     location_id = sa.Column(sa.Integer, nullable=False)
@@ -218,94 +276,655 @@ class CardScan(Base):
 
     __table_args__ = (
         sa.ForeignKeyConstraint([card_id, location_id], [HawkCard.card, HawkCard.location_id]),
-        sa.ForeignKeyConstraint([location_id], [Location.id])
+        sa.ForeignKeyConstraint([location_id], [Location.id]),
+        sa.Index('ix_scanLog_location_time', location_id, time)
     )
 
     def __repr__(self):
         return "<CardScan %d at %s>" % (self.card, self.time)
 
 
-# create tables if they don't exist
-db_session = scoped_session(sessionmaker(bind=engine))
-Base.metadata.create_all(engine)
+# Rows moved out of access and scanLog by `checkIn.py --archive` (see archive.py): same columns and ids,
+# no foreign keys, compressed on MariaDB
+class AccessArchive(Base):
+    __tablename__ = 'accessArchive'
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    sid = sa.Column(sa.BigInteger)
+    timeIn = sa.Column(sa.DateTime, nullable=False)
+    timeOut = sa.Column(sa.DateTime)
+    location_id = sa.Column(sa.Integer, nullable=False)
+    auto_closed = sa.Column(sa.Boolean, nullable=False, default=False, server_default=sa.false())
+
+    __table_args__ = (
+        sa.Index('ix_accessArchive_location_time', location_id, timeIn),
+        {'mysql_row_format': 'COMPRESSED'}
+    )
+
+
+class CardScanArchive(Base):
+    __tablename__ = 'scanLogArchive'
+    id = sa.Column(sa.BigInteger, primary_key=True, autoincrement=False)
+    card_id = sa.Column(sa.BigInteger, nullable=False)
+    time = sa.Column(sa.DateTime)
+    location_id = sa.Column(sa.Integer, nullable=False)
+
+    __table_args__ = (
+        sa.Index('ix_scanLogArchive_location_time', location_id, time),
+        {'mysql_row_format': 'COMPRESSED'}
+    )
+
 
+# Name search tokens (see search.py), kept up to date whenever a user is added or renamed
+class UserNameToken(Base):
+    __tablename__ = 'userNameTokens'
+    location_id = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    token = sa.Column(sa.String(length=50), primary_key=True)
+    sid = sa.Column(sa.BigInteger, primary_key=True, autoincrement=False)
+
+    __table_args__ = (
+        sa.ForeignKeyConstraint([sid, location_id], [User.sid, User.location_id]),
+    )
+
+    def __repr__(self):
+        return "<UserNameToken %s (A%d)>" % (self.token, self.sid)
+
+
+def index_names(conn, location_id, users):
+    # users is a list of (sid, name); replaces their search tokens
+    if not users:
+        return
+    table = UserNameToken.__table__
+    conn.execute(table.delete().where(sa.and_(table.c.location_id == location_id,
+                                              table.c.sid.in_([sid for sid, name in users]))))
+    rows = [{'location_id': location_id, 'token': token, 'sid': sid}
+            for sid, name in users for token in search.name_tokens(name)]
+    if rows:
+        conn.execute(table.insert(), rows)
+
+
+@sa.event.listens_for(User, 'after_insert')
+@sa.event.listens_for(User, 'after_update')
+def index_user_name(mapper, connection, user):
+    if sa.inspect(user).attrs.name.history.has_changes():
+        index_names(connection, user.location_id, [(user.sid, user.name)])
+
+
+# Usage rollups, updated as visits close (see analytics.py)
+class UsageHourly(Base):
+    __tablename__ = 'usageHourly'
+    location_id = sa.Column(sa.Integer, sa.ForeignKey('locations.id'), primary_key=True, autoincrement=False)
+    day = sa.Column(sa.Date, primary_key=True)
+    hour = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    # 0 for users without a type
+    type_id = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    # visits that started in this hour
+    visits = sa.Column(sa.Integer, nullable=False, default=0)
+    # time everyone of this type spent in the lab during this hour
+    seconds = sa.Column(sa.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<UsageHourly %d %s %02d:00 type %d: %d visits, %ds>" % \
+               (self.location_id, self.day, self.hour, self.type_id, self.visits, self.seconds)
 
-@app.before_request
+
+class UsagePeak(Base):
+    __tablename__ = 'usagePeak'
+    location_id = sa.Column(sa.Integer, sa.ForeignKey('locations.id'), primary_key=True, autoincrement=False)
+    day = sa.Column(sa.Date, primary_key=True)
+    hour = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    peak = sa.Column(sa.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<UsagePeak %d %s %02d:00: %d>" % (self.location_id, self.day, self.hour, self.peak)
+
+
+class UsageVisitor(Base):
+    __tablename__ = 'usageVisitors'
+    location_id = sa.Column(sa.Integer, sa.ForeignKey('locations.id'), primary_key=True, autoincrement=False)
+    day = sa.Column(sa.Date, primary_key=True)
+    sid = sa.Column(sa.BigInteger, primary_key=True, autoincrement=False)
+
+    def __repr__(self):
+        return "<UsageVisitor %d %s A%d>" % (self.location_id, self.day, self.sid)
+
+
+# tables are created and upgraded by `checkIn.py --migrate`, see migrations.py; create_app() binds the
+# session to the engine
+db_session = scoped_session(sessionmaker())
+
+# card scans are an audit trail only, so they're written behind the tap in batches (set up by create_app())
+scan_log = None
+
+# Latency and load metrics, served at /metrics for Prometheus (see metrics.py)
+registry = metrics.Registry()
+request_seconds = registry.histogram('http_request_seconds', 'Time to handle an HTTP request', labels=('endpoint',))
+request_queries = registry.histogram('http_request_sql_queries', 'SQL statements run per HTTP request',
+                                     labels=('endpoint',), buckets=metrics.COUNT_BUCKETS)
+request_sql_seconds = registry.histogram('http_request_sql_seconds', 'Time spent in SQL per HTTP request',
+                                         labels=('endpoint',))
+event_seconds = registry.histogram('socketio_event_seconds', 'Time to handle a Socket.IO event', labels=('event',))
+event_queries = registry.histogram('socketio_event_sql_queries', 'SQL statements run per Socket.IO event',
+                                   labels=('event',), buckets=metrics.COUNT_BUCKETS)
+event_sql_seconds = registry.histogram('socketio_event_sql_seconds', 'Time spent in SQL per Socket.IO event',
+                                       labels=('event',))
+checkin_phase_seconds = registry.histogram('checkin_phase_seconds', 'Time spent in each phase of a card tap',
+                                           labels=('phase',))
+iit_seconds = registry.histogram('iit_lookup_seconds', 'University lookup SOAP call latency', labels=('call',))
+announcer_seconds = registry.histogram('announcer_call_seconds', 'Announcer zerorpc call latency', labels=('call',))
+socketio_clients = registry.gauge('socketio_clients', 'Connected kiosk pages', labels=('location',))
+registry.gauge('iit_lookup_cache', 'University lookup cache hits, misses and size', labels=('stat',),
+               collect=lambda: dict(((k,), v) for k, v in iit_client.stats().items()) if iit_client else dict())
+pool_checkout_seconds = registry.histogram('db_pool_checkout_seconds',
+                                           'Time taken to check a connection out of the pool')
+registry.gauge('db_pool_connections', 'SQLAlchemy connection pool state', labels=('state',),
+               collect=lambda: metrics.pool_state(engine.pool) if engine else dict())
+query_stats = metrics.QueryStats(registry)
+
+
+def on_socket_event(message):
+    # socketio.on, recording how long the handler takes and the SQL it runs
+    def decorator(handler):
+        @functools.wraps(handler)
+        def timed_handler(*args):
+            query_stats.reset()
+            try:
+                with event_seconds.time(message):
+                    return handler(*args)
+            finally:
+                count, seconds = query_stats.current()
+                event_queries.observe(count, message)
+                event_sql_seconds.observe(seconds, message)
+        return socketio.on(message)(timed_handler)
+    return decorator
+
+
+# endpoints used by devices rather than kiosk pages; they don't need a kiosk session or the roster
+device_endpoints = {'checkin.card_read', 'checkin.card_read_batch', 'checkin.authorize', 'checkin.metrics_page'}
+
+
+@views.before_app_request
+def start_request_timer():
+    # registered before before_request so requests it redirects are timed too
+    g.request_started = time.perf_counter()
+    query_stats.reset()
+
+
+@views.teardown_app_request
+def record_request_time(error):
+    if 'request_started' not in g:
+        return
+    endpoint = request.endpoint or 'unmatched'
+    request_seconds.observe(time.perf_counter() - g.request_started, endpoint)
+    count, seconds = query_stats.current()
+    request_queries.observe(count, endpoint)
+    request_sql_seconds.observe(seconds, endpoint)
+
+
+@views.before_app_request
 def before_request():
-    if 'location_id' not in session and request.endpoint != 'auth' and request.endpoint != 'card_read':
-        return redirect(url_for('auth'))
+    if 'location_id' not in session and request.endpoint != 'checkin.auth' and \
+            request.endpoint not in device_endpoints:
+        return redirect(url_for('checkin.auth'))
 
-    if request.endpoint and request.endpoint != 'card_read' and \
+    if request.endpoint and request.endpoint not in device_endpoints and \
                     'socket.io' not in request.endpoint and \
                     'static' not in request.endpoint and \
                     'auth' not in request.endpoint:
         db = db_session()
-        kiosk = db.query(Kiosk).get((session['location_id'], session['hardware_id']))
-        if kiosk:
-            kiosk.last_seen = sa.func.now()
-            db.commit()
-
-        in_lab = db.query(Access) \
-            .filter_by(timeOut=None) \
-            .filter_by(location_id=session['location_id']) \
-            .all() \
-            if 'location_id' in session else list()
+        kiosk_heartbeat(db, session['location_id'], session['hardware_id'])
 
         g.location = db.query(Location).filter_by(
             id=session['location_id']).one_or_none() if 'location_id' in session else None
-        g.students = [a.user for a in in_lab if a.user.type.level <= 0]
-        g.staff = [a.user for a in in_lab if a.user.type.level > 0]
-        g.staff.sort(key=lambda x: x.type.level, reverse=True)
+        # the sequence number is read first so a change racing the page load is sent to it again
+        g.roster_seq = occupancy.sequence(session['location_id']) if 'location_id' in session else 0
+        g.students, g.staff = occupancy.roster(session['location_id']) \
+            if 'location_id' in session else (list(), list())
         g.admin = db.query(User).filter_by(sid=session['admin'], location_id=session[
             'location_id']).one_or_none() if 'admin' in session else None
         g.version = version
 
-        general_machine = db.query(Machine) \
-            .filter(Machine.name.ilike('General Safety Training')) \
-            .filter_by(location_id=session['location_id']) \
-            .one_or_none() \
-            if 'location_id' in session else None
 
-        for student in g.students:
-            student.general_training = None
-            if general_machine:
-                for training in student.trainings:
-                    if training.machine_id == general_machine.id:
-                        student.general_training = training
+def db_now():
+    # the database's NOW() is local time on MariaDB but UTC on SQLite, so kiosk replicas are given the
+    # local time explicitly; everything else (rollups, auto check-out, replica sync) assumes local time
+    return datetime.now() if engine.dialect.name == 'sqlite' else sa.func.now()
+
+
+# last time each kiosk's last_seen was written; a kiosk's heartbeat is persisted at most once every
+# KIOSK_HEARTBEAT_INTERVAL seconds instead of on every page load
+kiosk_heartbeats = dict()
 
 
-def update_kiosks(location, except_hwid=None):
+def kiosk_heartbeat(db, location_id, hwid):
+    now = time.monotonic()
+    key = (location_id, hwid)
+    if now - kiosk_heartbeats.get(key, float('-inf')) < current_app.config.get('KIOSK_HEARTBEAT_INTERVAL', 60):
+        return
+    kiosk_heartbeats[key] = now
+    db.query(Kiosk) \
+        .filter_by(location_id=location_id, hardware_id=hwid) \
+        .update({'last_seen': db_now()}, synchronize_session=False)
+    db.commit()
+
+
+def make_occupant(user, general_training, since):
+    return {
+        'sid': user.sid,
+        'name': user.name,
+        'photo': user.photo,
+        'level': user.type.level,
+        'type_name': user.type.name,
+        'general_training': general_training,
+        'since': (since - datetime(1970, 1, 1)).total_seconds() if since else 0,
+    }
+
+
+def general_training_sids(db, location_id, sids):
+    if not sids:
+        return set()
+    trainings = db.query(Training.trainee_id) \
+        .join(Training.machine) \
+        .filter(Machine.name.ilike('General Safety Training')) \
+        .filter(Machine.location_id == location_id) \
+        .filter(Training.trainee_id.in_(sids))
+    return set(sid for (sid,) in trainings)
+
+
+def load_occupants(location_id):
     db = db_session()
-    kiosks = db.query(Kiosk).filter_by(location_id=location)
-    if except_hwid:
-        kiosks = kiosks.filter(Kiosk.hardware_id != except_hwid)
-    kiosks = kiosks.all()
-    for kiosk in kiosks:
-        socketio.emit('go', {'to': '/', 'hwid': kiosk.hardware_id})
+    # everyone currently checked in, with their type, in one joined query
+    in_lab = db.query(Access) \
+        .join(Access.user) \
+        .join(User.type) \
+        .options(contains_eager(Access.user).contains_eager(User.type)) \
+        .filter(Access.timeOut == None) \
+        .filter(Access.location_id == location_id) \
+        .all()
+
+    # general safety training for everyone in the lab in one more query
+    trained = general_training_sids(db, location_id, [a.sid for a in in_lab])
+    return [make_occupant(a.user, a.sid in trained, a.timeIn) for a in in_lab]
+
+
+def record_tap(db, location_id, checked_in, checked_out):
+    # usage rollups for a check-in (sid) or check-out (Access row); call before committing the tap, so
+    # they're written in its transaction
+    if not checked_in and not checked_out:
+        return
+    before = len(occupancy.occupants(location_id))
+    record_occupancy(db, location_id, before, before + 1 if checked_in else before)
+    if checked_out:
+        record_visits(db, [checked_out.id])
+
+
+def visit_opened(db, location_id, sid):
+    # call once a check-in is committed
+    user = db.query(User).get((sid, location_id))
+    if user:
+        occupant = make_occupant(user, bool(general_training_sids(db, location_id, [user.sid])), datetime.now())
+        occupancy.add(location_id, occupant)
+        roster_changed(location_id, added=occupant)
+
+
+def visit_closed(db, location_id, access):
+    # call once a check-out is committed
+    occupants = occupancy.occupants(location_id)
+    occupancy.remove(location_id, access.sid)
+    roster_changed(location_id, removed=occupants.get(access.sid, {'sid': access.sid}))
+
+
+def occupant_updated(db, location_id, sid):
+    # keep a checked-in user's cached level and training in sync after an admin change
+    if occupancy.contains(location_id, sid):
+        user = db.query(User).get((sid, location_id))
+        since = occupancy.occupants(location_id)[sid]['since']
+        occupant = make_occupant(user, bool(general_training_sids(db, location_id, [user.sid])), None)
+        occupant['since'] = since
+        occupancy.add(location_id, occupant)
+        roster_changed(location_id, added=occupant)
+
+
+# set up by create_app() with the OCCUPANCY_CACHE backend
+occupancy = None
+
+def load_trainings(location_id):
+    return db_session().query(Training.trainee_id, Training.machine_id) \
+        .join(Training.machine) \
+        .filter(Machine.location_id == location_id) \
+        .all()
+
+
+training_matrix = TrainingMatrix(load_trainings)
+
+
+def training_changed(db, location_id, sid, machine_id):
+    # call after a training is added or removed and committed
+    trained = db.query(Training.id).filter_by(trainee_id=sid, machine_id=machine_id).first() is not None
+    training_matrix.update(location_id, sid, machine_id, trained)
+    occupant_updated(db, location_id, sid)
+
+
+# one university lookup client per process; building it downloads and parses the WSDL
+iit_client = None
+iit_client_lock = threading.Lock()
+
+
+def iit_lookup():
+    global iit_client
+    with iit_client_lock:
+        if iit_client is None:
+            config = current_app.config
+            iit_client = CachedIITLookup(config['IITLOOKUPURL'], config['IITLOOKUPUSER'], config['IITLOOKUPPASS'],
+                                         wsdl_cache=config.get('IITLOOKUP_WSDL_CACHE', True),
+                                         size=config.get('IITLOOKUP_CACHE_SIZE', 1024),
+                                         ttl=config.get('IITLOOKUP_CACHE_TTL', 3600),
+                                         negative_ttl=config.get('IITLOOKUP_NEGATIVE_TTL', 300),
+                                         timer=iit_seconds.time)
+        return iit_client
+
+
+def upsert(db, table, rows, merge):
+    # inserts rows; where a row's primary key already exists, each column in merge is combined with the
+    # existing value instead ('add' or 'max'), or the row is skipped if merge is empty. Done with
+    # INSERT ... ON DUPLICATE KEY UPDATE on MariaDB, and INSERT OR IGNORE followed by an in-place UPDATE
+    # on SQLite, so concurrent taps and workers can't lose updates or collide on the key.
+    if not rows:
+        return
+    if db.get_bind().dialect.name == 'mysql':
+        stmt = mysql.insert(table)
+        values = dict((column, table.c[column] + stmt.inserted[column] if how == 'add'
+                       else sa.func.greatest(table.c[column], stmt.inserted[column]))
+                      for column, how in merge.items())
+        db.execute(stmt.on_duplicate_key_update(**values) if values else stmt.prefix_with('IGNORE'), rows)
+        return
+
+    keys = [column.name for column in table.primary_key.columns]
+    db.execute(table.insert().prefix_with('OR IGNORE'),
+               [dict(row, **dict((column, 0) for column in merge)) for row in rows])
+    if merge:
+        update = table.update() \
+            .where(sa.and_(*(table.c[key] == sa.bindparam('key_' + key) for key in keys))) \
+            .values(dict((column, table.c[column] + sa.bindparam('new_' + column) if how == 'add'
+                          else sa.func.max(table.c[column], sa.bindparam('new_' + column)))
+                         for column, how in merge.items()))
+        db.execute(update, [dict([('key_' + key, row[key]) for key in keys] +
+                                 [('new_' + column, row[column]) for column in merge]) for row in rows])
+
+
+# Usage analytics: rollups are updated as each visit closes, so reports never scan the access table
+def add_rollups(db, visits):
+    hourly, visitors = analytics.visit_contributions(
+        (location_id, sid, type_id or 0, time_in, time_out) for location_id, sid, type_id, time_in, time_out in visits)
+    upsert(db, UsageHourly.__table__,
+           [{'location_id': location_id, 'day': day, 'hour': hour, 'type_id': type_id, 'visits': count,
+             'seconds': seconds} for (location_id, day, hour, type_id), (count, seconds) in hourly.items()],
+           {'visits': 'add', 'seconds': 'add'})
+    upsert(db, UsageVisitor.__table__,
+           [{'location_id': location_id, 'day': day, 'sid': sid} for location_id, day, sid in visitors], {})
+
+
+def closed_visits(table=Access):
+    # table is Access or AccessArchive
+    return db_session().query(table.location_id, table.sid, User.type_id, table.timeIn, table.timeOut) \
+        .join(User, sa.and_(User.sid == table.sid, User.location_id == table.location_id)) \
+        .filter(table.timeOut != None) \
+        .filter(table.auto_closed == False)
+
+
+def record_visits(db, access_ids):
+    # the caller commits
+    for i in range(0, len(access_ids), 500):
+        add_rollups(db, closed_visits().filter(Access.id.in_(access_ids[i:i + 500])).all())
+
+
+def record_occupancy(db, location_id, held, count):
+    # held people were in the lab from the last recorded tap until now and count are in it now, so the
+    # hours in between (which had no taps to record them) peaked at held. The caller commits.
+    hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+    peaks = {hour: max(held, count)}
+    if held:
+        last = db.query(UsagePeak.day, UsagePeak.hour) \
+            .filter(UsagePeak.location_id == location_id) \
+            .order_by(UsagePeak.day.desc(), UsagePeak.hour.desc()) \
+            .first()
+        if last:
+            for bucket, _ in analytics.hour_buckets(datetime.combine(last.day, datetime.min.time()) +
+                                                    timedelta(hours=last.hour), hour):
+                peaks[bucket] = held
+    upsert(db, UsagePeak.__table__, [{'location_id': location_id, 'day': bucket.date(), 'hour': bucket.hour,
+                                      'peak': peak} for bucket, peak in peaks.items()], {'peak': 'max'})
+
+
+def rebuild_rollups(location_id):
+    # recompute a location's rollups from the raw access table, e.g. after importing old data
+    db = db_session()
+    for table in (UsageHourly, UsagePeak, UsageVisitor):
+        db.query(table).filter_by(location_id=location_id).delete(synchronize_session=False)
+    db.commit()
+
+    # archived visits count too; paged by id, since committing would close a streaming cursor
+    for table in (AccessArchive, Access):
+        last_id = 0
+        while True:
+            batch = closed_visits(table).add_columns(table.id) \
+                .filter(table.location_id == location_id, table.id > last_id) \
+                .order_by(table.id).limit(1000).all()
+            if not batch:
+                break
+            add_rollups(db, [visit[:5] for visit in batch])
+            db.commit()
+            last_id = batch[-1][5]
+
+    # peaks need overlapping visits, so sweep a month at a time to keep memory flat. As when they're kept
+    # up to date tap by tap, everyone counts while they're in the lab, including visits that were then
+    # closed automatically, though those aren't counted as visits or visitors.
+    def counted(table):
+        return [table.location_id == location_id, table.timeOut != None]
+    bounds = [db.query(sa.func.min(table.timeIn), sa.func.max(table.timeOut)).filter(*counted(table)).one()
+              for table in (AccessArchive, Access)]
+    first = min([lo for lo, hi in bounds if lo] or [None])
+    last = max([hi for lo, hi in bounds if hi] or [None])
+    month = first.replace(day=1, hour=0, minute=0, second=0, microsecond=0) if first else None
+    while month and month <= last:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        intervals = itertools.chain(*(db.query(table.timeIn, table.timeOut)
+                                      .filter(*counted(table))
+                                      .filter(table.timeIn < next_month, table.timeOut > month)
+                                      for table in (AccessArchive, Access)))
+        peaks = analytics.peak_occupancy((max(i, month), min(o, next_month)) for i, o in intervals)
+        for (day, hour), peak in peaks.items():
+            db.add(UsagePeak(location_id=location_id, day=day, hour=hour, peak=peak))
+        db.commit()
+        month = next_month
+
+
+# Socket.IO rooms: every kiosk page joins one room for its location and one for its own
+# hardware id, so events are only delivered to the clients that act on them
+def location_room(location_id):
+    return 'location-%d' % location_id
+
+
+def kiosk_room(location_id, hwid):
+    return 'kiosk-%d-%d' % (location_id, hwid)
+
+
+@on_socket_event('connect')
+def join_kiosk_rooms():
+    if 'location_id' in session and 'hardware_id' in session:
+        socketio_clients.inc(1, session['location_id'])
+        join_room(location_room(session['location_id']))
+        join_room(kiosk_room(session['location_id'], session['hardware_id']))
+        # kiosks idling on one page still reconnect, so they keep showing up as alive
+        kiosk_heartbeat(db_session(), session['location_id'], session['hardware_id'])
+
+
+@on_socket_event('disconnect')
+def leave_kiosk_rooms():
+    if 'location_id' in session and 'hardware_id' in session:
+        socketio_clients.inc(-1, session['location_id'])
+
+
+# Kiosk pages keep their Who's Here sidebar current from 'roster' events instead of reloading. Each
+# event carries the location's next sequence number and either one occupant that was added (or
+# updated) or removed, or the whole roster after a bulk change. A page that sees a gap in the sequence
+# asks for the whole roster with 'roster sync' (see checkin.js), and so does every page when it connects,
+# passing the sequence number it's at so it's only sent the roster if it missed something.
+def roster_changed(location_id, **change):
+    change['seq'] = occupancy.next_sequence(location_id)
+    socketio.emit('roster', change, room=location_room(location_id))
+
+
+def update_kiosks(location):
+    # after a change to more than one occupant, send every kiosk the whole roster
+    students, staff = occupancy.roster(location)
+    roster_changed(location, students=students, staff=staff)
+
+
+@on_socket_event('roster sync')
+def send_roster(data=None):
+    if 'location_id' not in session:
+        return
+    # read the sequence number first: a change racing this is at worst applied twice
+    seq = occupancy.sequence(session['location_id'])
+    if data and data.get('seq') == seq:
+        return
+    students, staff = occupancy.roster(session['location_id'])
+    emit('roster', {'seq': seq, 'students': students, 'staff': staff})
+
+
+# state shared by the worker processes and which of them runs the background loops and announcer
+# clients (see coordination.py); set up by create_app()
+coordinator = None
+
+
+# Kiosk-local mode (see replica.py): DB is this kiosk's SQLite replica of REPLICA_LOCATION, and it's
+# reconciled with CENTRAL_DB every REPLICA_SYNC_INTERVAL seconds (set up by create_app())
+replica = None
+
+
+def record_central_rollups(conn, closed):
+    # reports are read from the central database, so its rollups need the kiosk's visits too; conn is
+    # in the sync's central transaction, which commits them
+    central_db = sessionmaker(bind=conn)()
+    try:
+        add_rollups(central_db, closed)
+    finally:
+        central_db.close()
+
+
+def sync_replica():
+    scan_log.flush()
+    try:
+        closed, changed = replica.sync(record_closed=record_central_rollups)
+    except Exception as e:
+        current_app.logger.warning('Replica sync failed: %s' % e)
+        return False
+    if changed:
+        occupancy.rebuild(replica.location_id)
+        training_matrix.rebuild(replica.location_id)
+        update_kiosks(replica.location_id)
+    return True
+
+
+def replica_sync_loop(app):
+    while True:
+        if coordinator.leader():
+            with app.app_context():
+                try:
+                    sync_replica()
+                except Exception as e:
+                    app.logger.error(e, exc_info=True)
+        socketio.sleep(app.config.get('REPLICA_SYNC_INTERVAL', 30))
+
+
+# Automatic check-out (see autoclose.py). Stale visits are closed in batches of UPDATEs guarded on
+# timeOut still being empty, so a tap-out racing the scheduler (or two schedulers) is never overwritten.
+def auto_checkout(location):
+    cutoff = autoclose.cutoff(datetime.now(), location.closing_time, location.max_session_hours)
+    if not cutoff:
+        return 0
+    db = db_session()
+    access = Access.__table__
+    close = access.update() \
+        .where(access.c.id == sa.bindparam('access_id')) \
+        .where(access.c.timeOut == None) \
+        .values(timeOut=sa.bindparam('closed_at'), auto_closed=True)
+    closed = 0
+    while True:
+        stale = db.query(Access.id, Access.sid, Access.timeIn) \
+            .filter(Access.location_id == location.id, Access.timeOut == None, Access.timeIn < cutoff) \
+            .limit(autoclose.BATCH_SIZE).all()
+        if not stale:
+            break
+        db.execute(close, [{'access_id': access_id, 'closed_at': autoclose.close_time(
+            time_in, location.closing_time, location.max_session_hours)} for access_id, sid, time_in in stale])
+        # like a tap-out, so the peaks up to now still count them (as rebuild_rollups does)
+        before = len(occupancy.occupants(location.id))
+        record_occupancy(db, location.id, before, max(0, before - len(stale)))
+        db.commit()
+        for access_id, sid, time_in in stale:
+            occupancy.remove(location.id, sid)
+        closed += len(stale)
+    if closed:
+        current_app.logger.info('Auto-closed %d visits at %s (%d)' % (closed, location.name, location.id))
+        update_kiosks(location.id)
+    return closed
+
+
+def auto_checkout_all():
+    locations = db_session().query(Location) \
+        .filter(sa.or_(Location.closing_time != None, Location.max_session_hours != None)).all()
+    return sum(auto_checkout(location) for location in locations)
+
+
+def auto_checkout_loop(app):
+    while True:
+        if coordinator.leader():
+            with app.app_context():
+                try:
+                    auto_checkout_all()
+                except Exception as e:
+                    app.logger.error(e, exc_info=True)
+        socketio.sleep(app.config.get('AUTO_CHECKOUT_INTERVAL', 300))
+
+
+def archive_old_rows():
+    # moves closed visits and scans older than ARCHIVE_AFTER_DAYS to the archive tables; returns the
+    # number of each moved
+    cutoff = archive.horizon(current_app.config.get('ARCHIVE_AFTER_DAYS', 365))
+    batch_size = current_app.config.get('ARCHIVE_BATCH_SIZE', 1000)
+    access, scans = Access.__table__, CardScan.__table__
+    visits = archive.move_rows(engine, access, AccessArchive.__table__,
+                               sa.and_(access.c.timeOut != None, access.c.timeOut < cutoff), batch_size)
+    scanned = archive.move_rows(engine, scans, CardScanArchive.__table__, scans.c.time < cutoff, batch_size)
+    return visits, scanned
 
 
-@app.teardown_appcontext
 def close_db(error):
+    # registered with teardown_appcontext by create_app(), so Socket.IO handlers are covered too
     db_session.remove()
 
 
-@app.errorhandler(Exception)
+@views.app_errorhandler(Exception)
 def exception_handler(error):
-    app.logger.error(error, exc_info=True)
+    if isinstance(error, HTTPException):
+        # abort() from the device endpoints; since Flask 1.0 these reach this handler too
+        return error
+    current_app.logger.error(error, exc_info=True)
     return render_template("internal_error.html"), 500
 
 
-@app.errorhandler(404)
+@views.app_errorhandler(404)
 def error_404(error):
     return render_template("internal_error.html"), 500
 
 
-@app.route('/error')
+@views.route('/error')
 def display_error():
     return render_template("internal_error.html"), 500
 
 
-@app.route('/auth', methods=['GET', 'POST'])
+@views.route('/auth', methods=['GET', 'POST'])
 def auth():
     db = db_session()
     locations = db.query(Location).all()
@@ -366,7 +985,7 @@ def auth():
             kiosk = Kiosk(location_id=request.form['location'],
                           hardware_id=request.form['hwid'],
                           token=bytes(new_token, 'utf-8'),
-                          last_seen=sa.func.now())
+                          last_seen=db_now())
             db.add(kiosk)
 
         db.commit()
@@ -378,7 +997,7 @@ def auth():
         return redirect('/')
 
 
-@app.route('/deauth')
+@views.route('/deauth')
 def deauth():
     db = db_session()
     db.query(Kiosk).filter_by(location_id=session['location_id'], hardware_id=session['hardware_id']).delete()
@@ -386,7 +1005,7 @@ def deauth():
     return redirect('/auth')
 
 
-@app.route('/deauth/<int:loc>/<int:hwid>')
+@views.route('/deauth/<int:loc>/<int:hwid>')
 def deauth_other(loc, hwid):
     if not g.admin or g.admin.location_id != session['location_id'] or g.admin.type.level < 90:
         return redirect('/')
@@ -397,7 +1016,7 @@ def deauth_other(loc, hwid):
     return redirect('/admin/locations/' + str(loc))
 
 
-@app.route('/')
+@views.route('/')
 def root():
     if 'admin' in session:
         del session['admin']
@@ -405,30 +1024,115 @@ def root():
     return render_template('index.html')
 
 
-@app.route('/card_read/<int:hwid>', methods=['GET', 'POST'])
-def card_read(hwid):
-    resp = 'Read success from HWID %d: Facility %s, card %s' % (hwid, request.form['facility'], request.form['cardnum'])
+# set up by create_app() with the CARD_DEBOUNCE_SECONDS window
+tap_filter = None
+
+
+def ingest_reads(hwid, reads, boot=None):
+    # turn a reader's raw reads into scan events for its kiosk; reads are dicts with facility, cardnum
+    # and optionally a reader sequence number seq. Returns None for an unknown reader, otherwise one
+    # status per read.
     db = db_session()
     kiosk = db.query(Kiosk).filter_by(hardware_id=hwid).one_or_none()
     if not kiosk:
-        return abort(403)
+        return None
 
-    dbcard = db.query(HawkCard) \
-        .filter_by(card=request.form['cardnum'], location_id=kiosk.location_id) \
-        .one_or_none()
-    user = dbcard.user if dbcard else None
-    socketio.emit('scan', {
-        'facility': request.form['facility'],
-        'card': request.form['cardnum'],
-        'hwid': hwid,
-        'sid': user.sid if user else None,
-        'name': user.name if user else None,
-    })
+    statuses = list()
+    accepted = list()
+    for read in reads:
+        try:
+            card = int(read['cardnum'])
+        except (KeyError, TypeError, ValueError):
+            statuses.append('invalid')
+            continue
+        seq = read.get('seq')
+        status = tap_filter.check(hwid, card, seq if isinstance(seq, int) else None, boot)
+        statuses.append(status)
+        if status == ingest.ACCEPTED:
+            accepted.append((card, read))
+
+    # resolve every accepted card in one query
+    users = dict()
+    if accepted:
+        users = dict((card.card, card.user) for card in db.query(HawkCard)
+                     .filter(HawkCard.location_id == kiosk.location_id)
+                     .filter(HawkCard.card.in_([card for card, read in accepted])))
+    for card, read in accepted:
+        user = users.get(card)
+        socketio.emit('scan', {
+            'facility': read.get('facility'),
+            'card': read['cardnum'],
+            'hwid': hwid,
+            'sid': user.sid if user else None,
+            'name': user.name if user else None,
+        }, room=kiosk_room(kiosk.location_id, hwid))
+    return statuses
+
+
+@views.route('/card_read/<int:hwid>', methods=['GET', 'POST'])
+def card_read(hwid):
+    resp = 'Read success from HWID %d: Facility %s, card %s' % (hwid, request.form['facility'], request.form['cardnum'])
+    statuses = ingest_reads(hwid, [{'facility': request.form['facility'], 'cardnum': request.form['cardnum']}])
+    if statuses is None:
+        return abort(403)
+    if statuses[0] != ingest.ACCEPTED:
+        resp = 'Read %s from HWID %d: Facility %s, card %s' % (
+            statuses[0], hwid, request.form['facility'], request.form['cardnum'])
     print(resp)
     return resp
 
 
-@app.route('/checkout', methods=['GET', 'POST'])
+@views.route('/card_read/<int:hwid>/batch', methods=['POST'])
+def card_read_batch(hwid):
+    data = request.get_json(force=True, silent=True)
+    # the boot id is what tells a resent batch from a reader that restarted its sequence numbers
+    if not data or not isinstance(data.get('reads'), list) or data.get('boot') in (None, ''):
+        return abort(400)
+    statuses = ingest_reads(hwid, data['reads'], data.get('boot'))
+    if statuses is None:
+        return abort(403)
+    return jsonify({'results': [{'seq': read.get('seq') if isinstance(read, dict) else None, 'status': status}
+                                for read, status in zip(data['reads'], statuses)]})
+
+
+# Machine authorization for interlocks: is this user trained on this machine and checked in here? Answered
+# from the in-memory training matrix and the occupancy cache. GET answers one question; POST takes
+# {"location": 1, "queries": [{"sid": 20123456, "machine": 3}, ...]} and answers them all at once.
+def authorize_one(location_id, occupants, sid, machine_id):
+    trained = training_matrix.trained(location_id, sid, machine_id)
+    checked_in = sid in occupants
+    return {'sid': sid, 'machine': machine_id, 'trained': trained, 'checked_in': checked_in,
+            'authorized': trained and checked_in}
+
+
+@views.route('/api/authorize', methods=['GET', 'POST'])
+def authorize():
+    token = current_app.config.get('AUTHORIZE_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('X-Auth-Token', ''), token):
+        return abort(403)
+
+    try:
+        if request.method == 'GET':
+            location_id = int(request.args['location'])
+            queries = [(int(request.args['sid']), int(request.args['machine']))]
+        else:
+            data = request.get_json(force=True)
+            location_id = int(data['location'])
+            queries = [(int(q['sid']), int(q['machine'])) for q in data['queries']]
+    except (KeyError, TypeError, ValueError):
+        return abort(400)
+
+    occupants = occupancy.occupants(location_id)
+    results = [authorize_one(location_id, occupants, sid, machine_id) for sid, machine_id in queries]
+    return jsonify(results[0] if request.method == 'GET' else {'results': results})
+
+
+@views.route('/metrics')
+def metrics_page():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@views.route('/checkout', methods=['GET', 'POST'])
 def checkout():
     db = db_session()
 
@@ -448,7 +1152,11 @@ def checkout():
                 .filter_by(sid=int(request.args['sid'])) \
                 .one_or_none()
         elif 'aid' in request.args:
-            lastIn = db.query(Access).get(int(request.args['aid']))
+            lastIn = db.query(Access) \
+                .filter_by(location_id=location.id) \
+                .filter_by(timeOut=None) \
+                .filter_by(id=int(request.args['aid'])) \
+                .one_or_none()
 
         if lastIn:
             # user signing out
@@ -456,12 +1164,14 @@ def checkout():
                 lastIn.user.name, location.name, location.id, session['hardware_id']
             ))
             # sign user out and send to confirmation page
-            lastIn.timeOut = sa.func.now()
+            lastIn.timeOut = db_now()
+            record_tap(db, location.id, None, lastIn)
     db.commit()
+    if location and lastIn:
+        visit_closed(db, location.id, lastIn)
 
     # need to query again for active users now that it's changed
     before_request()
-    update_kiosks(session['location_id'], except_hwid=session['hardware_id'])
 
     if 'next' in request.args:
         return redirect(request.args.get('next'))
@@ -469,7 +1179,7 @@ def checkout():
         return success('checkout')
 
 
-@app.route('/index', methods=['GET'])
+@views.route('/index', methods=['GET'])
 def index():
     return redirect('/')
 
@@ -483,26 +1193,31 @@ success_messages.update({
 })
 
 
-@app.route('/success/<action>', methods=['GET'])
+@views.route('/success/<action>', methods=['GET'])
 def success(action):
     return render_template('success.html', msg=success_messages[action])
 
 
-@app.route('/banned', methods=['GET'])
+@views.route('/banned', methods=['GET'])
 def banned():
     return render_template('banned.html')
 
 
-@app.route('/needs_training', methods=['GET'])
+@views.route('/needs_training', methods=['GET'])
 def needs_training():
     return render_template('needs_training.html')
 
 
+@views.route('/looking_up', methods=['GET'])
+def looking_up():
+    return render_template('looking_up.html')
+
+
 def _login(request):
     error = None
     if request.method == 'POST':
-        if (request.form['username'] != app.config['USERNAME']
-            or request.form['password'] != app.config['PASSWORD']):
+        if (request.form['username'] != current_app.config['USERNAME']
+            or request.form['password'] != current_app.config['PASSWORD']):
             error = 'Authentication failure'
         else:
             session['logged_in'] = True
@@ -510,7 +1225,7 @@ def _login(request):
 
 
 # Admin authentication
-@app.route('/admin/login', methods=['GET', 'POST'])
+@views.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     if not request.args.get('sid') and not request.args.get('card'):
         return render_template('admin/login_cardtap.html')
@@ -534,7 +1249,7 @@ def admin_login():
                                sid=request.args.get('sid'))
 
 
-@app.route('/admin/auth', methods=['POST'])
+@views.route('/admin/auth', methods=['POST'])
 def admin_auth():
     # sanity checks
     db = db_session()
@@ -549,17 +1264,18 @@ def admin_auth():
                                error='Invalid PIN!',
                                sid=request.form['sid'])
     # we good
+    db.commit()
     session['admin'] = user.sid
     return redirect('/admin')
 
 
-@app.route('/admin/logout', methods=['GET'])
+@views.route('/admin/logout', methods=['GET'])
 def admin_logout():
     session['admin'] = None
-    return redirect(url_for('.success', action='logout'))
+    return redirect(url_for('checkin.success', action='logout'))
 
 
-@app.route('/admin/change_pin', methods=['GET', 'POST'])
+@views.route('/admin/change_pin', methods=['GET', 'POST'])
 def admin_change_pin():
     if request.method == 'GET':
         return render_template('admin/change_pin.html')
@@ -577,7 +1293,7 @@ def admin_change_pin():
 
 
 # Admin flow
-@app.route('/admin', methods=['GET'])
+@views.route('/admin', methods=['GET'])
 def admin_dash():
     if g.admin and g.admin.location_id == session['location_id']:
         return render_template('admin/index.html')
@@ -585,7 +1301,7 @@ def admin_dash():
         return redirect('/')
 
 
-@app.route('/admin/lookup', methods=['GET'])
+@views.route('/admin/lookup', methods=['GET'])
 def admin_lookup():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -596,26 +1312,46 @@ def admin_lookup():
     sid = request.args.get('sid')
     name = request.args.get('name')
     card_id = request.args.get('card')
-    location_id = request.args.get('location') if 'location' in request.args else session['location_id']
+    after = search.parse_int(request.args.get('after'))
+    # a missing or malformed location means the admin's own
+    location_id = request.args.get('location', type=int)
+    if location_id is None:
+        location_id = session['location_id']
     query = query.filter(User.location_id == location_id)
     if sid or name or card_id:
         if sid and sid != '':
             query = query.filter_by(sid=sid)
         if name and name != '':
-            query = query.filter(User.name.ilike(name + '%'))
+            # every word has to start one of the words in the user's name
+            for token in search.name_tokens(name):
+                query = query.filter(User.sid.in_(
+                    db.query(UserNameToken.sid)
+                        .filter(UserNameToken.location_id == location_id)
+                        .filter(UserNameToken.token.like(token + '%'))
+                ))
         if card_id:
-            query = query.filter(User.cards.any(HawkCard.card == card_id))
+            query = query.join(User.cards).filter(HawkCard.card == card_id)
     else:
-        query = query.filter(User.access.any(Access.timeOut == None))
+        query = query.filter(User.sid.in_(list(occupancy.occupants(location_id)) or [None]))
+
+    # keyset pagination on (name, sid), continuing after the last user on the previous page
+    if after:
+        last = db.query(User).get((after, location_id))
+        if last:
+            query = query.filter(sa.or_(User.name > last.name, sa.and_(User.name == last.name, User.sid > last.sid)))
+    results = query.order_by(User.name, User.sid).limit(search.PAGE_SIZE + 1).all()
+    next_page = url_for('checkin.admin_lookup', **dict(request.args.to_dict(), after=results[search.PAGE_SIZE - 1].sid)) \
+        if len(results) > search.PAGE_SIZE else None
+    results = results[:search.PAGE_SIZE]
 
     access_log = None
+    next_before = None
     machines = None
     types = None
     ban_type = None
+    detail = len(results) == 1 and not after
 
-    results = query.limit(20).all()
-
-    if len(results) == 1:
+    if detail:
         machines = db.query(Machine).filter_by(location_id=session['location_id']).all()
         # if found user has lower rank than admin user
         if results[0].type.level < g.admin.type.level:
@@ -623,17 +1359,29 @@ def admin_lookup():
                 .filter(Type.level <= g.admin.type.level) \
                 .all()
         access_log = db.query(Access) \
-            .filter_by(sid=results[0].sid, location_id=session['location_id']) \
-            .order_by(Access.timeIn.desc()).limit(10).all()
+            .filter_by(sid=results[0].sid, location_id=session['location_id'])
+        # keyset pagination on (timeIn, id), newest first
+        before = search.parse_int(request.args.get('before'))
+        if before:
+            last = db.query(Access).get(before)
+            if last:
+                access_log = access_log.filter(sa.or_(Access.timeIn < last.timeIn,
+                                                      sa.and_(Access.timeIn == last.timeIn, Access.id < last.id)))
+        access_log = access_log.order_by(Access.timeIn.desc(), Access.id.desc()) \
+            .limit(search.ACCESS_PAGE_SIZE + 1).all()
+        if len(access_log) > search.ACCESS_PAGE_SIZE:
+            next_before = access_log[search.ACCESS_PAGE_SIZE - 1].id
+        access_log = access_log[:search.ACCESS_PAGE_SIZE]
         ban_type = db.query(Type).filter_by(location_id=session['location_id']) \
             .filter(Type.level < 0) \
             .first()
 
-    return render_template('admin/lookup.html', results=results, machines=machines, types=types, access_log=access_log,
+    return render_template('admin/lookup.html', results=results, detail=detail, machines=machines, types=types,
+                           access_log=access_log, next_page=next_page, next_before=next_before,
                            now=datetime.now(), ban_type=ban_type, error=request.args.get('error'))
 
 
-@app.route('/admin/clear_waiver', methods=['GET'])
+@views.route('/admin/clear_waiver', methods=['GET'])
 def admin_clear_waiver():
     if not session['admin']:
         return redirect('/')
@@ -648,19 +1396,25 @@ def admin_clear_waiver():
     return redirect('/admin/lookup?sid=' + str(user.sid))
 
 
-@app.route('/admin/clear_lab', methods=['GET'])
+@views.route('/admin/clear_lab', methods=['GET'])
 def admin_clear_lab():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/admin/login')
 
     db = db_session()
-    db.query(Access).filter_by(timeOut=None).update({"timeOut": sa.func.now()}, synchronize_session=False)
+    before = len(occupancy.occupants(session['location_id']))
+    db.query(Access) \
+        .filter_by(location_id=session['location_id'], timeOut=None) \
+        .update({'timeOut': db_now(), 'auto_closed': True}, synchronize_session=False)
+    record_occupancy(db, session['location_id'], before, 0)
     db.commit()
+    occupancy.invalidate(session['location_id'])
+    update_kiosks(session['location_id'])
     session['admin'] = None
     return redirect('/success/checkout')
 
 
-@app.route('/admin/training/add', methods=['POST'])
+@views.route('/admin/training/add', methods=['POST'])
 def admin_add_training():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -668,13 +1422,14 @@ def admin_add_training():
     t = Training(trainee_id=int(request.form['student_id']),
                  trainer_id=int(session['admin']),
                  machine_id=int(request.form['machine']),
-                 date=sa.func.now())
+                 date=db_now())
     db.add(t)
     db.commit()
+    training_changed(db, session['location_id'], t.trainee_id, t.machine_id)
     return redirect('/admin/lookup?sid=' + str(request.form['student_id']))
 
 
-@app.route('/admin/training/group_add', methods=['GET'])
+@views.route('/admin/training/group_add', methods=['GET'])
 def admin_group_add_training():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -683,7 +1438,110 @@ def admin_group_add_training():
     return render_template('admin/group_training.html', machines=machines)
 
 
-@app.route('/admin/training/remove')
+def add_trainings(db, location_id, machine_id, trainer_id, sids):
+    # record training on one machine for many users in a single insert, skipping anyone already trained
+    existing = set(sid for (sid,) in db.query(Training.trainee_id)
+                   .filter(Training.machine_id == machine_id, Training.trainee_id.in_(sids)))
+    new = [sid for sid in sids if sid not in existing]
+    if new:
+        now = datetime.now()
+        db.execute(Training.__table__.insert(), [
+            {'trainee_id': sid, 'trainer_id': trainer_id, 'machine_id': machine_id, 'date': now} for sid in new
+        ])
+        db.commit()
+        for sid in new:
+            training_matrix.update(location_id, sid, machine_id, True)
+            occupant_updated(db, location_id, sid)
+    return len(new), len(existing)
+
+
+# Group training: while an admin kiosk holds a session open, trainees tap their cards and are collected
+# here; finishing the session records all of them at once. A session outlives the page, so a kiosk that
+# reconnects or reloads picks up where it left off. Sessions are kept by the coordinator, since a kiosk's
+# start, taps and finish can reach different workers. Each session's trainees are a list of its own that
+# every tap appends to, so taps handled at once don't overwrite each other; a session is forgotten
+# GROUP_TRAINING_TTL seconds after it starts.
+GROUP_TRAINING_TTL = 86400
+
+
+def group_training_key():
+    return 'group-training:%d:%d' % (session['location_id'], session['hardware_id'])
+
+
+def group_trainees(training):
+    # sid -> name of everyone tapped in so far, in the order they first tapped
+    trainees = OrderedDict()
+    for sid, name in coordinator.get_list('group-trainees:%s' % training['id']):
+        trainees.setdefault(sid, name)
+    return trainees
+
+
+def group_training_admin(db):
+    if not session.get('admin'):
+        return None
+    admin = db.query(User).get((session['admin'], session['location_id']))
+    return admin if admin and admin.type.level > 0 else None
+
+
+@on_socket_event('group training start')
+def group_training_start(data):
+    db = db_session()
+    admin = group_training_admin(db)
+    if not admin:
+        return {'error': 'Please sign in as an admin first.'}
+    training = coordinator.get(group_training_key())
+    if training and training['trainer_id'] == admin.sid:
+        return {'machine_id': training['machine_id'], 'trainees': list(group_trainees(training).values())}
+    if training:
+        # left behind by another admin; their trainees are still recorded
+        trainees = group_trainees(training)
+        coordinator.release('group-trainees:%s' % training['id'])
+        if trainees:
+            add_trainings(db, session['location_id'], training['machine_id'], training['trainer_id'],
+                          list(trainees))
+
+    machine = db.query(Machine).filter_by(id=int(data['machine']), location_id=session['location_id']).one_or_none()
+    if not machine:
+        return {'error': 'That machine does not exist.'}
+
+    coordinator.put(group_training_key(), {
+        'id': uuid.uuid4().hex,
+        'machine_id': machine.id,
+        'trainer_id': admin.sid,
+    }, GROUP_TRAINING_TTL)
+    return {'machine_id': machine.id, 'trainees': []}
+
+
+@on_socket_event('group training tap')
+def group_training_tap(data):
+    training = coordinator.get(group_training_key())
+    if not training:
+        return {'error': 'No group training in progress.'}
+    if data.get('sid') is None:
+        return {'error': 'This student is not registered!'}
+    user = db_session().query(User).get((int(data['sid']), session['location_id']))
+    if not user:
+        return {'error': 'This student is not registered!'}
+
+    coordinator.append('group-trainees:%s' % training['id'], [user.sid, user.name], GROUP_TRAINING_TTL)
+    return {'trainees': list(group_trainees(training).values())}
+
+
+@on_socket_event('group training finish')
+def group_training_finish(data):
+    training = coordinator.pop(group_training_key())
+    if not training:
+        return {'added': 0, 'skipped': 0}
+    trainees = group_trainees(training)
+    coordinator.release('group-trainees:%s' % training['id'])
+    if not trainees:
+        return {'added': 0, 'skipped': 0}
+    added, skipped = add_trainings(db_session(), session['location_id'], training['machine_id'],
+                                   training['trainer_id'], list(trainees))
+    return {'added': added, 'skipped': skipped}
+
+
+@views.route('/admin/training/remove')
 def admin_remove_training():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -692,8 +1550,10 @@ def admin_remove_training():
     sid = 0
     if training:
         sid = training.trainee_id if training else None
+        machine_id = training.machine_id
         db.delete(training)
         db.commit()
+        training_changed(db, session['location_id'], sid, machine_id)
     else:
         sid = request.args.get('sid')
 
@@ -701,7 +1561,7 @@ def admin_remove_training():
 
 
 # TODO: implement location & machine UI
-@app.route('/admin/locations')
+@views.route('/admin/locations')
 def admin_locations():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -711,7 +1571,7 @@ def admin_locations():
     return render_template("/admin/locations.html", locations=locations)
 
 
-@app.route('/admin/locations/<int:id>')
+@views.route('/admin/locations/<int:id>')
 def admin_location(id):
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -727,19 +1587,19 @@ def admin_location(id):
     return render_template("/admin/location.html", location=location, machines=machines, staff=staff, kiosks=kiosks)
 
 
-@app.route('/admin/locations/remove')
+@views.route('/admin/locations/remove')
 def admin_remove_location():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
 
 
-@app.route('/admin/locations/update')
+@views.route('/admin/locations/update')
 def admin_update_location():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
 
 
-@app.route('/admin/locations/add', methods=['GET', 'POST'])
+@views.route('/admin/locations/add', methods=['GET', 'POST'])
 def admin_add_location():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -768,7 +1628,7 @@ def admin_add_location():
         return redirect('/admin/locations/' + str(loc.id))
 
 
-@app.route('/admin/locations/set_secret/<int:id>', methods=['POST'])
+@views.route('/admin/locations/set_secret/<int:id>', methods=['POST'])
 def admin_set_location_secret(id):
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -783,7 +1643,26 @@ def admin_set_location_secret(id):
     return redirect('/admin/locations/' + str(id))
 
 
-@app.route('/admin/locations/add_machine/<int:id>', methods=['GET', 'POST'])
+@views.route('/admin/locations/set_hours/<int:id>', methods=['POST'])
+def admin_set_location_hours(id):
+    if not g.admin or g.admin.location_id != session['location_id']:
+        return redirect('/')
+    if g.admin.type.level < 90:
+        return redirect('/admin')
+
+    db = db_session()
+    loc = db.query(Location).get(id)
+    try:
+        loc.closing_time = autoclose.parse_closing_time(request.form.get('closing_time'))
+    except ValueError:
+        return redirect('/admin/locations/' + str(id))
+    loc.max_session_hours = search.parse_int(request.form.get('max_session_hours')) or None
+    db.commit()
+
+    return redirect('/admin/locations/' + str(id))
+
+
+@views.route('/admin/locations/add_machine/<int:id>', methods=['GET', 'POST'])
 def admin_add_machine(id):
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -801,7 +1680,7 @@ def admin_add_machine(id):
     return redirect('/admin/locations/' + str(id))
 
 
-@app.route('/admin/type/set')
+@views.route('/admin/type/set')
 def admin_set_type():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
@@ -821,82 +1700,352 @@ def admin_set_type():
 
     user.type_id = request.args['tid']
     db.commit()
+    occupant_updated(db, user.location_id, user.sid)
     return redirect('/admin/lookup?sid=' + request.args['sid'])
 
 
-# Automatic announcer control
-@app.route('/admin/announcer')
+@views.route('/admin/reports')
+def admin_reports():
+    if not g.admin or g.admin.location_id != session['location_id']:
+        return redirect('/')
+    db = db_session()
+    default_start, default_end = analytics.default_range()
+    try:
+        start = analytics.parse_day(request.args.get('start'), default_start)
+        end = analytics.parse_day(request.args.get('end'), default_end)
+    except ValueError:
+        return redirect('/admin/reports?error=Dates must look like 2017-12-31.')
+    group = request.args.get('group') if request.args.get('group') in ('day', 'week', 'month') else 'day'
+    rows, hours = usage_report(db, session['location_id'], start, end, group)
+
+    # exports reach into the archive when the range starts before the archive horizon
+    archived = start < archive.horizon(current_app.config.get('ARCHIVE_AFTER_DAYS', 365)).date()
+    return render_template('admin/reports.html', rows=rows, hours=hours, start=start, end=end, group=group,
+                           archived=archived,
+                           type_names=sorted(set(name for row in rows for name in row['hours_by_type'])),
+                           error=request.args.get('error'))
+
+
+def usage_report(db, location_id, start, end, group='day'):
+    # (rows, hours) for the reports page, from the rollups
+    hourly = db.query(UsageHourly.day, UsageHourly.hour, UsageHourly.type_id, UsageHourly.visits, UsageHourly.seconds) \
+        .filter(UsageHourly.location_id == location_id, UsageHourly.day >= start, UsageHourly.day <= end)
+    peaks = db.query(UsagePeak.day, UsagePeak.hour, UsagePeak.peak) \
+        .filter(UsagePeak.location_id == location_id, UsagePeak.day >= start, UsagePeak.day <= end)
+    visitors = db.query(UsageVisitor.day, UsageVisitor.sid) \
+        .filter(UsageVisitor.location_id == location_id, UsageVisitor.day >= start, UsageVisitor.day <= end)
+    types = dict(db.query(Type.id, Type.name).filter_by(location_id=location_id))
+    return analytics.summarize(hourly, peaks, visitors, types, group)
+
+
+def usage_report_raw(db, location_id, start, end, group='day'):
+    # the same report computed from the access tables, the way it would be without rollups; used to
+    # check the rollups and benchmark them against (see loadtest.py bench-reports)
+    low, high = analytics.day_range(start, end)
+    visits = list(itertools.chain(*(closed_visits(table)
+                                    .filter(table.location_id == location_id, table.timeIn < high, table.timeOut > low)
+                                    for table in (AccessArchive, Access))))
+    hourly, visitors = analytics.visit_contributions(
+        (location_id, sid, type_id or 0, time_in, time_out) for location_id, sid, type_id, time_in, time_out in visits)
+    peaks = analytics.peak_occupancy((max(time_in, low), min(time_out, high))
+                                     for location_id, sid, type_id, time_in, time_out in visits)
+    types = dict(db.query(Type.id, Type.name).filter_by(location_id=location_id))
+    return analytics.summarize(
+        [(day, hour, type_id, count, seconds) for (_, day, hour, type_id), (count, seconds) in hourly.items()
+         if start <= day <= end],
+        [(day, hour, peak) for (day, hour), peak in peaks.items()],
+        [(day, sid) for _, day, sid in visitors if start <= day <= end],
+        types, group)
+
+
+def export_rows(kind, location_id, start=None, end=None, sid=None, archived=False):
+    # (columns, rows) for an access or scan log export; rows are streamed from a server-side cursor, and
+    # archived rows (which are all older than the live ones) come first if asked for
+    db = db_session()
+    if kind == 'access':
+        columns = ['id', 'sid', 'name', 'location_id', 'time_in', 'time_out', 'auto_closed']
+
+        def rows(table):
+            query = db.query(table.id, table.sid, User.name, table.location_id, table.timeIn, table.timeOut,
+                             table.auto_closed) \
+                .outerjoin(User, sa.and_(User.sid == table.sid, User.location_id == table.location_id))
+            return query, table.timeIn, table.sid
+        tables = (AccessArchive, Access)
+    elif kind == 'scans':
+        columns = ['id', 'card', 'sid', 'location_id', 'time']
+
+        def rows(table):
+            query = db.query(table.id, table.card_id, HawkCard.sid, table.location_id, table.time) \
+                .outerjoin(HawkCard, sa.and_(HawkCard.card == table.card_id,
+                                             HawkCard.location_id == table.location_id))
+            return query, table.time, HawkCard.sid
+        tables = (CardScanArchive, CardScan)
+    else:
+        raise ValueError('Unknown export: %s' % kind)
+
+    queries = list()
+    for table in tables if archived else tables[1:]:
+        query, time_column, sid_column = rows(table)
+        query = query.filter(table.location_id == location_id).order_by(table.id)
+        if start:
+            query = query.filter(time_column >= start)
+        if end:
+            query = query.filter(time_column < end)
+        if sid:
+            query = query.filter(sid_column == sid)
+        queries.append(query.execution_options(stream_results=True).yield_per(1000))
+    return columns, itertools.chain(*queries)
+
+
+def export_range(start, end):
+    # inclusive YYYY-MM-DD dates -> datetime bounds, either of which may be missing
+    start = analytics.parse_day(start, None)
+    end = analytics.parse_day(end, None)
+    return (analytics.day_range(start, start)[0] if start else None,
+            analytics.day_range(end, end)[1] if end else None)
+
+
+@views.route('/admin/export/<kind>.<fmt>')
+def admin_export(kind, fmt):
+    if not g.admin or g.admin.location_id != session['location_id']:
+        return redirect('/')
+    if kind not in ('access', 'scans') or fmt not in export.formats:
+        return abort(404)
+    try:
+        start, end = export_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        return redirect('/admin/reports?error=Dates must look like 2017-12-31.')
+
+    columns, rows = export_rows(kind, session['location_id'], start, end, request.args.get('sid'),
+                                archived=bool(request.args.get('archive')))
+    filename = '%s-%d.%s' % (kind, session['location_id'], fmt)
+    return Response(stream_with_context(export.chunks(fmt, columns, rows)),
+                    mimetype=export.formats[fmt],
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+
+def import_roster(db, location_id, f):
+    # create or update a location's users and cards from a roster CSV (see roster.py) with a few batched
+    # statements per 500 rows; returns counts of what happened
+    counts = defaultdict(int)
+    bad_lines = list()
+    types = dict((name.lower(), tid) for tid, name in db.query(Type.id, Type.name).filter_by(location_id=location_id))
+    default_type = db.query(Type).filter_by(location_id=location_id, level=0).first()
+    if not default_type:
+        default_type = Type(level=0, location_id=location_id, name='Users')
+        db.add(default_type)
+        db.commit()
+
+    for batch in roster.batches(roster.read_roster(f)):
+        users = OrderedDict()
+        cards = OrderedDict()
+        for line, sid, name, card, type_name in batch:
+            type_id = types.get(type_name.lower()) if type_name else None
+            if sid is None or (type_name and type_id is None):
+                counts['skipped'] += 1
+                bad_lines.append(line)
+                continue
+            users[sid] = {'sid': sid, 'location_id': location_id, 'name': name, 'type_id': type_id}
+            if card is not None:
+                cards[card] = {'card': card, 'location_id': location_id, 'sid': sid}
+
+        existing = dict((sid, (name, type_id)) for sid, name, type_id in
+                        db.query(User.sid, User.name, User.type_id)
+                        .filter(User.location_id == location_id, User.sid.in_(list(users))))
+        inserts = list()
+        updates = list()
+        for sid, user in users.items():
+            if sid not in existing:
+                user['type_id'] = user['type_id'] or default_type.id
+                inserts.append(user)
+            else:
+                # a roster without a type never demotes existing staff
+                user['type_id'] = user['type_id'] or existing[sid][1]
+                if existing[sid] != (user['name'], user['type_id']):
+                    updates.append(user)
+                else:
+                    counts['skipped'] += 1
+        db.bulk_insert_mappings(User, inserts)
+        db.bulk_update_mappings(User, updates)
+        # bulk writes skip the ORM events that keep name search up to date
+        index_names(db.connection(), location_id, [(u['sid'], u['name']) for u in inserts + updates])
+        counts['inserted'] += len(inserts)
+        counts['updated'] += len(updates)
+
+        existing_cards = dict(db.query(HawkCard.card, HawkCard.sid)
+                              .filter(HawkCard.location_id == location_id, HawkCard.card.in_(list(cards))))
+        card_inserts = [c for card, c in cards.items() if card not in existing_cards]
+        card_updates = [c for card, c in cards.items() if card in existing_cards and existing_cards[card] != c['sid']]
+        db.bulk_insert_mappings(HawkCard, card_inserts)
+        db.bulk_update_mappings(HawkCard, card_updates)
+        counts['cards_inserted'] += len(card_inserts)
+        counts['cards_updated'] += len(card_updates)
+        db.commit()
+
+    # names and types of people in the lab may have changed
+    occupancy.invalidate(location_id)
+    return counts, bad_lines
+
+
+@views.route('/admin/roster', methods=['GET', 'POST'])
+def admin_roster():
+    if not g.admin or g.admin.location_id != session['location_id']:
+        return redirect('/')
+    if g.admin.type.level < 90:
+        return redirect('/admin')
+    if request.method == 'GET':
+        return render_template('admin/roster.html')
+
+    if 'roster' not in request.files or not request.files['roster'].filename:
+        return render_template('admin/roster.html', error='Please choose a roster file.')
+    try:
+        counts, bad_lines = import_roster(db_session(), session['location_id'],
+                                          codecs.getreader('utf-8-sig')(request.files['roster'].stream))
+    except (ValueError, UnicodeDecodeError) as e:
+        return render_template('admin/roster.html', error=str(e))
+    return render_template('admin/roster.html', counts=counts, bad_lines=bad_lines[:20])
+
+
+# Automatic announcer control: commands are queued for the location's announcer client (see
+# announcer.py) and their progress is pushed to the location's kiosks as 'announcer status' events.
+# Only the leading worker has announcer clients; the others send it their commands, and it shares the
+# recent commands' statuses so every worker can show them.
+announcers = dict()
+announcers_lock = threading.Lock()
+# how announcer clients connect; the load test swaps in announcer.StandIn
+announcer_connect = announcer.zerorpc_client
+
+
+def location_announcer(location):
+    with announcers_lock:
+        current = announcers.get(location.id)
+        if current is None or current.address != location.announcer:
+            current = announcers[location.id] = announcer.Announcer(
+                location.announcer,
+                connect=lambda address, timeout: announcer_connect(address, timeout),
+                timeout=current_app.config.get('ANNOUNCER_TIMEOUT', 5),
+                queue_size=current_app.config.get('ANNOUNCER_QUEUE_SIZE', 20),
+                retries=current_app.config.get('ANNOUNCER_RETRIES', 3),
+                deadline=current_app.config.get('ANNOUNCER_DEADLINE', 30),
+                on_status=lambda status, location_id=location.id: announcer_status(location_id, status),
+                start_task=socketio.start_background_task,
+                sleep=socketio.sleep,
+                timer=announcer_seconds.time)
+        return current
+
+
+def announcer_status(location_id, status):
+    socketio.emit('announcer status', status, room=location_room(location_id))
+    if coordinator.shared:
+        coordinator.put('announcer:%d' % location_id,
+                        [announcer.status(command) for command in list(announcers[location_id].recent)], 86400)
+
+
+def recent_announcements(location_id):
+    if coordinator.leader():
+        current = announcers.get(location_id)
+        return [announcer.status(command) for command in list(current.recent)] if current else list()
+    return coordinator.get('announcer:%d' % location_id) or list()
+
+
+def submit_announcement(location, method, args, urgent):
+    # on the leader; a full queue fails the command where every worker's announcer page can see it
+    try:
+        location_announcer(location).submit(method, *args, urgent=urgent)
+    except announcer.QueueFull as e:
+        socketio.emit('announcer status', {'id': next(announcer.Announcer.ids), 'method': method,
+                                           'status': announcer.FAILED, 'attempts': 0, 'error': str(e)},
+                      room=location_room(location.id))
+
+
+def announcer_forward_loop(app):
+    # runs the commands other workers send the leader
+    while True:
+        if not coordinator.leader():
+            socketio.sleep(1)
+            continue
+        try:
+            message = coordinator.receive(timeout=1)
+            if message:
+                with app.app_context():
+                    location = db_session().query(Location).get(message['location_id'])
+                    submit_announcement(location, message['method'], message['args'], message['urgent'])
+        except Exception as e:
+            app.logger.error(e, exc_info=True)
+            socketio.sleep(1)
+
+
+def announce(method, *args, urgent=False):
+    if coordinator.leader():
+        try:
+            location_announcer(g.location).submit(method, *args, urgent=urgent)
+        except announcer.QueueFull:
+            return redirect(url_for('checkin.admin_announcer', busy=1))
+    else:
+        queued = [c for c in recent_announcements(g.location.id) if c['status'] == announcer.QUEUED]
+        if not urgent and len(queued) >= current_app.config.get('ANNOUNCER_QUEUE_SIZE', 20):
+            return redirect(url_for('checkin.admin_announcer', busy=1))
+        coordinator.send({'location_id': g.location.id, 'method': method, 'args': list(args), 'urgent': urgent})
+    return redirect('/admin/announcer')
+
+
+@views.route('/admin/announcer')
 def admin_announcer():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
-    return render_template("/admin/announcer.html")
+    commands = recent_announcements(g.location.id)
+    return render_template("/admin/announcer.html", commands=reversed(commands), busy=request.args.get('busy'))
 
 
-@app.route('/admin/announcer/test')
+@views.route('/admin/announcer/test')
 def admin_announcer_test():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
-    announcer = zerorpc.Client()
-    announcer.connect(g.location.announcer)
-    announcer.test()
-    return redirect('/admin/announcer')
+    return announce('test')
 
 
-@app.route('/admin/announcer/power_tool', methods=['POST'])
+@views.route('/admin/announcer/power_tool', methods=['POST'])
 def admin_announcer_power_tool():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
-    announcer = zerorpc.Client()
-    announcer.connect(g.location.announcer)
 
     if request.form.get('endtimesub'):
         timestr = request.form['endtime']
         h = int(timestr.split(':')[0])
         m = int(timestr.split(':')[1].split(' ')[0])
         am = timestr.split(':')[1].split(' ')[1] == 'AM'
-        announcer.tools_prohibited(h, m, am)
-        return redirect('/admin/announcer')
+        return announce('tools_prohibited', h, m, am)
     # elif request.form.get('endminssub'):
-    #	announcer.tools_prohibited_rel(int(request.form['endmins']))
-    #	return redirect('/admin/announcer')
+    #	announce('tools_prohibited_rel', int(request.form['endmins']))
     else:
         return abort(500)
 
 
-@app.route('/admin/announcer/cancel_power_tool')
+@views.route('/admin/announcer/cancel_power_tool')
 def admin_announcer_cancel_power_tool():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
-    announcer = zerorpc.Client()
-    announcer.connect(g.location.announcer)
-    announcer.cancel_tools_prohibited()
-    return redirect('/admin/announcer')
+    return announce('cancel_tools_prohibited')
 
 
-@app.route('/admin/announcer/evac', methods=['POST'])
+@views.route('/admin/announcer/evac', methods=['POST'])
 def admin_announcer_evac():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
-    announcer = zerorpc.Client()
-    announcer.connect(g.location.announcer)
     emergency = bool(request.form.get('emergency'))
     emergency_exit = bool(request.form.get('emergency_exit'))
-    announcer.start_evac(emergency, emergency_exit)
-    return redirect('/admin/announcer')
+    return announce('start_evac', emergency, emergency_exit, urgent=True)
 
 
-@app.route('/admin/announcer/cancel_evac')
+@views.route('/admin/announcer/cancel_evac')
 def admin_announcer_cancel_evac():
     if not g.admin or g.admin.location_id != session['location_id']:
         return redirect('/')
-    announcer = zerorpc.Client()
-    announcer.connect(g.location.announcer)
-    announcer.stop_evac()
-    return redirect('/admin/announcer')
+    return announce('stop_evac', urgent=True)
 
 
 # Card tap flow
-@app.route('/waiver', methods=['GET'])
+@views.route('/waiver', methods=['GET'])
 def waiver():
     if not request.args.get('agreed'):
         db = db_session()
@@ -921,7 +2070,7 @@ def waiver():
         db.add(Access(
             sid=request.args.get('sid'),
             location_id=session['location_id'],
-            timeIn=sa.func.now(),
+            timeIn=db_now(),
             timeOut=None
         ))
         user = db.query(User) \
@@ -929,9 +2078,10 @@ def waiver():
                        location_id=session['location_id']) \
             .one_or_none()
         if user:
-            user.waiverSigned = sa.func.now()
+            user.waiverSigned = db_now()
+        record_tap(db, session['location_id'], int(request.args.get('sid')), None)
         db.commit()
-        update_kiosks(session['location_id'], except_hwid=session['hardware_id'])
+        visit_opened(db, session['location_id'], int(request.args.get('sid')))
 
         db.query(Training).filter_by(trainee_id=user.sid)
 
@@ -952,18 +2102,13 @@ def waiver():
         return redirect('/')
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@views.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'GET':
-        resp = ""
         card_id = request.args.get('card_id')
         name = ""
         sid = ""
-        try:
-            il = IITLookup(app.config['IITLOOKUPURL'], app.config['IITLOOKUPUSER'], app.config['IITLOOKUPPASS'])
-            resp = il.nameIDByCard(card_id)
-        except:
-            print(sys.exc_info()[0])
+        resp = looked_up_student(session.get('location_id'), request.args.get('card_id', type=int))
         if resp:
             sid = resp['idnumber'][1:]
             name = ("%s %s") % (resp['first_name'], resp['last_name'])
@@ -1003,12 +2148,190 @@ def register():
         card.sid = request.form['sid']
 
         db.commit()
-        return redirect(url_for('.waiver', sid=request.form['sid']))
+        return redirect(url_for('checkin.waiver', sid=request.form['sid']))
+
+
+def looked_up_student(location_id, card_id):
+    # what the background lookup (see lookup_card) found for the card, to fill in the registration form.
+    # The service itself isn't asked: this page is where a lookup that was too slow or failed ends up.
+    if location_id is None or card_id is None:
+        return None
+    student = coordinator.get('lookup-student:%d:%d' % (location_id, card_id))
+    if not student and isinstance(iit_client, CachedIITLookup):
+        student = iit_client.cachedNameIDByCard(card_id)
+    return student
+
+
+def decide_tap(db, card, location, hwid):
+    # work out what a tap of a known card means; returns (log message, page for the kiosk, sid checked in,
+    # Access row checked out). The caller commits.
+    if not card.user:
+        # send to registration page
+        return ("User for card id %d not found" % card.card, url_for('checkin.register', card_id=card.card), None, None)
+
+    lastIn = db.query(Access) \
+        .filter_by(location_id=location.id) \
+        .filter_by(timeOut=None) \
+        .filter_by(sid=card.sid) \
+        .one_or_none()
+
+    # user is banned
+    if card.user.type.level < 0:
+        resp = ("User %s (card id %d) tried to sign in at %s but is banned! (id %d, kiosk %d)" % (
+            card.user.name, card.card, location.name, location.id, hwid
+        ))
+        return resp, url_for('checkin.banned'), None, None
 
+    # user signing out
+    elif lastIn:
+        resp = ("User %s (card id %d) signed out at location %s (id %d, kiosk %d)" % (
+            card.user.name, card.card, location.name, location.id, hwid
+        ))
+        # sign user out and send to confirmation page
+        lastIn.timeOut = db_now()
+        return resp, url_for('checkin.success', action='checkout', name=card.user.name), None, lastIn
 
-@socketio.on('check in')
+    # user signing in
+    elif card.user.waiverSigned:
+        general_machine = db.query(Machine) \
+            .filter(Machine.name.ilike('General Safety Training')) \
+            .filter_by(location_id=location.id) \
+            .one_or_none()
+
+        general_training = None
+        if general_machine:
+            general_training = db.query(Training) \
+                .filter_by(machine_id=general_machine.id) \
+                .filter_by(trainee_id=card.sid) \
+                .count()
+
+        resp = ("User %s (card id %d) is cleared for entry at location %s (id %d, kiosk %d)" % (
+            card.user.name, card.card, location.name, location.id, hwid
+        ))
+        # sign user in and send to confirmation page
+        accessEntry = Access(sid=card.sid, timeIn=db_now(), location_id=location.id)
+        db.add(accessEntry)
+
+        # if user has training or there is no training required, let 'em in
+        if not general_machine or general_training > 0:
+            return resp, url_for('checkin.success', action='checkin', name=card.user.name), card.sid, None
+        else:
+            return resp, url_for('checkin.needs_training', name=card.user.name), card.sid, None
+
+    # user needs to sign waiver
+    else:
+        resp = ("User %s (card id %d) needs to sign waiver at location %s (id %d, kiosk %d)" % (
+            card.user.name, card.card, location.name, location.id, hwid
+        ))
+        # present waiver page
+        return resp, url_for('checkin.waiver', sid=card.sid), None, None
+
+
+def tap_committed(db, location_id, hwid, checked_in, checked_out):
+    # only touch the roster once the change is committed; kiosks are sent the change from there
+    if checked_in:
+        visit_opened(db, location_id, checked_in)
+    elif checked_out:
+        visit_closed(db, location_id, checked_out)
+
+
+# University lookups for unknown cards run in the background so a slow or offline lookup service never
+# holds up the socket handler. The kiosk waits on the looking_up page until the lookup finishes or
+# IITLOOKUP_DEADLINE passes, whichever comes first, and is then sent on as if the card was known.
+# The outcome is also kept until the looking_up page asks for it, in case it was decided before that
+# page had connected. Under eventlet or gevent the lookup only runs alongside other requests if the
+# standard library is monkey-patched (see the README), since the SOAP client uses blocking sockets.
+# Pending lookups and outcomes are kept by the coordinator, so every worker sees them; pending_lookups
+# only settles the race between this worker's lookup and its deadline.
+pending_lookups = dict()
+pending_lookups_lock = threading.Lock()
+
+
+def lookup_pending(location_id, card_id):
+    return coordinator.get('lookup:%d:%d' % (location_id, card_id)) is not None
+
+
+def lookup_card(location_id, hwid, card_id):
+    app = current_app._get_current_object()
+    # finish() runs outside any request, so it builds the kiosk's URLs with an adapter bound to this one
+    url_adapter = app.create_url_adapter(request)
+    key = (location_id, card_id)
+    token = object()
+    # held until the lookup finishes, or for a while past its deadline should this worker die first
+    if not coordinator.claim('lookup:%d:%d' % key, app.config.get('IITLOOKUP_DEADLINE', 3) + 30):
+        return
+    coordinator.pop('lookup-outcome:%d:%d' % key)
+    with pending_lookups_lock:
+        pending_lookups[key] = token
+
+    def finish(student):
+        with pending_lookups_lock:
+            if pending_lookups.get(key) is not token:
+                # the lookup and the deadline race; whoever gets here second does nothing
+                return
+            del pending_lookups[key]
+        coordinator.release('lookup:%d:%d' % key)
+
+        with app.app_context() as ctx:
+            ctx.url_adapter = url_adapter
+            try:
+                db = db_session()
+                card = db.query(HawkCard).get((card_id, location_id))
+                location = db.query(Location).get(location_id)
+                sid = int(student['idnumber'].replace('A', '')) if student else None
+                if sid and db.query(User).get((sid, location_id)):
+                    # user exists, has a new card
+                    card.sid = sid
+                    db.commit()
+
+                resp, to, checked_in, checked_out = decide_tap(db, card, location, hwid)
+                record_tap(db, location_id, checked_in, checked_out)
+                db.commit()
+                coordinator.put('lookup-outcome:%d:%d' % key, to, 300)
+                socketio.emit('go', {'to': to, 'hwid': hwid}, room=kiosk_room(location_id, hwid))
+                tap_committed(db, location_id, hwid, checked_in, checked_out)
+                print(resp)
+            except Exception as e:
+                app.logger.error(e, exc_info=True)
+                socketio.emit('go', {'to': url_for('checkin.display_error'), 'hwid': hwid}, room=kiosk_room(location_id, hwid))
+
+    def run_lookup():
+        student = None
+        try:
+            with app.app_context(), checkin_phase_seconds.time('iit_lookup'):
+                student = iit_lookup().nameIDByCard(card_id)
+        except Exception:
+            print("ERROR: IIT Lookup is offline.")
+        if student:
+            # for the registration form, even if the deadline has already sent the kiosk there
+            coordinator.put('lookup-student:%d:%d' % key, student, 300)
+        finish(student)
+
+    def run_deadline():
+        socketio.sleep(app.config.get('IITLOOKUP_DEADLINE', 3))
+        # fall back to manual registration
+        finish(None)
+
+    socketio.start_background_task(run_lookup)
+    socketio.start_background_task(run_deadline)
+
+
+@on_socket_event('lookup status')
+def lookup_status(data):
+    try:
+        card_id = int(data['card'])
+    except (KeyError, TypeError, ValueError):
+        emit('go', {'to': '/', 'hwid': session['hardware_id']})
+        return
+    to = coordinator.pop('lookup-outcome:%d:%d' % (session['location_id'], card_id))
+    if to:
+        emit('go', {'to': to, 'hwid': session['hardware_id']})
+
+
+@on_socket_event('check in')
 def check_in(data):
     try:
+        started = time.perf_counter()
         db = db_session()
         data['card'] = int(data['card'])
         data['facility'] = int(data['facility'])
@@ -1017,6 +2340,8 @@ def check_in(data):
         server_kiosk = db.query(Kiosk).filter_by(location_id=data['location'], hardware_id=data['hwid']).one_or_none()
 
         resp = ""
+        checked_in = None
+        checked_out = None
 
         # if server_kiosk.token.decode('utf-8') != data['token']:
         #    emit('err', {'hwid': session['hardware_id'], 'err': 'Token mismatch'})
@@ -1035,138 +2360,215 @@ def check_in(data):
         if not location:
             resp = ("Location %d not found" % data['location'])
 
-        if not card:
-            # check to see if they already have a record
-            student = None
-            sid = None
-            try:
-                il = IITLookup(app.config['IITLOOKUPURL'], app.config['IITLOOKUPUSER'], app.config['IITLOOKUPPASS'])
-                student = il.nameIDByCard(data['card'])
-                sid = int(student['idnumber'].replace('A', ''))
-            except Exception:
-                print("ERROR: IIT Lookup is offline.")
-            if not student:
-                # user is new and isn't in IIT's database
-                card = HawkCard(sid=None, card=data['card'], location_id=location.id)
-                db.add(card)
-                db.commit()
-            elif db.query(User).get((sid, location.id)):
-                # user exists, has a new card
-                card = HawkCard(sid=sid, card=data['card'], location_id=location.id)
-                db.add(card)
-                db.commit()
-            else:
-                # first time in lab
-                resp = ("User for card id %d not found" % data['card'])
-                card = HawkCard(sid=None, card=data['card'], location_id=location.id)
-                db.add(card)
-                db.commit()
+        resolved = time.perf_counter()
+        checkin_phase_seconds.observe(resolved - started, 'card')
 
+        if not card:
+            # never seen this card: record it without a user and look it up in the background
+            card = HawkCard(sid=None, card=data['card'], location_id=location.id)
+            db.add(card)
             db.commit()
+            lookup_card(location.id, data['hwid'], data['card'])
+            resp = ("Looking up card id %d at location %s (id %d, kiosk %d)" % (
+                data['card'], location.name, location.id, data['hwid']
+            ))
+            emit('go', {'to': url_for('checkin.looking_up', card=data['card']), 'hwid': data['hwid']})
 
-        if not card or not card.user:
-            # send to registration page
-            emit('go', {'to': url_for('.register', card_id=data['card']), 'hwid': data['hwid']})
+        elif not card.user and lookup_pending(location.id, data['card']):
+            # tapped again while the first lookup is still running
+            emit('go', {'to': url_for('checkin.looking_up', card=data['card']), 'hwid': data['hwid']})
 
         else:
-            lastIn = db.query(Access) \
-                .filter_by(location_id=location.id) \
-                .filter_by(timeOut=None) \
-                .filter_by(sid=card.sid) \
-                .one_or_none()
+            resp, to, checked_in, checked_out = decide_tap(db, card, location, data['hwid'])
+            emit('go', {'to': to, 'hwid': data['hwid']})
 
-            # user is banned
-            if card.user.type.level < 0:
-                resp = ("User %s (card id %d) tried to sign in at %s but is banned! (id %d, kiosk %d)" % (
-                    card.user.name, data['card'], location.name, location.id, data['hwid']
-                ))
-                emit('go', {'to': url_for('.banned'), 'hwid': data['hwid']})
-
-            # user signing out
-            elif lastIn:
-                resp = ("User %s (card id %d) signed out at location %s (id %d, kiosk %d)" % (
-                    card.user.name, data['card'], location.name, location.id, data['hwid']
-                ))
-                # sign user out and send to confirmation page
-                lastIn.timeOut = sa.func.now()
-                emit('go', {'to': url_for('.success', action='checkout', name=card.user.name), 'hwid': data['hwid']})
-                update_kiosks(location.id, except_hwid=data['hwid'])
-
-            # user signing in
-            elif card.user.waiverSigned:
-                general_machine = db.query(Machine) \
-                    .filter(Machine.name.ilike('General Safety Training')) \
-                    .filter_by(location_id=location.id) \
-                    .one_or_none()
-
-                general_training = None
-                if general_machine:
-                    general_training = db.query(Training) \
-                        .filter_by(machine_id=general_machine.id) \
-                        .filter_by(trainee_id=card.sid) \
-                        .count()
-
-                resp = ("User %s (card id %d) is cleared for entry at location %s (id %d, kiosk %d)" % (
-                    card.user.name, data['card'], location.name, location.id, data['hwid']
-                ))
-                # sign user in and send to confirmation page
-                accessEntry = Access(sid=card.sid, timeIn=sa.func.now(), location_id=location.id)
-                db.add(accessEntry)
-
-                # if user has training or there is no training required, let 'em in
-                if not general_machine or general_training > 0:
-                    emit('go', {'to': url_for('.success', action='checkin', name=card.user.name), 'hwid': data['hwid']})
-
-                else:
-                    emit('go', {'to': url_for('.needs_training', name=card.user.name), 'hwid': data['hwid']})
-
-                update_kiosks(location.id, except_hwid=data['hwid'])
-
-            # user needs to sign waiver
-            else:
-                resp = ("User %s (card id %d) needs to sign waiver at location %s (id %d, kiosk %d)" % (
-                    card.user.name, data['card'],
-                    location.name, location.id, data['hwid']
-                ))
-                # present waiver page
-                emit('go', {'to': url_for('.waiver', sid=card.sid), 'hwid': data['hwid']})
-
-        logEntry = CardScan(card_id=data['card'], time=sa.func.now(), location_id=data['location'])
-        db.add(logEntry)
+        decided = time.perf_counter()
+        checkin_phase_seconds.observe(decided - resolved, 'decision')
 
+        record_tap(db, location.id, checked_in, checked_out)
         db.commit()
+        scan_log.add(card_id=data['card'], location_id=data['location'])
+        tap_committed(db, location.id, data['hwid'], checked_in, checked_out)
+        checkin_phase_seconds.observe(time.perf_counter() - decided, 'commit')
         print(resp)
         return resp
     except Exception as e:
-        app.logger.error(e, exc_info=True)
-        emit('go', {'to': url_for('.display_error'), 'hwid': data['hwid']})
+        current_app.logger.error(e, exc_info=True)
+        emit('go', {'to': url_for('checkin.display_error'), 'hwid': data['hwid']})
         return 'Internal error.'
 
 
+def create_app(config=None, background_tasks=True):
+    # builds the app from config.cfg, FLASKR_SETTINGS and then the config dict, and sets up the
+    # database, caches and background workers it needs. Each worker process calls this once.
+    global hasher, engine, scan_log, occupancy, tap_filter, coordinator, replica
+    app = Flask(__name__, static_url_path='/static', static_folder='static')
+    app.config.from_object(__name__)
+    app.config.from_pyfile('config.cfg', silent=config is not None)
+    app.config.from_envvar('FLASKR_SETTINGS', silent=True)
+    app.config.update(config or dict())
+    app.config['BOOTSTRAP_SERVE_LOCAL'] = True
+
+    Bootstrap(app)
+    app.register_blueprint(views)
+    app.teardown_appcontext(close_db)
+    # with a message queue (e.g. redis://localhost:6379/0), an emit from any worker reaches kiosks
+    # connected to any other
+    socketio.init_app(app, manage_session=True, message_queue=app.config.get('SOCKETIO_MESSAGE_QUEUE'))
+
+    hasher = Hasher(socketio.async_mode,
+                    rounds=app.config.get('PBKDF2_ROUNDS', LEGACY_ROUNDS),
+                    cache_ttl=app.config.get('PIN_CACHE_TTL', 300))
+
+    engine = sa.create_engine(app.config['DB'], pool_recycle=3600, encoding='utf-8')
+    db_session.configure(bind=engine)
+    query_stats.instrument(engine, sa)
+    metrics.time_checkouts(engine.pool, pool_checkout_seconds)
+
+    scan_log = ScanLogBuffer(engine, CardScan.__table__,
+                             batch_size=app.config.get('SCANLOG_BATCH_SIZE', 100),
+                             interval=app.config.get('SCANLOG_FLUSH_INTERVAL', 5),
+                             spool=app.config.get('SCANLOG_SPOOL'),
+                             start_task=socketio.start_background_task,
+                             sleep=socketio.sleep,
+                             logger=app.logger)
+    atexit.register(scan_log.flush)
+
+    # with several workers, use a redis:// OCCUPANCY_CACHE so they share one roster, and set
+    # TRAINING_MATRIX_MAX_AGE so trainings recorded by one worker reach the others
+    occupancy = OccupancyCache(make_backend(app.config.get('OCCUPANCY_CACHE')), load_occupants)
+    training_matrix.max_age = app.config.get('TRAINING_MATRIX_MAX_AGE')
+    training_matrix.invalidate()
+    # a redis:// OCCUPANCY_CACHE also holds card debouncing and reader sequence numbers, pending university
+    # lookups and the lease electing the worker that runs background work (see coordination.py)
+    tap_filter = ingest.make_tap_filter(app.config.get('OCCUPANCY_CACHE'),
+                                        window=app.config.get('CARD_DEBOUNCE_SECONDS', 2))
+    coordinator = make_coordinator(app.config.get('OCCUPANCY_CACHE'),
+                                   lease=app.config.get('LEADER_LEASE_SECONDS', 15))
+
+    replica = None
+    if app.config.get('CENTRAL_DB'):
+        replica = Replica(engine, sa.create_engine(app.config['CENTRAL_DB'], pool_recycle=3600, encoding='utf-8'),
+                          Base.metadata, app.config['REPLICA_LOCATION'], logger=app.logger)
+
+    if background_tasks:
+        start_background_tasks(app)
+    return app
+
+
+def start_background_tasks(app):
+    # every worker starts these; the loops only do anything on the elected leader
+    if coordinator.shared:
+        socketio.start_background_task(leadership_loop, app)
+        socketio.start_background_task(announcer_forward_loop, app)
+        atexit.register(coordinator.resign)
+    if replica:
+        socketio.start_background_task(replica_sync_loop, app)
+    socketio.start_background_task(auto_checkout_loop, app)
+
+
+def leadership_loop(app):
+    while True:
+        try:
+            coordinator.elect()
+        except Exception as e:
+            app.logger.error('Leader election failed: %s' % e)
+        socketio.sleep(coordinator.lease / 3.0)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Idea Shop Check In App')
     # parser.add_argument('-p', '--port', help='set the port to bind on', type=int)
     parser.add_argument('-a', '--admin', help='invoke admin tools instead of starting the web app', action='store_true')
     parser.add_argument('-l', '--location', help='choose the location to operate on', type=int)
     parser.add_argument('-s', '--secret', help='set a location\'s secret', type=str)
+    parser.add_argument('-m', '--migrate', help='create or upgrade the database schema and exit', action='store_true')
+    parser.add_argument('--rebuild-rollups', help='recompute usage reports for --location from the access table',
+                        action='store_true')
+    parser.add_argument('--export', help='export --location\'s access or scan log', choices=['access', 'scans'])
+    parser.add_argument('--format', help='export format', choices=sorted(export.formats), default='csv')
+    parser.add_argument('--start', help='export rows from this day on (YYYY-MM-DD)', type=str)
+    parser.add_argument('--end', help='export rows up to and including this day (YYYY-MM-DD)', type=str)
+    parser.add_argument('--sid', help='only export rows for this student ID', type=int)
+    parser.add_argument('--include-archive', help='also export archived rows', action='store_true')
+    parser.add_argument('-o', '--output', help='file to export to instead of stdout', type=str)
+    parser.add_argument('--archive', help='move visits and scans older than ARCHIVE_AFTER_DAYS to the archive '
+                                          'tables and exit', action='store_true')
+    parser.add_argument('--auto-checkout', help='close stale visits at every location and exit', action='store_true')
+    parser.add_argument('--sync', help='reconcile this kiosk\'s replica with CENTRAL_DB and exit', action='store_true')
+    parser.add_argument('--import-roster', help='create or update --location\'s users and cards from a CSV roster',
+                        type=str)
     args = parser.parse_args()
+    app = create_app(background_tasks=False)
 
-    if args.admin:
-        _db = db_session()
-        location = _db.query(Location).filter_by(id=args.location).one_or_none()
-        if not location:
-            print('Location %d does not exist!' % args.location)
-            exit(404)
+    with app.app_context():
+        if args.migrate:
+            version = migrations.migrate(engine, Base.metadata)
+            print('Database is at schema version %d.' % version)
+            exit(0)
 
-        if args.secret:
-            location.set_secret(args.secret)
-            _db.commit()
-            print('Secret for %s (%d) updated.' % (location.name, location.id))
+        if args.archive:
+            print('Archived %d visits and %d scans.' % archive_old_rows())
             exit(0)
-        else:
-            print('Location %d: %s' % (location.name, location.id))
+
+        if args.auto_checkout:
+            print('Auto-closed %d visits.' % auto_checkout_all())
             exit(0)
 
+        if args.sync:
+            if not replica:
+                print('CENTRAL_DB is not set, there is nothing to sync with.')
+                exit(1)
+            migrations.migrate(engine, Base.metadata)
+            exit(0 if sync_replica() else 1)
+
+        if args.admin:
+            _db = db_session()
+            location = _db.query(Location).filter_by(id=args.location).one_or_none()
+            if not location:
+                print('Location %d does not exist!' % args.location)
+                exit(404)
+
+            if args.import_roster:
+                with open(args.import_roster, newline='', encoding='utf-8-sig') as f:
+                    counts, bad_lines = import_roster(_db, location.id, f)
+                print('Users: %d inserted, %d updated, %d skipped. Cards: %d inserted, %d updated.' % (
+                    counts['inserted'], counts['updated'], counts['skipped'],
+                    counts['cards_inserted'], counts['cards_updated']))
+                if bad_lines:
+                    print('Unusable rows on lines: %s' % ', '.join(str(line) for line in bad_lines))
+                exit(0)
+            elif args.export:
+                columns, rows = export_rows(args.export, location.id, *export_range(args.start, args.end), sid=args.sid,
+                                            archived=args.include_archive)
+                out = open(args.output, 'w', newline='') if args.output else sys.stdout
+                for chunk in export.chunks(args.format, columns, rows):
+                    out.write(chunk)
+                out.flush()
+                exit(0)
+            elif args.rebuild_rollups:
+                rebuild_rollups(location.id)
+                print('Usage rollups for %s (%d) rebuilt.' % (location.name, location.id))
+                exit(0)
+            elif args.secret:
+                location.set_secret(args.secret)
+                _db.commit()
+                print('Secret for %s (%d) updated.' % (location.name, location.id))
+                exit(0)
+            else:
+                print('Location %d: %s' % (location.name, location.id))
+                exit(0)
+
+        # the development server is a single process, so it's safe to migrate on startup here
+        migrations.migrate(engine, Base.metadata)
+
+        # build every location's roster up front instead of on the first page load
+        for (location_id,) in db_session().query(Location.id):
+            occupancy.rebuild(location_id)
+            training_matrix.rebuild(location_id)
+        db_session.remove()
+
+    start_background_tasks(app)
     app.jinja_env.auto_reload = True
     app.config['TEMPLATES_AUTO_RELOAD'] = True
     socketio.run(app, host='0.0.0.0')
@@ -0,0 +1,162 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+# State the worker processes serving the app have to agree on, and which of them runs the background
+# work. With one process (MemoryCoordinator) it's all kept here and the process always leads. With
+# several (RedisCoordinator), keys live in Redis and the workers elect a leader through a lease that
+# every worker calls elect() for every lease / 3 seconds: a free lease is taken, and the holder renews
+# it. If the leader dies its lease runs out and another worker takes over within `lease` seconds. The
+# leader runs the replica sync and automatic check-out loops and owns the announcer clients; the other
+# workers send() it announcer commands, which it receive()s.
+#
+# Keys are claimed, or given a JSON value, for `ttl` seconds; pop() takes a value and removes it. A list
+# key is appended to one value at a time, so two workers appending at once both get in, and expires `ttl`
+# seconds after the last append.
+class MemoryCoordinator:
+    shared = False
+
+    def __init__(self):
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def elect(self):
+        return True
+
+    def leader(self):
+        return True
+
+    def resign(self):
+        pass
+
+    def _set(self, key, value, ttl, only_new=False):
+        now = time.monotonic()
+        with self.lock:
+            held = self.values.get(key)
+            if only_new and held and held[0] > now:
+                return False
+            self.values[key] = (now + ttl, value)
+            if len(self.values) > 10000:
+                self.values = dict((k, v) for k, v in self.values.items() if v[0] > now)
+            return True
+
+    def claim(self, key, ttl):
+        # True if nobody held key, which is now held for ttl seconds or until it's released
+        return self._set(key, True, ttl, only_new=True)
+
+    def put(self, key, value, ttl):
+        self._set(key, value, ttl)
+
+    def get(self, key):
+        with self.lock:
+            held = self.values.get(key)
+            return held[1] if held and held[0] > time.monotonic() else None
+
+    def pop(self, key):
+        with self.lock:
+            held = self.values.pop(key, None)
+            return held[1] if held and held[0] > time.monotonic() else None
+
+    def release(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def append(self, key, value, ttl):
+        now = time.monotonic()
+        with self.lock:
+            held = self.values.get(key)
+            values = held[1] if held and held[0] > now else list()
+            values.append(value)
+            self.values[key] = (now + ttl, values)
+
+    def get_list(self, key):
+        return list(self.get(key) or list())
+
+
+class RedisCoordinator:
+    shared = True
+
+    # renews or gives up the lease only if this worker still holds it
+    RENEW = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end " \
+            "return 0"
+    RESIGN = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url, lease=15, prefix='checkin:'):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.lease = lease
+        self.prefix = prefix
+        self.id = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.leading = False
+        self.renew = self.redis.register_script(self.RENEW)
+        self.give_up = self.redis.register_script(self.RESIGN)
+
+    def elect(self):
+        key = self.prefix + 'leader'
+        ms = int(self.lease * 1000)
+        try:
+            self.leading = bool(self.redis.set(key, self.id, nx=True, px=ms) or
+                                self.renew(keys=[key], args=[self.id, ms]))
+        except Exception:
+            # without Redis there's no telling whether another worker has taken over
+            self.leading = False
+            raise
+        return self.leading
+
+    def leader(self):
+        return self.leading
+
+    def resign(self):
+        # lets another worker take over straight away rather than when the lease runs out
+        if self.leading:
+            self.leading = False
+            self.give_up(keys=[self.prefix + 'leader'], args=[self.id])
+
+    def claim(self, key, ttl):
+        return bool(self.redis.set(self.prefix + key, 1, nx=True, px=max(1, int(ttl * 1000))))
+
+    def put(self, key, value, ttl):
+        self.redis.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        return json.loads(value.decode('utf-8')) if value is not None else None
+
+    def pop(self, key):
+        pipe = self.redis.pipeline()
+        pipe.get(self.prefix + key)
+        pipe.delete(self.prefix + key)
+        value, _ = pipe.execute()
+        return json.loads(value.decode('utf-8')) if value is not None else None
+
+    def release(self, key):
+        self.redis.delete(self.prefix + key)
+
+    def append(self, key, value, ttl):
+        pipe = self.redis.pipeline()
+        pipe.rpush(self.prefix + key, json.dumps(value))
+        pipe.pexpire(self.prefix + key, max(1, int(ttl * 1000)))
+        pipe.execute()
+
+    def get_list(self, key):
+        return [json.loads(value.decode('utf-8')) for value in self.redis.lrange(self.prefix + key, 0, -1)]
+
+    def send(self, message):
+        self.redis.rpush(self.prefix + 'announcer', json.dumps(message))
+
+    def receive(self, timeout=1):
+        # the next message sent to the leader, or None after timeout seconds
+        item = self.redis.blpop([self.prefix + 'announcer'], timeout=max(1, int(timeout)))
+        return json.loads(item[1].decode('utf-8')) if item else None
+
+
+def make_coordinator(url=None, lease=15):
+    if not url or url == 'memory':
+        return MemoryCoordinator()
+    if url.startswith('redis://') or url.startswith('rediss://') or url.startswith('unix://'):
+        return RedisCoordinator(url, lease)
+    raise ValueError('Unsupported coordination backend: %s' % url)
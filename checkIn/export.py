@@ -0,0 +1,51 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+
+# Streaming writers for access and scan log exports. Rows come from a query run with yield_per, and
+# output is produced in chunks of chunk_size rows, so memory use doesn't grow with the export.
+
+formats = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(columns, rows, chunk_size=500):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow([_value(v) for v in row])
+        count += 1
+        if count % chunk_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def ndjson_chunks(columns, rows, chunk_size=500):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, (_value(v) for v in row)))) + '\n')
+        if len(lines) == chunk_size:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+def chunks(fmt, columns, rows, chunk_size=500):
+    if fmt == 'csv':
+        return csv_chunks(columns, rows, chunk_size)
+    elif fmt == 'ndjson':
+        return ndjson_chunks(columns, rows, chunk_size)
+    raise ValueError('Unknown export format: %s' % fmt)
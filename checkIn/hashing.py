@@ -0,0 +1,51 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# rounds used by hashes stored before the round count was saved alongside them
+LEGACY_ROUNDS = 100000
+
+
+# PBKDF2 for location secrets and admin PINs. The hashing itself runs on a real OS thread so an
+# eventlet/gevent server keeps serving other kiosks while it works, and successful verifications
+# are remembered for cache_ttl seconds so an admin moving around the admin pages isn't re-hashed.
+class Hasher:
+    def __init__(self, async_mode='threading', rounds=LEGACY_ROUNDS, cache_ttl=300):
+        self.async_mode = async_mode
+        self.rounds = rounds
+        self.cache_ttl = cache_ttl
+        self.cache_key = os.urandom(32)
+        self.verified = dict()
+        self.lock = threading.Lock()
+
+    def _offload(self, func, *args):
+        if self.async_mode == 'eventlet':
+            from eventlet import tpool
+            return tpool.execute(func, *args)
+        elif self.async_mode == 'gevent':
+            import gevent
+            return gevent.get_hub().threadpool.apply(func, args)
+        # threading mode already gives every request its own thread, and pbkdf2_hmac releases the GIL
+        return func(*args)
+
+    def hash(self, secret, salt, rounds):
+        return self._offload(hashlib.pbkdf2_hmac, 'sha256', bytearray(secret, 'utf-8'), salt, rounds)
+
+    def verify(self, attempt, digest, salt, rounds):
+        key = (bytes(salt), bytes(digest))
+        fingerprint = hmac.new(self.cache_key, bytearray(attempt, 'utf-8'), hashlib.sha256).digest()
+        now = time.monotonic()
+        with self.lock:
+            cached = self.verified.get(key)
+            if cached and cached[1] > now and hmac.compare_digest(cached[0], fingerprint):
+                return True
+
+        if not hmac.compare_digest(digest, self.hash(attempt, salt, rounds)):
+            return False
+        with self.lock:
+            self.verified[key] = (fingerprint, now + self.cache_ttl)
+            for stale in [k for k, v in self.verified.items() if v[1] <= now]:
+                del self.verified[stale]
+        return True
@@ -1,29 +1,95 @@
 from pysimplesoap.client import SoapClient,SoapFault
+from pysimplesoap.helpers import fetch
+from collections import OrderedDict
 import base64
+import hashlib
+import os
+import pathlib
+import stat
+import threading
+import time
+
+# where wsdl_cache=True keeps the WSDL: a directory of the app's own, made readable by its user only
+WSDL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+def _private(path):
+        # True if path is a regular file or directory owned by this user that nobody else can write to
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        return (stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode)) and st.st_uid == os.getuid() and \
+            not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+class WSDLCacheClient(SoapClient):
+        # SoapClient that keeps a copy of the WSDL document (not the ones it imports) in the directory
+        # `cache` (WSDL_CACHE_DIR if it's True) and parses that rather than downloading it again.
+        # pysimplesoap's own cache pickles the parsed WSDL, which fails on Python 3 and would run whatever
+        # a planted pickle held; this one stores the XML and only reads a copy that this user owns and
+        # nobody else can write, since it decides where the lookups (and their credentials) are sent.
+        # Delete the file to refetch it.
+
+        def wsdl_parse(self, url, cache=False):
+                self.wsdl_cache = WSDL_CACHE_DIR if cache is True else cache
+                return SoapClient.wsdl_parse(self, url)
+
+        def _url_to_xml_tree(self, url, cache, force_download):
+                try:
+                    if not self.wsdl_cache:
+                            raise OSError('no WSDL cache')
+                    os.makedirs(self.wsdl_cache, mode=0o700, exist_ok=True)
+                    if not _private(self.wsdl_cache):
+                            raise OSError('%s can be written by other users' % self.wsdl_cache)
+                except OSError:
+                    return SoapClient._url_to_xml_tree(self, url, False, False)
+                name = 'iitlookup-%s.wsdl' % hashlib.md5(url.encode('utf-8')).hexdigest()
+                path = os.path.join(self.wsdl_cache, name)
+                if not _private(path):
+                        xml = fetch(url, self.http, False, False, self.wsdl_basedir, self.http_headers)
+                        try:
+                            fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+                            with os.fdopen(fd, 'wb') as f:
+                                f.write(xml if isinstance(xml, bytes) else xml.encode('utf-8'))
+                            os.replace(path + '.tmp', path)
+                        except OSError:
+                            # rare enough to just parse the service's copy instead
+                            return SoapClient._url_to_xml_tree(self, url, False, False)
+                return SoapClient._url_to_xml_tree(self, pathlib.Path(path).as_uri(), False, False)
+
 class IITLookup:
+        # The public lookups answer None both for "not found" and for a SoapFault from the service; the
+        # underscored ones let faults through so CachedIITLookup can tell the two apart.
 
-        def __init__(self, wsurl, user=None, pwd=None, idlength=6):
+        # wsdl_cache is a directory to keep the WSDL in (True for WSDL_CACHE_DIR), so later clients skip
+        # the download
+        def __init__(self, wsurl, user=None, pwd=None, idlength=6, wsdl_cache=True):
                 self.idlength=idlength
                 if(user or pwd):
                     bts = ('%s:%s' % (user, pwd)).encode('ascii')
                     auth = base64.b64encode(bts).replace(b'\n', b'')
                     head = {'Authorization': "Basic %s" % auth.decode('ascii')}
-                    self.sclient=SoapClient(wsdl=wsurl, sessions=True, http_headers=head)
+                    self.sclient=WSDLCacheClient(wsdl=wsurl, sessions=True, http_headers=head, cache=wsdl_cache)
                 else:
-                    self.sclient=SoapClient(wsdl=wsurl)
+                    self.sclient=WSDLCacheClient(wsdl=wsurl, cache=wsdl_cache)
 
         def nameByID(self,idnumber):
                 try:
-                    return self.sclient.PCSGetName(idNumber=idnumber)['PCSGetNameResult']
+                    return self._nameByID(idnumber)
                 except SoapFault:
                     return None
 
+        def _nameByID(self,idnumber):
+                return self.sclient.PCSGetName(idNumber=idnumber)['PCSGetNameResult']
+
         def nameIDByCard(self,cardnum):
-                lookupstr = str(cardnum).zfill(self.idlength)
                 try:
-                    ret = self.sclient.PCSGetbyCardNum(cardNumber=lookupstr)['PCSGetbyCardNumResult']
+                    return self._nameIDByCard(cardnum)
                 except SoapFault:
                     return None
+
+        def _nameIDByCard(self,cardnum):
+                lookupstr = str(cardnum).zfill(self.idlength)
+                ret = self.sclient.PCSGetbyCardNum(cardNumber=lookupstr)['PCSGetbyCardNumResult']
                 if(ret == 'Not Found'):
                     return None
                 ret = ret.split(',')
@@ -36,9 +102,12 @@ class IITLookup:
 
         def inquiryByID(self,idnumber):
                 try:
-                    ret = self.sclient.PCSGetInquiry(idNumber=idnumber)['PCSGetInquiryResult']
+                    return self._inquiryByID(idnumber)
                 except SoapFault:
                     return None
+
+        def _inquiryByID(self,idnumber):
+                ret = self.sclient.PCSGetInquiry(idNumber=idnumber)['PCSGetInquiryResult']
                 output = {}
                 for x in ret:
                     x = x['InquiryRecord']
@@ -55,3 +124,67 @@ class IITLookup:
                         return None
                 return self.inquiryByID(idn['idnumber'])
 
+class CachedIITLookup(IITLookup):
+        # IITLookup with an LRU cache in front of the SOAP calls. Answers are kept for `ttl` seconds,
+        # "not found" answers for `negative_ttl`; SOAP faults and other errors talking to the service
+        # are never cached.
+        # If given, timer(call name) returns a context manager wrapped around each SOAP call.
+
+        def __init__(self, wsurl, user=None, pwd=None, idlength=6, wsdl_cache=True,
+                     size=1024, ttl=3600, negative_ttl=300, timer=None):
+                IITLookup.__init__(self, wsurl, user, pwd, idlength, wsdl_cache)
+                self.size = size
+                self.ttl = ttl
+                self.negative_ttl = negative_ttl
+                self.entries = OrderedDict()
+                self.lock = threading.Lock()
+                self.hits = 0
+                self.misses = 0
+                self.timer = timer
+
+        def _cached(self, key, lookup, *args):
+                now = time.monotonic()
+                with self.lock:
+                    entry = self.entries.get(key)
+                    if entry and entry[0] > now:
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        return entry[1]
+                    self.misses += 1
+                try:
+                    if self.timer:
+                            with self.timer(lookup.__name__.lstrip('_')):
+                                    value = lookup(self, *args)
+                    else:
+                            value = lookup(self, *args)
+                except SoapFault:
+                    return None
+                with self.lock:
+                    self.entries[key] = (now + (self.ttl if value else self.negative_ttl), value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
+                return value
+
+        def cachedNameIDByCard(self,cardnum):
+                # nameIDByCard's answer if it's cached, without asking the service
+                with self.lock:
+                    entry = self.entries.get(('card', str(cardnum)))
+                    return entry[1] if entry and entry[0] > time.monotonic() else None
+
+        def nameByID(self,idnumber):
+                return self._cached(('name', str(idnumber)), IITLookup._nameByID, idnumber)
+
+        def nameIDByCard(self,cardnum):
+                return self._cached(('card', str(cardnum)), IITLookup._nameIDByCard, cardnum)
+
+        def inquiryByID(self,idnumber):
+                return self._cached(('inquiry', str(idnumber)), IITLookup._inquiryByID, idnumber)
+
+        def stats(self):
+                with self.lock:
+                    return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+        def clear(self):
+                with self.lock:
+                    self.entries.clear()
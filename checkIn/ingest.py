@@ -0,0 +1,80 @@
+import threading
+import time
+
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+DEBOUNCED = 'debounced'
+
+
+# Filters raw card reads before they become taps. Reads carrying a reader sequence number and boot id are
+# only accepted once per (reader, boot, sequence), so a batch that is retried after a lost response isn't
+# processed twice; without a boot id there's no telling a retry from a reader that restarted its count,
+# so the sequence number is ignored. Reads of the same card on the same reader less than `window` seconds after the
+# previous read are dropped, so a jittery reader or a card held against it makes one tap, not a
+# check-in followed by a check-out. Its state is per process; RedisTapFilter (below) shares it.
+class TapFilter:
+    def __init__(self, window=2.0):
+        self.window = window
+        self.last_seq = dict()
+        self.last_read = dict()
+        self.lock = threading.Lock()
+
+    def check(self, hwid, card, seq=None, boot=None, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if seq is not None and boot is not None:
+                key = (hwid, boot)
+                if seq <= self.last_seq.get(key, -1):
+                    return DUPLICATE
+                self.last_seq[key] = seq
+
+            key = (hwid, card)
+            last = self.last_read.get(key)
+            # every read pushes the window out, so a card held on the reader never repeats
+            self.last_read[key] = now
+            if last is not None and now - last < self.window:
+                return DEBOUNCED
+
+            if len(self.last_read) > 10000:
+                self.last_read = dict((k, t) for k, t in self.last_read.items() if now - t < self.window)
+            return ACCEPTED
+
+
+# TapFilter with its state in Redis, so a reader whose posts are spread over several worker processes is
+# filtered as if one process took them all. A script compares and stores each reader boot's sequence
+# number in one step, so two workers can't both accept the same read; boots unheard of for `boot_ttl`
+# seconds are forgotten. Every read sets its (reader, card) key to expire `window` seconds later, so the
+# key exists exactly when the previous read was less than `window` ago.
+class RedisTapFilter:
+    SEQUENCE = "local last = redis.call('get', KEYS[1]) " \
+               "if last and tonumber(ARGV[1]) <= tonumber(last) then return 0 end " \
+               "redis.call('set', KEYS[1], ARGV[1], 'ex', ARGV[2]) return 1"
+
+    def __init__(self, url, window=2.0, prefix='checkin:reads:', boot_ttl=7 * 86400):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.window = window
+        self.prefix = prefix
+        self.boot_ttl = boot_ttl
+        self.accept_sequence = self.redis.register_script(self.SEQUENCE)
+
+    def check(self, hwid, card, seq=None, boot=None, now=None):
+        # now is only there for TapFilter's signature; Redis keeps the time
+        if seq is not None and boot is not None:
+            if not self.accept_sequence(keys=['%sseq:%s:%s' % (self.prefix, hwid, boot)], args=[seq, self.boot_ttl]):
+                return DUPLICATE
+
+        key = '%scard:%s:%s' % (self.prefix, hwid, card)
+        pipe = self.redis.pipeline()
+        pipe.exists(key)
+        pipe.set(key, 1, px=max(1, int(self.window * 1000)))
+        seen, _ = pipe.execute()
+        return DEBOUNCED if seen else ACCEPTED
+
+
+def make_tap_filter(url=None, window=2.0):
+    if not url or url == 'memory':
+        return TapFilter(window)
+    if url.startswith('redis://') or url.startswith('rediss://') or url.startswith('unix://'):
+        return RedisTapFilter(url, window)
+    raise ValueError('Unsupported tap filter backend: %s' % url)
@@ -0,0 +1,834 @@
+import os
+import math
+import sys
+import random
+import argparse
+import contextlib
+import subprocess
+import threading
+import time
+from datetime import date, datetime, timedelta
+from urllib.parse import urlsplit
+
+# Load generator for sizing a server before each semester. Three steps, usually in three terminals:
+#
+#   python loadtest.py seed --db sqlite:////tmp/load.db --users 2000
+#   python loadtest.py serve --db sqlite:////tmp/load.db
+#   python loadtest.py run --url http://localhost:5000 --kiosks 8 --taps-per-minute 240 --duration 300
+#
+# seed fills a database with one location of returning, waiver-pending and banned users, serve runs
+# the app against it with the university lookup and the announcer stubbed out, and run authenticates
+# simulated kiosks through /auth, holds a Socket.IO connection for each, taps cards through
+# /card_read and answers each scan with a `check in` event the way the kiosk page does. It reports
+# tap-to-go latency percentiles and the error rate. run needs `requests` and `python-socketio`.
+#
+# To measure several workers, start them on consecutive ports sharing a message queue and give run
+# every URL; each kiosk's card reader then posts to a different worker than its page is connected to:
+#
+#   python loadtest.py serve --db mysql+pymysql://... --workers 4 --message-queue redis://localhost:6379/0
+#   python loadtest.py run --url http://localhost:5000,http://localhost:5001,http://localhost:5002,...
+#
+# The bench-* commands time one part of the app in isolation against a scratch database, e.g.
+#
+#   python loadtest.py bench-reports --db sqlite:////tmp/reports.db --visits 200000 --days 730
+#   python loadtest.py bench-lookup --db sqlite:////tmp/lookup.db --lookup-latency 1
+#   python loadtest.py bench-fanout --db sqlite:////tmp/fanout.db --kiosks 25,100,400
+#   python loadtest.py bench-hashing --db sqlite:////tmp/hashing.db --rounds 100000
+#   python loadtest.py bench-indexes --db sqlite:////tmp/indexes.db --visits 200000 --scans 1000000
+#   python loadtest.py bench-heartbeats --db sqlite:////tmp/heartbeats.db --kiosks 4 --hours 12
+
+# cards are numbered by kind, so run can pick them without reading the database: seeded users have
+# cards from RETURNING_CARDS on, one in BANNED_EVERY of them is banned and one in WAIVER_PENDING_EVERY
+# hasn't signed the waiver; cards from NEW_CARDS on have never been seen
+RETURNING_CARDS = 1000000
+NEW_CARDS = 9000000
+BANNED_EVERY = 50
+WAIVER_PENDING_EVERY = 10
+FIRST_SID = 20000000
+# PBKDF2 rounds of hashes stored before the round count was (hashing.LEGACY_ROUNDS)
+LEGACY_ROUNDS = 100000
+
+
+def use_database(url, **config):
+    # builds the app against url (and any other config overrides); returns the checkIn module and the app
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import checkIn
+    config.update(DB=url, CENTRAL_DB=None)
+    return checkIn, checkIn.create_app(config, background_tasks=False)
+
+
+def seed(args):
+    app, _ = use_database(args.db)
+    app.migrations.migrate(app.engine, app.Base.metadata)
+    db = app.db_session()
+
+    location = app.Location(name=args.name)
+    location.set_secret(args.secret)
+    db.add(location)
+    db.flush()
+    users = app.Type(level=0, name='Users', location_id=location.id)
+    banned = app.Type(level=-1, name='Banned', location_id=location.id)
+    general = app.Machine(name='General Safety Training', location_id=location.id)
+    db.add_all([users, banned, general])
+    db.flush()
+
+    now = datetime.now()
+    rows, cards, trainings = list(), list(), list()
+    for i in range(args.users):
+        sid = FIRST_SID + i
+        rows.append({'sid': sid, 'name': 'Load Test %d' % i, 'location_id': location.id,
+                     'type_id': banned.id if i % BANNED_EVERY == 0 else users.id,
+                     'waiverSigned': None if i % WAIVER_PENDING_EVERY == 1 else now})
+        cards.append({'card': RETURNING_CARDS + i, 'sid': sid, 'location_id': location.id})
+        trainings.append({'trainee_id': sid, 'trainer_id': FIRST_SID, 'machine_id': general.id, 'date': now})
+    db.bulk_insert_mappings(app.User, rows)
+    db.bulk_insert_mappings(app.HawkCard, cards)
+    db.bulk_insert_mappings(app.Training, trainings)
+    db.commit()
+    print('Seeded location %d (%s) with %d users; its secret is %r.' % (location.id, location.name, args.users,
+                                                                        args.secret))
+
+
+class StubLookup:
+    # stands in for the university lookup: answers after `latency` seconds, and knows about one in
+    # `known_every` new cards
+    def __init__(self, latency, known_every=2):
+        self.latency = latency
+        self.known_every = known_every
+
+    def nameIDByCard(self, cardnum):
+        time.sleep(self.latency)
+        if int(cardnum) % self.known_every:
+            return None
+        return {'idnumber': 'A%d' % (FIRST_SID + int(cardnum) - NEW_CARDS), 'first_name': 'New',
+                'last_name': 'User %s' % cardnum}
+
+    def nameByID(self, idnumber):
+        time.sleep(self.latency)
+        return None
+
+    def inquiryByID(self, idnumber):
+        time.sleep(self.latency)
+        return None
+
+    def stats(self):
+        return dict()
+
+
+def monkey_patch():
+    # socketio.run() serves with eventlet or gevent when either is installed, and the app needs the
+    # standard library patched under them (see the README)
+    try:
+        import eventlet
+        eventlet.monkey_patch()
+    except ImportError:
+        try:
+            from gevent import monkey
+            monkey.patch_all()
+        except ImportError:
+            pass
+
+
+def serve(args):
+    if args.workers > 1:
+        serve_workers(args)
+        return
+    monkey_patch()
+    # every worker signs sessions with the same key, so a kiosk's session is good on all of them
+    config = {'OCCUPANCY_CACHE': args.occupancy_cache or args.message_queue or 'memory',
+              'SOCKETIO_MESSAGE_QUEUE': args.message_queue, 'SECRET_KEY': 'loadtest'}
+    app, flask_app = use_database(args.db, **config)
+    app.iit_client = StubLookup(args.lookup_latency)
+    app.announcer_connect = lambda address, timeout: app.announcer.StandIn()
+    with flask_app.app_context():
+        if not args.skip_migrate:
+            app.migrations.migrate(app.engine, app.Base.metadata)
+        for (location_id,) in app.db_session().query(app.Location.id):
+            app.occupancy.rebuild(location_id)
+            app.training_matrix.rebuild(location_id)
+        app.db_session.remove()
+    app.socketio.run(flask_app, host=args.host, port=args.port)
+
+
+def serve_workers(args):
+    # one process per worker on consecutive ports; they only see each other's emits through the queue
+    if not args.message_queue:
+        exit('--workers needs --message-queue, or kiosks will miss taps handled by other workers')
+    app, _ = use_database(args.db)
+    app.migrations.migrate(app.engine, app.Base.metadata)
+    workers = list()
+    for i in range(args.workers):
+        workers.append(subprocess.Popen([
+            sys.executable, os.path.abspath(__file__), 'serve', '--db', args.db, '--host', args.host,
+            '--port', str(args.port + i), '--lookup-latency', str(args.lookup_latency),
+            '--message-queue', args.message_queue, '--occupancy-cache', args.occupancy_cache or args.message_queue,
+            '--skip-migrate']))
+    print('%d workers on ports %d-%d.' % (args.workers, args.port, args.port + args.workers - 1))
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    # nearest rank; values are sorted
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class SimulatedKiosk:
+    def __init__(self, url, location, secret, hwid, timeout, reader_url=None):
+        # the page connects to url; the card reader posts to reader_url, which may be another worker
+        import requests
+        import socketio
+
+        self.url = url.rstrip('/')
+        self.reader_url = (reader_url or url).rstrip('/')
+        self.hwid = hwid
+        self.timeout = timeout
+        self.location = location
+        self.http = requests.Session()
+        resp = self.http.post(self.url + '/auth', data={'location': location, 'hwid': hwid, 'secret': secret})
+        if resp.status_code != 200 or 'session' not in self.http.cookies:
+            raise RuntimeError('Kiosk %d could not authenticate: HTTP %d' % (hwid, resp.status_code))
+
+        self.arrived = threading.Event()
+        self.outcome = None
+        self.sio = socketio.Client(reconnection=True)
+        self.sio.on('scan', self.on_scan)
+        self.sio.on('go', self.on_go)
+        self.sio.connect(self.url, headers={'Cookie': '; '.join('%s=%s' % c for c in self.http.cookies.items())})
+
+    def on_scan(self, data):
+        if data.get('hwid') == self.hwid:
+            data['location'] = self.location
+            self.sio.emit('check in', data)
+
+    def on_go(self, data):
+        # a tap's own answer is never the home page, and an unknown card's first answer is the
+        # looking_up page; answers decided after a lookup carry absolute URLs
+        path = urlsplit(data.get('to', '')).path
+        if data.get('hwid') != self.hwid or path == '/' or path.startswith('/looking_up'):
+            return
+        self.outcome = path
+        self.arrived.set()
+
+    def tap(self, card):
+        # returns (seconds until the kiosk was sent on, error or None); None seconds if debounced
+        self.arrived.clear()
+        self.outcome = None
+        started = time.perf_counter()
+        resp = self.http.post('%s/card_read/%d' % (self.reader_url, self.hwid), data={'facility': 1, 'cardnum': card})
+        if resp.status_code != 200:
+            return None, 'card_read HTTP %d' % resp.status_code
+        if 'debounced' in resp.text:
+            return None, None
+        if not self.arrived.wait(self.timeout):
+            return None, 'no go within %ds' % self.timeout
+        elapsed = time.perf_counter() - started
+        if self.outcome.startswith('/error'):
+            return elapsed, 'error page'
+        return elapsed, None
+
+    def close(self):
+        self.sio.disconnect()
+
+
+def pick_card(args, rng):
+    if rng.random() < args.new_share:
+        return NEW_CARDS + rng.randrange(10 ** 6)
+    return RETURNING_CARDS + rng.randrange(args.users)
+
+
+def run(args):
+    urls = args.url.split(',')
+    kiosks = [SimulatedKiosk(urls[i % len(urls)], args.location, args.secret, args.first_hwid + i, args.timeout,
+                             reader_url=urls[(i + 1) % len(urls)])
+              for i in range(args.kiosks)]
+    print('%d kiosks connected.' % len(kiosks))
+
+    latencies, errors = list(), dict()
+    taps = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    # each kiosk taps as a Poisson process, so together they average taps_per_minute
+    mean_gap = 60.0 * args.kiosks / args.taps_per_minute
+
+    def drive(kiosk, seed):
+        rng = random.Random(seed)
+        while True:
+            time.sleep(rng.expovariate(1.0 / mean_gap))
+            if time.monotonic() >= deadline:
+                return
+            try:
+                elapsed, error = kiosk.tap(pick_card(args, rng))
+            except Exception as e:
+                elapsed, error = None, type(e).__name__
+            with lock:
+                taps[0] += 1
+                if elapsed is not None:
+                    latencies.append(elapsed)
+                if error:
+                    errors[error] = errors.get(error, 0) + 1
+
+    threads = [threading.Thread(target=drive, args=(kiosk, args.seed + i)) for i, kiosk in enumerate(kiosks)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for kiosk in kiosks:
+        kiosk.close()
+
+    latencies.sort()
+    failed = sum(errors.values())
+    print('%d taps in %ds (%.1f/min), %d errors (%.2f%%)' % (
+        taps[0], args.duration, taps[0] * 60.0 / args.duration, failed, 100.0 * failed / taps[0] if taps[0] else 0))
+    print('tap to go: p50 %.0f ms, p95 %.0f ms, p99 %.0f ms, max %.0f ms' % tuple(
+        1000 * v for v in (percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+                           latencies[-1] if latencies else float('nan'))))
+    for error, count in sorted(errors.items(), key=lambda e: -e[1]):
+        print('  %6d  %s' % (count, error))
+    exit(1 if failed else 0)
+
+
+def timed(repeat, fn, *args):
+    # (median seconds, last result) over repeat calls
+    times, result = list(), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return times[len(times) // 2], result
+
+
+def bench_reports(args):
+    # fills a location with synthetic visits, builds its rollups and times the reports page's query
+    # against computing the same report from the access table
+    app, flask_app = use_database(args.db)
+    with flask_app.app_context():
+        app.migrations.migrate(app.engine, app.Base.metadata)
+        db = app.db_session()
+        location = app.Location(name='Report Benchmark')
+        location.set_secret('benchmark')
+        db.add(location)
+        db.flush()
+        types = [app.Type(level=level, name=name, location_id=location.id)
+                 for level, name in ((0, 'Users'), (1, 'Staff'))]
+        db.add_all(types)
+        db.flush()
+        db.bulk_insert_mappings(app.User, [{'sid': FIRST_SID + i, 'name': 'Report User %d' % i,
+                                            'location_id': location.id, 'type_id': types[i % 10 == 0].id}
+                                           for i in range(args.users)])
+        db.commit()
+
+        rng = random.Random(args.seed)
+        first = datetime.combine(date.today() - timedelta(days=args.days), datetime.min.time())
+        batch = list()
+        for i in range(args.visits):
+            time_in = first + timedelta(days=rng.randrange(args.days), hours=rng.uniform(8, 20))
+            batch.append({'sid': FIRST_SID + rng.randrange(args.users), 'location_id': location.id,
+                          'timeIn': time_in.replace(microsecond=0),
+                          'timeOut': (time_in + timedelta(minutes=rng.uniform(10, 240))).replace(microsecond=0)})
+            if len(batch) == 10000 or i == args.visits - 1:
+                db.execute(app.Access.__table__.insert(), batch)
+                db.commit()
+                batch = list()
+        print('%d visits by %d users over %d days.' % (args.visits, args.users, args.days))
+
+        started = time.perf_counter()
+        app.rebuild_rollups(location.id)
+        print('Rollups built in %.1fs.' % (time.perf_counter() - started))
+
+        end = date.today()
+        for days in sorted(set((28, 365, args.days))):
+            start = end - timedelta(days=days - 1)
+            rollup_time, rollup = timed(args.repeat, app.usage_report, db, location.id, start, end, 'week')
+            raw_time, raw = timed(args.repeat, app.usage_report_raw, db, location.id, start, end, 'week')
+            print('%4d days: rollups %7.1f ms, raw %8.1f ms (%.0fx)%s' % (
+                days, 1000 * rollup_time, 1000 * raw_time, raw_time / rollup_time,
+                '' if rollup == raw else ', RESULTS DIFFER'))
+        app.db_session.remove()
+
+
+def bench_lookup(args):
+    # taps never seen cards on a kiosk page held by the Socket.IO test client, with the university lookup
+    # stubbed to take --lookup-latency seconds, and reports how long the page waits for its first screen
+    # and for the register page. Runs once with the lookup inline in the check in handler, as it used to
+    # be, and once in the background as the app does it.
+    app, flask_app = use_database(args.db, IITLOOKUP_DEADLINE=args.deadline, SECRET_KEY='benchmark')
+    app.iit_client = StubLookup(args.lookup_latency)
+    with flask_app.app_context():
+        app.migrations.migrate(app.engine, app.Base.metadata)
+        db = app.db_session()
+        location = app.Location(name='Lookup Benchmark')
+        location.set_secret('benchmark')
+        db.add(location)
+        db.flush()
+        db.add(app.Type(level=0, name='Users', location_id=location.id))
+        db.commit()
+        location_id = location.id
+        app.db_session.remove()
+
+    page = flask_app.test_client()
+    with page.session_transaction() as session:
+        session.update(location_id=location_id, hardware_id=1, token='benchmark')
+    kiosk = app.socketio.test_client(flask_app, flask_test_client=page)
+    start_background_task = app.socketio.start_background_task
+
+    def inline_lookups(target, *args, **kwargs):
+        # the lookup runs in the handler; the deadline still runs in the background, and finds it done
+        if target.__name__ == 'run_lookup':
+            return target(*args, **kwargs)
+        return start_background_task(target, *args, **kwargs)
+
+    print('Lookup stubbed to %.0f ms, %d taps each.' % (1000 * args.lookup_latency, args.taps))
+    card = NEW_CARDS + random.Random(args.seed).randrange(10 ** 6)
+    for mode, starter in (('inline', inline_lookups), ('background', start_background_task)):
+        app.socketio.start_background_task = starter
+        first, final = list(), list()
+        # the app prints every tap
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+            for _ in range(args.taps):
+                card += 1
+                kiosk.get_received()
+                started = time.perf_counter()
+                kiosk.emit('check in', {'card': card, 'facility': 1, 'location': location_id, 'hwid': 1})
+                first.append(time.perf_counter() - started)
+                while not any(event['name'] == 'go' and '/register' in event['args'][0]['to']
+                              for event in kiosk.get_received()):
+                    time.sleep(0.001)
+                final.append(time.perf_counter() - started)
+        first.sort()
+        final.sort()
+        print('%10s: first screen p50 %6.0f ms, p95 %6.0f ms; register page p50 %6.0f ms, p95 %6.0f ms' % (
+            mode, 1000 * percentile(first, 50), 1000 * percentile(first, 95),
+            1000 * percentile(final, 50), 1000 * percentile(final, 95)))
+    app.socketio.start_background_task = start_background_task
+    kiosk.disconnect()
+
+
+def bench_fanout(args):
+    # connects kiosk pages spread over --locations locations through the Socket.IO test client and times
+    # sending one kiosk a scan event, broadcast to every page as the app used to and to the kiosk's room,
+    # counting the messages delivered
+    app, flask_app = use_database(args.db, SECRET_KEY='benchmark')
+    with flask_app.app_context():
+        app.migrations.migrate(app.engine, app.Base.metadata)
+        db = app.db_session()
+        locations = [app.Location(name='Fan-out Benchmark %d' % i) for i in range(args.locations)]
+        for location in locations:
+            location.set_secret('benchmark')
+        db.add_all(locations)
+        db.commit()
+        location_ids = [location.id for location in locations]
+        app.db_session.remove()
+
+    pages = list()
+
+    def connect(hwid):
+        page = flask_app.test_client()
+        with page.session_transaction() as session:
+            session.update(location_id=location_ids[hwid % len(location_ids)], hardware_id=hwid, token='benchmark')
+        pages.append(app.socketio.test_client(flask_app, flask_test_client=page))
+
+    def delivered():
+        return sum(len(page.get_received()) for page in pages)
+
+    print('%d locations, median of %d scans each.' % (args.locations, args.repeat))
+    scan = {'facility': 1, 'card': RETURNING_CARDS, 'hwid': 0, 'sid': FIRST_SID, 'name': 'Fan-out'}
+    for kiosks in sorted(int(count) for count in args.kiosks.split(',')):
+        while len(pages) < kiosks:
+            connect(len(pages))
+        delivered()
+        results = list()
+        for mode, room in (('broadcast', None), ('room', app.kiosk_room(location_ids[0], 0))):
+            seconds, _ = timed(args.repeat, lambda: app.socketio.emit('scan', scan, room=room))
+            results.append((mode, seconds, delivered() / args.repeat))
+        print('%5d kiosks: %s' % (kiosks, ', '.join('%s %7.2f ms (%d sent)' % (mode, 1000 * seconds, messages)
+                                                   for mode, seconds, messages in results)))
+    for page in pages:
+        page.disconnect()
+
+
+def bench_hashing(args):
+    # taps cards on kiosk pages in eventlet green threads while an admin signs in over and over, and
+    # reports tap latency with PBKDF2 run on the event loop, as it used to be, and on eventlet's thread
+    # pool as the app does it. Needs eventlet.
+    try:
+        import eventlet
+    except ImportError:
+        exit('bench-hashing needs eventlet')
+    eventlet.monkey_patch()
+    app, flask_app = use_database(args.db, SECRET_KEY='benchmark', PBKDF2_ROUNDS=args.rounds, PIN_CACHE_TTL=0)
+    if app.socketio.async_mode != 'eventlet':
+        exit('Socket.IO is running in %s mode rather than eventlet' % app.socketio.async_mode)
+    with flask_app.app_context():
+        app.migrations.migrate(app.engine, app.Base.metadata)
+        db = app.db_session()
+        location = app.Location(name='Hashing Benchmark')
+        location.set_secret('benchmark')
+        db.add(location)
+        db.flush()
+        users = app.Type(level=0, name='Users', location_id=location.id)
+        general = app.Machine(name='General Safety Training', location_id=location.id)
+        db.add_all([users, general])
+        db.flush()
+        now = datetime.now()
+        for i in range(args.users):
+            db.add(app.User(sid=FIRST_SID + i, name='Hashing User %d' % i, location_id=location.id,
+                            type_id=users.id, waiverSigned=now))
+            db.add(app.HawkCard(card=RETURNING_CARDS + i, sid=FIRST_SID + i, location_id=location.id))
+            db.add(app.Training(trainee_id=FIRST_SID + i, trainer_id=FIRST_SID, machine_id=general.id, date=now))
+        db.commit()
+        location_id = location.id
+        app.db_session.remove()
+
+    def kiosk(hwid):
+        page = flask_app.test_client()
+        with page.session_transaction() as session:
+            session.update(location_id=location_id, hardware_id=hwid, token='benchmark')
+        return app.socketio.test_client(flask_app, flask_test_client=page)
+
+    kiosks = [kiosk(hwid) for hwid in range(args.kiosks)]
+    print('%d kiosks each tapping every %.0f ms while an admin signs in with %d PBKDF2 rounds, %ds each.' % (
+        args.kiosks, 1000 * args.tap_interval, args.rounds, args.duration))
+    for name, mode in (('no admin', None), ('inline', 'threading'), ('offloaded', 'eventlet')):
+        app.hasher.async_mode = mode
+        latencies, sign_ins = list(), [0]
+        deadline = time.monotonic() + args.duration
+
+        def tap(hwid, page):
+            rng = random.Random(args.seed + hwid)
+            while time.monotonic() < deadline:
+                # timed from when the card was tapped, so time spent waiting for the event loop counts
+                gap = rng.expovariate(1.0 / args.tap_interval)
+                tapped = time.perf_counter() + gap
+                eventlet.sleep(gap)
+                page.emit('check in', {'card': RETURNING_CARDS + rng.randrange(args.users), 'facility': 1,
+                                       'location': location_id, 'hwid': hwid})
+                latencies.append(time.perf_counter() - tapped)
+                page.get_received()
+
+        def sign_in():
+            with flask_app.app_context():
+                location = app.db_session().query(app.Location).get(location_id)
+                while time.monotonic() < deadline:
+                    location.verify_secret('benchmark')
+                    sign_ins[0] += 1
+                    eventlet.sleep(0)
+                app.db_session.remove()
+
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+            pool = eventlet.GreenPool()
+            for hwid, page in enumerate(kiosks):
+                pool.spawn(tap, hwid, page)
+            if mode:
+                pool.spawn(sign_in)
+            pool.waitall()
+        latencies.sort()
+        print('%9s: %4d taps, p50 %6.0f ms, p95 %6.0f ms, max %6.0f ms; %d sign-ins' % (
+            name, len(latencies), 1000 * percentile(latencies, 50), 1000 * percentile(latencies, 95),
+            1000 * latencies[-1], sign_ins[0]))
+    for page in kiosks:
+        page.disconnect()
+
+
+def bench_indexes(args):
+    # seeds a location with a year of visits and card scans, and times the tap path's lookups and a scan
+    # log write with the indexes the models declare for them and with those indexes dropped
+    app, flask_app = use_database(args.db)
+    sa = app.sa
+    access, trainings, kiosks, scans = (app.Access.__table__, app.Training.__table__, app.Kiosk.__table__,
+                                        app.CardScan.__table__)
+    indexes = [index for table in (access, trainings, kiosks, scans) for index in table.indexes
+               if index.name in ('ix_access_location_open', 'ix_safetyTraining_trainee_machine',
+                                 'ix_kiosks_hardware_id', 'ix_scanLog_location_time')]
+    rng = random.Random(args.seed)
+    with flask_app.app_context():
+        app.migrations.migrate(app.engine, app.Base.metadata)
+        db = app.db_session()
+        location = app.Location(name='Index Benchmark')
+        location.set_secret('benchmark')
+        db.add(location)
+        db.flush()
+        users = app.Type(level=0, name='Users', location_id=location.id)
+        machines = [app.Machine(name='Machine %d' % i, location_id=location.id) for i in range(args.machines)]
+        db.add_all([users] + machines)
+        db.flush()
+        lid = location.id
+        now = datetime.now().replace(microsecond=0)
+        db.bulk_insert_mappings(app.User, [{'sid': FIRST_SID + i, 'name': 'Index User %d' % i, 'location_id': lid,
+                                            'type_id': users.id, 'waiverSigned': now} for i in range(args.users)])
+        db.bulk_insert_mappings(app.HawkCard, [{'card': RETURNING_CARDS + i, 'sid': FIRST_SID + i,
+                                                'location_id': lid} for i in range(args.users)])
+        db.bulk_insert_mappings(app.Training, [{'trainee_id': FIRST_SID + i, 'trainer_id': FIRST_SID,
+                                                'machine_id': machine.id, 'date': now}
+                                               for i in range(args.users) for machine in machines
+                                               if rng.random() < 0.3])
+        db.bulk_insert_mappings(app.Kiosk, [{'location_id': lid, 'hardware_id': hwid, 'token': 'benchmark'}
+                                             for hwid in range(10)])
+        db.commit()
+
+        def fill(table, count, row):
+            batch = list()
+            for i in range(count):
+                batch.append(row(i))
+                if len(batch) == 10000 or i == count - 1:
+                    db.execute(table.insert(), batch)
+                    db.commit()
+                    batch = list()
+
+        def visit(i):
+            time_in = now - timedelta(days=365) + timedelta(seconds=rng.randrange(365 * 86400))
+            # the last few are still in the lab
+            open_visit = i >= args.visits - args.open
+            return {'sid': FIRST_SID + (i % args.users if open_visit else rng.randrange(args.users)),
+                    'location_id': lid, 'timeIn': time_in,
+                    'timeOut': None if open_visit else time_in + timedelta(minutes=rng.uniform(10, 240))}
+
+        fill(access, args.visits, visit)
+        fill(scans, args.scans, lambda i: {'card_id': RETURNING_CARDS + rng.randrange(args.users),
+                                           'location_id': lid, 'time': now - timedelta(
+                                               seconds=rng.randrange(365 * 86400))})
+        print('%d visits and %d card scans over a year, %d users, %d machines; median of %d runs.' % (
+            args.visits, args.scans, args.users, args.machines, args.repeat))
+
+        def write_scans():
+            batch = [{'card_id': RETURNING_CARDS + rng.randrange(args.users), 'location_id': lid, 'time': now}
+                     for i in range(args.write_batch)]
+            db.execute(scans.insert(), batch)
+            db.commit()
+
+        open_at = access.c.location_id == lid, access.c.timeOut.is_(None)
+        benchmarks = (
+            ('open visit of a user', lambda: db.execute(sa.select([access.c.timeIn]).where(sa.and_(
+                access.c.sid == FIRST_SID + rng.randrange(args.users), *open_at))).fetchall()),
+            ('who is in the lab', lambda: db.execute(sa.select([access.c.sid]).where(sa.and_(*open_at))).fetchall()),
+            ('training check', lambda: db.execute(sa.select([trainings.c.date]).where(sa.and_(
+                trainings.c.trainee_id == FIRST_SID + rng.randrange(args.users),
+                trainings.c.machine_id == rng.choice(machines).id))).fetchall()),
+            ('kiosk by hardware id', lambda: db.execute(sa.select([kiosks.c.location_id]).where(
+                kiosks.c.hardware_id == rng.randrange(10))).fetchall()),
+            ("today's card scans", lambda: db.execute(sa.select([sa.func.count()]).where(sa.and_(
+                scans.c.location_id == lid, scans.c.time >= now - timedelta(days=1)))).scalar()),
+            ('scan log write of %d' % args.write_batch, write_scans),
+        )
+
+        results = dict()
+        for indexed in (True, False):
+            if not indexed:
+                for index in indexes:
+                    index.drop(app.engine)
+            for name, run in benchmarks:
+                results[name, indexed] = timed(args.repeat, run)[0]
+        for index in indexes:
+            index.create(app.engine)
+        app.db_session.remove()
+
+    print('%28s %12s %12s' % ('', 'indexed', 'not indexed'))
+    for name, _ in benchmarks:
+        print('%28s %9.2f ms %9.2f ms' % (name, 1000 * results[name, True], 1000 * results[name, False]))
+
+
+def heartbeat_trace(args):
+    # (seconds, hwid, 'page' or 'connect') events, read from --trace or made up: each kiosk's taps arrive
+    # as a Poisson process, and a tap loads the result page, which goes back to the home page 5 seconds
+    # later; every page load also opens a Socket.IO connection
+    if args.trace:
+        with open(args.trace) as f:
+            events = [(float(seconds), int(hwid), kind) for seconds, hwid, kind in
+                      (line.strip().split(',') for line in f if line.strip() and not line.startswith('#'))]
+        return sorted(events)
+    rng = random.Random(args.seed)
+    events = list()
+    for hwid in range(args.kiosks):
+        t = rng.expovariate(args.taps_per_hour / 3600.0)
+        while t < args.hours * 3600:
+            for offset, kind in ((0, 'page'), (0.5, 'connect'), (5, 'page'), (5.5, 'connect')):
+                events.append((t + offset, hwid, kind))
+            t += rng.expovariate(args.taps_per_hour / 3600.0)
+    return sorted(events)
+
+
+def bench_heartbeats(args):
+    # replays kiosk page loads and Socket.IO connects through the app with a simulated clock, with
+    # KIOSK_HEARTBEAT_INTERVAL at 0 (last_seen written on every request, as it used to be) and at each
+    # --intervals, and counts the kiosks UPDATEs and how far last_seen fell behind a kiosk's latest request
+    import sqlalchemy as sa
+    app, flask_app = use_database(args.db, SECRET_KEY='benchmark')
+    events = heartbeat_trace(args)
+    kiosks = sorted(set(hwid for _, hwid, _ in events))
+    with flask_app.app_context():
+        app.migrations.migrate(app.engine, app.Base.metadata)
+        db = app.db_session()
+        location = app.Location(name='Heartbeat Benchmark')
+        location.set_secret('benchmark')
+        db.add(location)
+        db.flush()
+        db.add_all([app.Kiosk(location_id=location.id, hardware_id=hwid, token='benchmark') for hwid in kiosks])
+        db.commit()
+        location_id = location.id
+        app.db_session.remove()
+
+    pages = dict()
+    for hwid in kiosks:
+        page = flask_app.test_client()
+        with page.session_transaction() as session:
+            session.update(location_id=location_id, hardware_id=hwid, token='benchmark')
+        pages[hwid] = page
+
+    class Clock:
+        # the time module, with monotonic() at the trace's current time
+        now = 0.0
+
+        def monotonic(self):
+            return self.now
+
+        def __getattr__(self, name):
+            return getattr(time, name)
+
+    writes = [0]
+
+    def count_writes(conn, cursor, statement, *rest):
+        if statement.lstrip().upper().startswith('UPDATE KIOSKS'):
+            writes[0] += 1
+
+    hours = (events[-1][0] - events[0][0]) / 3600.0 if events else 0
+    print('%d kiosks over %.1f hours: %d page loads, %d Socket.IO connects.' % (
+        len(kiosks), hours, sum(1 for event in events if event[2] == 'page'),
+        sum(1 for event in events if event[2] == 'connect')))
+    print('%22s %8s %12s %18s %12s' % ('KIOSK_HEARTBEAT_INTERVAL', 'writes', 'writes/hour', 'per kiosk-hour',
+                                        'max lag'))
+    clock = Clock()
+    app.time = clock
+    sa.event.listen(app.engine, 'before_cursor_execute', count_writes)
+    try:
+        for interval in [0] + [int(value) for value in args.intervals.split(',')]:
+            flask_app.config['KIOSK_HEARTBEAT_INTERVAL'] = interval
+            app.kiosk_heartbeats.clear()
+            writes[0] = 0
+            written, lag = dict(), 0.0
+            for seconds, hwid, kind in events:
+                clock.now = seconds
+                before = writes[0]
+                if kind == 'page':
+                    pages[hwid].get('/')
+                else:
+                    app.socketio.test_client(flask_app, flask_test_client=pages[hwid]).disconnect()
+                if writes[0] > before:
+                    written[hwid] = seconds
+                lag = max(lag, seconds - written.get(hwid, seconds))
+            print('%22s %8d %12.1f %18.1f %10.0f s' % (
+                '%d s' % interval if interval else 'every request', writes[0], writes[0] / hours if hours else 0,
+                writes[0] / hours / len(kiosks) if hours else 0, lag))
+    finally:
+        sa.event.remove(app.engine, 'before_cursor_execute', count_writes)
+        app.time = time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Idea Shop Check In load test')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    seed_parser = commands.add_parser('seed', help='fill a database with a location and users to tap')
+    seed_parser.add_argument('--db', help='SQLAlchemy URL of the database to seed', required=True)
+    seed_parser.add_argument('--users', help='number of users with cards', type=int, default=2000)
+    seed_parser.add_argument('--name', help='name of the location to create', default='Load Test')
+    seed_parser.add_argument('--secret', help='secret for the location', default='loadtest')
+    seed_parser.set_defaults(handler=seed)
+
+    serve_parser = commands.add_parser('serve', help='run the app with the university lookup and announcer stubbed')
+    serve_parser.add_argument('--db', help='SQLAlchemy URL of the seeded database', required=True)
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=5000)
+    serve_parser.add_argument('--lookup-latency', help='seconds the stub lookup takes', type=float, default=0.3)
+    serve_parser.add_argument('--workers', help='worker processes, on consecutive ports', type=int, default=1)
+    serve_parser.add_argument('--message-queue', help='SOCKETIO_MESSAGE_QUEUE shared by the workers')
+    serve_parser.add_argument('--occupancy-cache', help='OCCUPANCY_CACHE; defaults to the message queue')
+    serve_parser.add_argument('--skip-migrate', help=argparse.SUPPRESS, action='store_true')
+    serve_parser.set_defaults(handler=serve)
+
+    run_parser = commands.add_parser('run', help='tap cards on simulated kiosks and report latency')
+    run_parser.add_argument('--url', help='comma-separated URLs of every worker', default='http://localhost:5000')
+    run_parser.add_argument('--location', type=int, default=1)
+    run_parser.add_argument('--secret', default='loadtest')
+    run_parser.add_argument('--users', help='--users the database was seeded with', type=int, default=2000)
+    run_parser.add_argument('--kiosks', type=int, default=4)
+    run_parser.add_argument('--first-hwid', help='hardware id of the first simulated kiosk', type=int, default=9000)
+    run_parser.add_argument('--taps-per-minute', help='across all kiosks', type=float, default=60)
+    run_parser.add_argument('--duration', help='seconds to run for', type=int, default=60)
+    run_parser.add_argument('--new-share', help='fraction of taps by cards never seen before', type=float,
+                            default=0.05)
+    run_parser.add_argument('--timeout', help='seconds to wait for a tap\'s answer', type=int, default=10)
+    run_parser.add_argument('--seed', help='random seed', type=int, default=1)
+    run_parser.set_defaults(handler=run)
+
+    reports_parser = commands.add_parser('bench-reports', help='time usage reports from rollups and from raw visits')
+    reports_parser.add_argument('--db', help='SQLAlchemy URL of a scratch database', required=True)
+    reports_parser.add_argument('--visits', type=int, default=100000)
+    reports_parser.add_argument('--users', type=int, default=5000)
+    reports_parser.add_argument('--days', help='days the visits are spread over', type=int, default=730)
+    reports_parser.add_argument('--repeat', help='runs of each query; the median is reported', type=int, default=5)
+    reports_parser.add_argument('--seed', help='random seed', type=int, default=1)
+    reports_parser.set_defaults(handler=bench_reports)
+
+    lookup_parser = commands.add_parser('bench-lookup', help='time taps of unknown cards with a slow university lookup')
+    lookup_parser.add_argument('--db', help='SQLAlchemy URL of a scratch database', required=True)
+    lookup_parser.add_argument('--lookup-latency', help='seconds the stub lookup takes', type=float, default=1)
+    lookup_parser.add_argument('--deadline', help='IITLOOKUP_DEADLINE', type=float, default=3)
+    lookup_parser.add_argument('--taps', help='taps in each mode', type=int, default=20)
+    lookup_parser.add_argument('--seed', help='random seed', type=int, default=1)
+    lookup_parser.set_defaults(handler=bench_lookup)
+
+    fanout_parser = commands.add_parser('bench-fanout', help='time sending a kiosk a scan, broadcast and by room')
+    fanout_parser.add_argument('--db', help='SQLAlchemy URL of a scratch database', required=True)
+    fanout_parser.add_argument('--kiosks', help='comma-separated numbers of connected kiosk pages',
+                               default='25,100,400')
+    fanout_parser.add_argument('--locations', type=int, default=5)
+    fanout_parser.add_argument('--repeat', help='scans sent at each size; the median is reported', type=int,
+                               default=50)
+    fanout_parser.set_defaults(handler=bench_fanout)
+
+    hashing_parser = commands.add_parser('bench-hashing', help='time taps while an admin signs in, under eventlet')
+    hashing_parser.add_argument('--db', help='SQLAlchemy URL of a scratch database', required=True)
+    hashing_parser.add_argument('--rounds', help='PBKDF2_ROUNDS', type=int, default=LEGACY_ROUNDS)
+    hashing_parser.add_argument('--kiosks', type=int, default=4)
+    hashing_parser.add_argument('--users', type=int, default=200)
+    hashing_parser.add_argument('--tap-interval', help='mean seconds between taps on each kiosk', type=float,
+                                default=0.2)
+    hashing_parser.add_argument('--duration', help='seconds to run each mode for', type=int, default=10)
+    hashing_parser.add_argument('--seed', help='random seed', type=int, default=1)
+    hashing_parser.set_defaults(handler=bench_hashing)
+
+    indexes_parser = commands.add_parser('bench-indexes', help='time the tap path\'s lookups with and without indexes')
+    indexes_parser.add_argument('--db', help='SQLAlchemy URL of a scratch database', required=True)
+    indexes_parser.add_argument('--visits', type=int, default=200000)
+    indexes_parser.add_argument('--open', help='visits still open', type=int, default=100)
+    indexes_parser.add_argument('--scans', type=int, default=1000000)
+    indexes_parser.add_argument('--users', type=int, default=5000)
+    indexes_parser.add_argument('--machines', type=int, default=20)
+    indexes_parser.add_argument('--write-batch', help='scans per scan log write (SCANLOG_BATCH_SIZE)', type=int,
+                                default=100)
+    indexes_parser.add_argument('--repeat', help='runs of each query; the median is reported', type=int, default=21)
+    indexes_parser.add_argument('--seed', help='random seed', type=int, default=1)
+    indexes_parser.set_defaults(handler=bench_indexes)
+
+    heartbeats_parser = commands.add_parser('bench-heartbeats', help='count kiosk last_seen writes over a traffic '
+                                                                     'trace, with and without throttling')
+    heartbeats_parser.add_argument('--db', help='SQLAlchemy URL of a scratch database', required=True)
+    heartbeats_parser.add_argument('--trace', help='CSV of seconds,hwid,page|connect to replay instead of a '
+                                                   'made-up one')
+    heartbeats_parser.add_argument('--kiosks', type=int, default=4)
+    heartbeats_parser.add_argument('--hours', help='hours the lab is open', type=float, default=12)
+    heartbeats_parser.add_argument('--taps-per-hour', help='mean taps an hour on each kiosk', type=float, default=30)
+    heartbeats_parser.add_argument('--intervals', help='KIOSK_HEARTBEAT_INTERVAL values to compare', default='60,300')
+    heartbeats_parser.add_argument('--seed', help='random seed', type=int, default=1)
+    heartbeats_parser.set_defaults(handler=bench_heartbeats)
+
+    args = parser.parse_args()
+    args.handler(args)
@@ -0,0 +1,179 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process metrics in the Prometheus text exposition format. Recording a value is a bisect and a
+# couple of additions under a lock, cheap enough to leave on for every request on a Pi; everything
+# else (sorting, formatting) happens when /metrics is scraped.
+
+# seconds; spans a cached lookup up to a lookup service timing out
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', self.labels + ('le',), labels + (_number(bound),), cumulative
+            yield '_sum', self.labels, labels, total
+            yield '_count', self.labels, labels, cumulative
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, value in series:
+            yield '', self.labels, labels, value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    # a gauge either holds values set with set()/inc(), or reads them from collect(), which returns
+    # a {labels: value} dict when scraped
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.series[labels] = value
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        return (('', self.labels, labels, value) for labels, value in sorted(self.collect().items()))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = list()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        return self.add(Histogram(*args, **kwargs))
+
+    def counter(self, *args, **kwargs):
+        return self.add(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.add(Gauge(*args, **kwargs))
+
+    def render(self):
+        lines = list()
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for suffix, names, values, value in metric.samples():
+                lines.append('%s%s%s %s' % (metric.name, suffix, _labels(names, values), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# SQL statement counts and time, both process-wide and for whatever request or event is running on
+# this thread (or greenlet, once eventlet/gevent have patched threading)
+class QueryStats:
+    def __init__(self, registry):
+        self.queries = registry.counter('sql_queries_total', 'SQL statements executed')
+        self.seconds = registry.histogram('sql_query_seconds', 'Time spent executing a SQL statement')
+        self.local = threading.local()
+
+    def instrument(self, engine, sa):
+        @sa.event.listens_for(engine, 'before_cursor_execute')
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+        @sa.event.listens_for(engine, 'after_cursor_execute')
+        def after_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['query_started'].pop()
+            self.queries.inc()
+            self.seconds.observe(elapsed)
+            self.local.count = getattr(self.local, 'count', 0) + 1
+            self.local.time = getattr(self.local, 'time', 0.0) + elapsed
+
+    def reset(self):
+        self.local.count = 0
+        self.local.time = 0.0
+
+    def current(self):
+        return getattr(self.local, 'count', 0), getattr(self.local, 'time', 0.0)
+
+
+def time_checkouts(pool, histogram):
+    # wraps pool.connect() to time checkouts, which includes any wait for a free connection
+    connect = pool.connect
+
+    def timed_connect():
+        with histogram.time():
+            return connect()
+    pool.connect = timed_connect
+
+
+def pool_state(pool):
+    values = dict()
+    for stat in ('size', 'checkedout', 'overflow', 'checkedin'):
+        if hasattr(pool, stat):
+            values[(stat,)] = getattr(pool, stat)()
+    return values
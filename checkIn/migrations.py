@@ -0,0 +1,141 @@
+import sqlalchemy as sa
+import search
+from datetime import datetime
+
+
+def create_tables(*names):
+    def step(conn, metadata):
+        for name in names:
+            metadata.tables[name].create(conn)
+    return step
+
+
+def index_user_names(conn, metadata):
+    users = metadata.tables['users']
+    tokens = metadata.tables['userNameTokens']
+    rows = list()
+    for sid, location_id, name in conn.execute(sa.select([users.c.sid, users.c.location_id, users.c.name])):
+        rows.extend({'location_id': location_id, 'token': token, 'sid': sid} for token in search.name_tokens(name))
+        if len(rows) >= 1000:
+            conn.execute(tokens.insert(), rows)
+            rows = list()
+    if rows:
+        conn.execute(tokens.insert(), rows)
+
+
+def rebuild_on_sqlite(*names):
+    # SQLite can't change a column's type, so the table is recreated from its model and its rows copied
+    # over; other databases are left alone
+    def step(conn, metadata):
+        if conn.dialect.name != 'sqlite':
+            return
+        for name in names:
+            table = metadata.tables[name]
+            old = name + 'Old'
+            conn.execute(sa.text('ALTER TABLE "%s" RENAME TO "%s"' % (name, old)))
+            # the renamed table keeps its indexes' names, which the new table needs
+            for index in sa.inspect(conn).get_indexes(old):
+                conn.execute(sa.text('DROP INDEX "%s"' % index['name']))
+            table.create(conn)
+            columns = ', '.join('"%s"' % column.name for column in table.columns)
+            conn.execute(sa.text('INSERT INTO "%s" (%s) SELECT %s FROM "%s"' % (name, columns, columns, old)))
+            conn.execute(sa.text('DROP TABLE "%s"' % old))
+    return step
+
+
+# Schema migrations. Version 0 is the schema with every file in schema_updates/ applied by hand
+# (the last one being 12-14-17.sql); each step below upgrades the database by one version and is
+# applied exactly once. A step is a list of SQL statements that both SQLite and MariaDB accept, or
+# callables taking (connection, metadata) for anything that needs more than that.
+#
+# Run them once per deploy with `python checkIn.py --migrate` rather than from every worker.
+STEPS = [
+    (1, 'store PBKDF2 round counts with secrets and PINs', [
+        'ALTER TABLE locations ADD COLUMN secret_rounds INTEGER NULL',
+        'ALTER TABLE users ADD COLUMN pin_rounds INTEGER NULL',
+    ]),
+    (2, 'index hot access, kiosk, training and scan log queries', [
+        'CREATE INDEX ix_access_location_open ON access (location_id, timeOut, sid)',
+        'CREATE INDEX ix_kiosks_hardware_id ON kiosks (hardware_id)',
+        'CREATE INDEX ix_safetyTraining_trainee_machine ON safetyTraining (trainee_id, machine_id)',
+        'CREATE INDEX ix_scanLog_location_time ON scanLog (location_id, time)',
+    ]),
+    (3, 'usage report rollups', [
+        create_tables('usageHourly', 'usagePeak', 'usageVisitors'),
+    ]),
+    (4, 'name search tokens', [
+        create_tables('userNameTokens'),
+        index_user_names,
+    ]),
+    (5, 'automatic check-out', [
+        'ALTER TABLE locations ADD COLUMN closing_time TIME NULL',
+        'ALTER TABLE locations ADD COLUMN max_session_hours INTEGER NULL',
+        'ALTER TABLE access ADD COLUMN auto_closed BOOLEAN NOT NULL DEFAULT 0',
+    ]),
+    (6, 'archive tables for old visits and scans', [
+        create_tables('accessArchive', 'scanLogArchive'),
+    ]),
+    (7, 'number scan and admin log rows on SQLite replicas', [
+        rebuild_on_sqlite('scanLog', 'adminLog'),
+    ]),
+]
+
+version_table = sa.Table(
+    'schemaVersion', sa.MetaData(),
+    sa.Column('version', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('description', sa.String(length=100), nullable=False),
+    sa.Column('applied', sa.DateTime, nullable=False),
+)
+
+
+def head():
+    return STEPS[-1][0] if STEPS else 0
+
+
+def current_version(conn):
+    if version_table.name not in sa.inspect(conn).get_table_names():
+        return None
+    return conn.execute(sa.select([sa.func.max(version_table.c.version)])).scalar() or 0
+
+
+def _stamp(conn, version, description):
+    conn.execute(version_table.insert().values(version=version, description=description, applied=datetime.now()))
+
+
+def migrate(engine, metadata, log=print):
+    with engine.connect() as conn:
+        # MariaDB DDL can't be rolled back, so keep two deploys from migrating at the same time
+        locked = engine.dialect.name == 'mysql'
+        if locked and not conn.execute(sa.text("SELECT GET_LOCK('checkin_migrate', 60)")).scalar():
+            raise RuntimeError('Timed out waiting for another migration to finish')
+        try:
+            version = current_version(conn)
+            if version is None:
+                version_table.create(conn)
+                if 'locations' in sa.inspect(conn).get_table_names():
+                    # database from before migrations existed
+                    log('Existing database found, assuming schema version 0')
+                    _stamp(conn, 0, 'schema_updates applied by hand')
+                    version = 0
+                else:
+                    log('Empty database, creating schema version %d' % head())
+                    metadata.create_all(conn)
+                    _stamp(conn, head(), 'created from models')
+                    return head()
+
+            for step_version, description, statements in STEPS:
+                if step_version <= version:
+                    continue
+                log('Migrating to schema version %d: %s' % (step_version, description))
+                with conn.begin():
+                    for statement in statements:
+                        if callable(statement):
+                            statement(conn, metadata)
+                        else:
+                            conn.execute(sa.text(statement))
+                    _stamp(conn, step_version, description)
+                version = step_version
+            return version
+        finally:
+            if locked:
+                conn.execute(sa.text("SELECT RELEASE_LOCK('checkin_migrate')"))
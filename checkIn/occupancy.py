@@ -0,0 +1,154 @@
+import json
+import threading
+
+
+# keeps occupancy in this process only
+class MemoryBackend:
+    def __init__(self):
+        self.locations = {}
+        self.sequences = {}
+        self.lock = threading.Lock()
+
+    def load(self, location_id):
+        with self.lock:
+            occupants = self.locations.get(location_id)
+            return dict(occupants) if occupants is not None else None
+
+    def replace(self, location_id, occupants):
+        with self.lock:
+            self.locations[location_id] = dict((o['sid'], o) for o in occupants)
+
+    def put(self, location_id, occupant):
+        with self.lock:
+            if location_id in self.locations:
+                self.locations[location_id][occupant['sid']] = occupant
+
+    def discard(self, location_id, sid):
+        with self.lock:
+            if location_id in self.locations:
+                self.locations[location_id].pop(sid, None)
+
+    def invalidate(self, location_id=None):
+        with self.lock:
+            if location_id is None:
+                self.locations.clear()
+            else:
+                self.locations.pop(location_id, None)
+
+    def sequence(self, location_id):
+        with self.lock:
+            return self.sequences.get(location_id, 0)
+
+    def next_sequence(self, location_id):
+        with self.lock:
+            self.sequences[location_id] = self.sequences.get(location_id, 0) + 1
+            return self.sequences[location_id]
+
+
+# keeps occupancy in Redis so every worker process sees the same roster. Each location is a
+# hash of sid -> JSON occupant plus a marker field saying the hash was built from the database;
+# a missing marker means the roster has to be rebuilt. Sequence numbers are separate counters, so
+# invalidating rosters doesn't reset them.
+class RedisBackend:
+    LOADED = '_loaded'
+
+    def __init__(self, url, prefix='checkin:occupancy:', sequence_prefix='checkin:roster-seq:'):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.sequence_prefix = sequence_prefix
+
+    def key(self, location_id):
+        return '%s%d' % (self.prefix, location_id)
+
+    def load(self, location_id):
+        raw = self.redis.hgetall(self.key(location_id))
+        if self.LOADED.encode('utf-8') not in raw:
+            return None
+        return dict((int(sid), json.loads(value.decode('utf-8')))
+                    for sid, value in raw.items() if sid != self.LOADED.encode('utf-8'))
+
+    def replace(self, location_id, occupants):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key(location_id))
+        pipe.hset(self.key(location_id), self.LOADED, 1)
+        for occupant in occupants:
+            pipe.hset(self.key(location_id), occupant['sid'], json.dumps(occupant))
+        pipe.execute()
+
+    def put(self, location_id, occupant):
+        # only update rosters that have been built; an unbuilt one is rebuilt from the database on read
+        if self.redis.hexists(self.key(location_id), self.LOADED):
+            self.redis.hset(self.key(location_id), occupant['sid'], json.dumps(occupant))
+
+    def discard(self, location_id, sid):
+        self.redis.hdel(self.key(location_id), sid)
+
+    def invalidate(self, location_id=None):
+        if location_id is None:
+            keys = list(self.redis.scan_iter(self.prefix + '*'))
+            if keys:
+                self.redis.delete(*keys)
+        else:
+            self.redis.delete(self.key(location_id))
+
+    def sequence(self, location_id):
+        return int(self.redis.get('%s%d' % (self.sequence_prefix, location_id)) or 0)
+
+    def next_sequence(self, location_id):
+        return self.redis.incr('%s%d' % (self.sequence_prefix, location_id))
+
+
+def make_backend(url=None):
+    if not url or url == 'memory':
+        return MemoryBackend()
+    if url.startswith('redis://') or url.startswith('rediss://') or url.startswith('unix://'):
+        return RedisBackend(url)
+    raise ValueError('Unsupported occupancy cache backend: %s' % url)
+
+
+# Who is checked in at each location, kept up to date by the check-in and check-out paths.
+# Occupants are plain dicts (sid, name, photo, level, type_name, general_training, since) so they
+# can be shared between processes. loader(location_id) rebuilds a location's roster from the
+# database and is called whenever the backend has no roster for that location. Each location also
+# has a sequence number, bumped with next_sequence() for every change announced to its kiosks, so a
+# kiosk can tell when it has missed one.
+class OccupancyCache:
+    def __init__(self, backend, loader):
+        self.backend = backend
+        self.loader = loader
+
+    def occupants(self, location_id):
+        occupants = self.backend.load(location_id)
+        if occupants is None:
+            occupants = self.rebuild(location_id)
+        return occupants
+
+    def roster(self, location_id):
+        occupants = self.occupants(location_id).values()
+        students = sorted((o for o in occupants if o['level'] <= 0), key=lambda o: o['since'])
+        staff = sorted((o for o in occupants if o['level'] > 0), key=lambda o: o['level'], reverse=True)
+        return students, staff
+
+    def contains(self, location_id, sid):
+        return sid in self.occupants(location_id)
+
+    def rebuild(self, location_id):
+        occupants = self.loader(location_id)
+        self.backend.replace(location_id, occupants)
+        return dict((o['sid'], o) for o in occupants)
+
+    def add(self, location_id, occupant):
+        self.backend.put(location_id, occupant)
+
+    def remove(self, location_id, sid):
+        self.backend.discard(location_id, sid)
+
+    def invalidate(self, location_id=None):
+        self.backend.invalidate(location_id)
+
+    def sequence(self, location_id):
+        return self.backend.sequence(location_id)
+
+    def next_sequence(self, location_id):
+        return self.backend.next_sequence(location_id)
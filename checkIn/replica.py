@@ -0,0 +1,292 @@
+import threading
+import sqlalchemy as sa
+import search
+from datetime import datetime, timedelta
+
+
+# Kiosk-local mode. The kiosk runs against a SQLite replica of its location's rows, so a tap never
+# waits on the network, and sync() reconciles the replica with the central database whenever it can
+# reach it. Reconciliation is state-based rather than a replay log, so it can be retried at any point
+# and every kiosk converges on the same answer:
+#
+# * visits are matched by (sid, location, time in, to the second); a visit closed on either side
+#   takes the earliest time out (and whether that close was automatic), and if a user ends up with
+#   more than one open visit the earliest stays open and the later ones are closed where they started
+# * users and cards created on the kiosk are added centrally; otherwise the central copy wins,
+#   except that a waiver signature is kept if either side has a newer one and a card registered on
+#   the kiosk fills in a card the central database doesn't know the owner of
+# * scan log rows are append-only: they're copied up and removed from the replica
+# * types, machines, trainings, kiosks and the location itself are read-only on a kiosk and are
+#   replaced wholesale from the central database
+#
+# Admin changes besides waivers and registrations should be made against the central database.
+# Times on both sides are local: the app writes datetime.now() rather than SQLite's UTC
+# CURRENT_TIMESTAMP on a replica (see db_now() in checkIn.py).
+
+# visits that might have changed are re-read with this much overlap, to allow for clock skew
+OVERLAP = timedelta(minutes=10)
+
+state_table = sa.Table(
+    'replicaState', sa.MetaData(),
+    sa.Column('name', sa.String(length=50), primary_key=True),
+    sa.Column('value', sa.String(length=50), nullable=False),
+)
+
+
+def _time_key(value):
+    # MariaDB DATETIME columns drop microseconds, SQLite keeps them
+    return value.replace(microsecond=0) if value else value
+
+
+def _earliest(a, b):
+    return min(t for t in (a, b) if t is not None) if a or b else None
+
+
+def merge_visits(conn, access, location_id, visits):
+    # merges (sid, timeIn, timeOut, auto_closed) tuples into conn's access table; returns the visits this
+    # closed (leaving out auto-closed ones, which usage reports don't count) and how many rows it touched
+    if not visits:
+        return list(), 0
+    existing = dict()
+    query = sa.select([access.c.id, access.c.sid, access.c.timeIn, access.c.timeOut]) \
+        .where(access.c.location_id == location_id) \
+        .where(access.c.timeIn >= _time_key(min(visit[1] for visit in visits)))
+    for row_id, sid, time_in, time_out in conn.execute(query):
+        existing[(sid, _time_key(time_in))] = (row_id, time_in, time_out)
+
+    inserts = list()
+    closed = list()
+    updated = 0
+    for sid, time_in, time_out, auto_closed in visits:
+        match = existing.get((sid, _time_key(time_in)))
+        if not match:
+            inserts.append({'sid': sid, 'location_id': location_id, 'timeIn': time_in, 'timeOut': time_out,
+                            'auto_closed': bool(auto_closed)})
+            if time_out and not auto_closed:
+                closed.append((sid, time_in, time_out))
+            continue
+        row_id, current_in, current_out = match
+        merged = _earliest(current_out, time_out)
+        if merged != current_out:
+            conn.execute(access.update().where(access.c.id == row_id)
+                         .values(timeOut=merged, auto_closed=bool(auto_closed)))
+            updated += 1
+            if current_out is None and not auto_closed:
+                closed.append((sid, current_in, merged))
+    if inserts:
+        conn.execute(access.insert(), inserts)
+    return closed, updated + len(inserts)
+
+
+def close_duplicate_visits(conn, access, location_id):
+    open_visits = conn.execute(sa.select([access.c.id, access.c.sid, access.c.timeIn])
+                               .where(access.c.location_id == location_id)
+                               .where(access.c.timeOut == None)
+                               .order_by(access.c.sid, access.c.timeIn, access.c.id))
+    closed = list()
+    last_sid = None
+    for row_id, sid, time_in in open_visits.fetchall():
+        if sid == last_sid:
+            conn.execute(access.update().where(access.c.id == row_id).values(timeOut=time_in))
+            closed.append((sid, time_in, time_in))
+        last_sid = sid
+    return closed
+
+
+def index_names(conn, tokens, location_id, users):
+    # users is a list of (sid, name); replaces their search tokens
+    if not users:
+        return
+    conn.execute(tokens.delete().where(tokens.c.location_id == location_id)
+                 .where(tokens.c.sid.in_([sid for sid, name in users])))
+    rows = [{'location_id': location_id, 'token': token, 'sid': sid}
+            for sid, name in users for token in search.name_tokens(name)]
+    if rows:
+        conn.execute(tokens.insert(), rows)
+
+
+class Replica:
+    def __init__(self, local, central, metadata, location_id, logger=None):
+        self.local = local
+        self.central = central
+        self.location_id = location_id
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.t = metadata.tables
+        state_table.create(local, checkfirst=True)
+
+    def _get_state(self, conn, name):
+        return conn.execute(sa.select([state_table.c.value]).where(state_table.c.name == name)).scalar()
+
+    def _set_state(self, conn, name, value):
+        if conn.execute(state_table.update().where(state_table.c.name == name).values(value=value)).rowcount == 0:
+            conn.execute(state_table.insert().values(name=name, value=value))
+
+    def _rows(self, conn, table, *where):
+        query = sa.select([table]).order_by(*table.primary_key.columns)
+        for clause in where:
+            query = query.where(clause)
+        return [dict(row) for row in conn.execute(query)]
+
+    def _visits(self, conn, since):
+        access = self.t['access']
+        query = sa.select([access.c.sid, access.c.timeIn, access.c.timeOut, access.c.auto_closed]) \
+            .where(access.c.location_id == self.location_id)
+        if since:
+            query = query.where(sa.or_(access.c.timeOut == None, access.c.timeIn >= since,
+                                       access.c.timeOut >= since))
+        else:
+            query = query.where(access.c.timeOut == None)
+        return [tuple(row) for row in conn.execute(query)]
+
+    def sync(self, record_closed=None):
+        # returns (visits closed in the central database, whether the replica changed), where visits
+        # are (location_id, sid, type_id, timeIn, timeOut) tuples as add_rollups expects. If given,
+        # record_closed(conn, visits) is called in the central transaction, so whatever it writes is
+        # committed together with the visits or not at all.
+        with self.lock:
+            started = datetime.now()
+            with self.local.connect() as conn:
+                since = self._get_state(conn, 'visits_since')
+                since = datetime.strptime(since, '%Y-%m-%dT%H:%M:%S') - OVERLAP if since else None
+                pushed = self._read_local(conn, since)
+
+            with self.central.begin() as conn:
+                closed = self._push(conn, pushed)
+                pulled = self._read_central(conn, since)
+                types = dict((user['sid'], user['type_id']) for user in pulled['users'])
+                closed = [(self.location_id, sid, types.get(sid), time_in, time_out)
+                          for sid, time_in, time_out in closed]
+                if record_closed and closed:
+                    record_closed(conn, closed)
+
+            with self.local.begin() as conn:
+                changed = self._apply(conn, pushed, pulled)
+                self._set_state(conn, 'visits_since', started.strftime('%Y-%m-%dT%H:%M:%S'))
+
+            self._log('Synced location %d: %d visits and %d scans pushed, %d visits pulled' % (
+                self.location_id, len(pushed['visits']), len(pushed['scans']), len(pulled['visits'])))
+            return closed, changed
+
+    def _read_local(self, conn, since):
+        t = self.t
+        return {
+            'users': self._rows(conn, t['users'], t['users'].c.location_id == self.location_id),
+            'cards': self._rows(conn, t['hawkcards'], t['hawkcards'].c.location_id == self.location_id),
+            'visits': self._visits(conn, since),
+            'scans': self._rows(conn, t['scanLog'], t['scanLog'].c.location_id == self.location_id),
+        }
+
+    def _read_central(self, conn, since):
+        t = self.t
+        machines = sa.select([t['machines'].c.id]).where(t['machines'].c.location_id == self.location_id)
+        return {
+            'locations': self._rows(conn, t['locations'], t['locations'].c.id == self.location_id),
+            'kiosks': self._rows(conn, t['kiosks'], t['kiosks'].c.location_id == self.location_id),
+            'types': self._rows(conn, t['types'], t['types'].c.location_id == self.location_id),
+            'machines': self._rows(conn, t['machines'], t['machines'].c.location_id == self.location_id),
+            'safetyTraining': self._rows(conn, t['safetyTraining'], t['safetyTraining'].c.machine_id.in_(machines)),
+            'users': self._rows(conn, t['users'], t['users'].c.location_id == self.location_id),
+            'hawkcards': self._rows(conn, t['hawkcards'], t['hawkcards'].c.location_id == self.location_id),
+            'visits': self._visits(conn, since),
+        }
+
+    def _merge_users(self, conn, users, keep_newer_waiver):
+        # adds users conn doesn't have; returns whether anything changed
+        table = self.t['users']
+        current = dict((row['sid'], row) for row in self._rows(conn, table, table.c.location_id == self.location_id))
+        inserts = list()
+        renamed = list()
+        changed = False
+        for user in users:
+            row = current.get(user['sid'])
+            if not row:
+                inserts.append(user)
+                renamed.append((user['sid'], user['name']))
+                continue
+            values = dict()
+            if keep_newer_waiver:
+                if user['waiverSigned'] and (not row['waiverSigned'] or user['waiverSigned'] > row['waiverSigned']):
+                    values['waiverSigned'] = user['waiverSigned']
+            else:
+                # the incoming copy is authoritative apart from a newer waiver on this side
+                values = dict((k, v) for k, v in user.items() if row[k] != v)
+                if row['waiverSigned'] and (not user['waiverSigned'] or row['waiverSigned'] > user['waiverSigned']):
+                    values.pop('waiverSigned', None)
+                if 'name' in values:
+                    renamed.append((user['sid'], user['name']))
+            if values:
+                changed = True
+                conn.execute(table.update().where(table.c.sid == user['sid'])
+                             .where(table.c.location_id == self.location_id).values(**values))
+        if inserts:
+            conn.execute(table.insert(), inserts)
+        index_names(conn, self.t['userNameTokens'], self.location_id, renamed)
+        return changed or bool(inserts)
+
+    def _merge_cards(self, conn, cards, authoritative):
+        table = self.t['hawkcards']
+        current = dict((card, sid) for card, sid in conn.execute(
+            sa.select([table.c.card, table.c.sid]).where(table.c.location_id == self.location_id)))
+        inserts = list()
+        changed = False
+        for card in cards:
+            if card['card'] not in current:
+                inserts.append(card)
+            elif card['sid'] and current[card['card']] != card['sid'] and \
+                    (authoritative or current[card['card']] is None):
+                conn.execute(table.update().where(table.c.card == card['card'])
+                             .where(table.c.location_id == self.location_id).values(sid=card['sid']))
+                changed = True
+        if inserts:
+            conn.execute(table.insert(), inserts)
+        return changed or bool(inserts)
+
+    def _push(self, conn, pushed):
+        access = self.t['access']
+        self._merge_users(conn, pushed['users'], keep_newer_waiver=True)
+        self._merge_cards(conn, pushed['cards'], authoritative=False)
+        closed, _ = merge_visits(conn, access, self.location_id, pushed['visits'])
+        closed += close_duplicate_visits(conn, access, self.location_id)
+        if pushed['scans']:
+            conn.execute(self.t['scanLog'].insert(),
+                         [dict((k, v) for k, v in scan.items() if k != 'id') for scan in pushed['scans']])
+        return closed
+
+    def _apply(self, conn, pushed, pulled):
+        t = self.t
+        if pushed['scans']:
+            scan_log = t['scanLog']
+            conn.execute(scan_log.delete().where(scan_log.c.location_id == self.location_id)
+                         .where(scan_log.c.id <= max(scan['id'] for scan in pushed['scans'])))
+
+        # read-only tables are replaced wholesale
+        changed = False
+        for name, column in (('locations', 'id'), ('kiosks', 'location_id'), ('types', 'location_id'),
+                             ('machines', 'location_id')):
+            table = t[name]
+            where = table.c[column] == self.location_id
+            if self._rows(conn, table, where) != pulled[name]:
+                conn.execute(table.delete().where(where))
+                if pulled[name]:
+                    conn.execute(table.insert(), pulled[name])
+                changed = True
+        trainings = t['safetyTraining']
+        machines = sa.select([t['machines'].c.id]).where(t['machines'].c.location_id == self.location_id)
+        if self._rows(conn, trainings, trainings.c.machine_id.in_(machines)) != pulled['safetyTraining']:
+            conn.execute(trainings.delete().where(trainings.c.machine_id.in_(machines)))
+            if pulled['safetyTraining']:
+                conn.execute(trainings.insert(), pulled['safetyTraining'])
+            changed = True
+
+        changed |= self._merge_users(conn, pulled['users'], keep_newer_waiver=False)
+        changed |= self._merge_cards(conn, pulled['hawkcards'], authoritative=True)
+        changed |= bool(merge_visits(conn, t['access'], self.location_id, pulled['visits'])[1])
+        changed |= bool(close_duplicate_visits(conn, t['access'], self.location_id))
+        return changed
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger.info(msg)
+        else:
+            print(msg)
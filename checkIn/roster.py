@@ -0,0 +1,45 @@
+import csv
+
+# Roster CSV parsing for bulk imports. A roster has a header row with at least `sid` and `name`
+# columns, and optionally `card` and `type` (the name of a user type at the location). Student IDs
+# may be written with or without the leading A.
+
+BATCH_SIZE = 500
+
+
+def parse_sid(value):
+    value = (value or '').strip().upper()
+    if value.startswith('A'):
+        value = value[1:]
+    return int(value) if value.isdigit() else None
+
+
+def parse_card(value):
+    value = (value or '').strip()
+    return int(value) if value.isdigit() else None
+
+
+def read_roster(f):
+    # yields (line number, sid, name, card, type name) for every row, or (line number, None, ...) for
+    # rows that can't be used
+    reader = csv.DictReader(f)
+    fields = [name.strip().lower() for name in reader.fieldnames or []]
+    if 'sid' not in fields or 'name' not in fields:
+        raise ValueError('The roster needs a header row with at least sid and name columns.')
+    reader.fieldnames = fields
+    for row in reader:
+        sid = parse_sid(row.get('sid'))
+        name = (row.get('name') or '').strip()
+        yield reader.line_num, sid if name else None, name.title(), parse_card(row.get('card')), \
+            (row.get('type') or '').strip()
+
+
+def batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+
+# Write-behind buffer for the scan log. Taps are queued in memory and written in bulk when
+# batch_size rows are waiting or every `interval` seconds, whichever comes first, so the audit
+# trail never costs the tap itself a database write. If the database can't be reached and a
+# spool file is configured, the batch is appended there as JSON lines and replayed on the next
+# successful flush; without a spool the rows stay queued (up to max_pending) and are retried.
+class ScanLogBuffer:
+    def __init__(self, engine, table, batch_size=100, interval=5, spool=None, max_pending=10000,
+                 start_task=None, sleep=None, logger=None):
+        self.engine = engine
+        self.table = table
+        self.batch_size = batch_size
+        self.interval = interval
+        self.spool = spool
+        self.max_pending = max_pending
+        self.start_task = start_task
+        self.sleep = sleep
+        self.logger = logger
+        self.pending = list()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.started = False
+
+    def add(self, card_id, location_id, time=None):
+        with self.lock:
+            self.pending.append({'card_id': card_id, 'location_id': location_id, 'time': time or datetime.now()})
+            full = len(self.pending) >= self.batch_size
+            start = not self.started and self.start_task is not None
+            self.started = True
+        if start:
+            self.start_task(self._run)
+        if full:
+            if self.start_task is not None:
+                self.start_task(self.flush)
+            else:
+                self.flush()
+
+    def _run(self):
+        while True:
+            self.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                rows, self.pending = self.pending, list()
+            try:
+                self._replay_spool()
+                if rows:
+                    with self.engine.begin() as conn:
+                        conn.execute(self.table.insert(), rows)
+            except Exception as e:
+                self._log('Scan log flush of %d rows failed: %s' % (len(rows), e))
+                if self.spool:
+                    self._write_spool(rows)
+                else:
+                    with self.lock:
+                        self.pending = (rows + self.pending)[-self.max_pending:]
+
+    def _write_spool(self, rows):
+        with open(self.spool, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(dict(row, time=row['time'].isoformat())) + '\n')
+
+    def _replay_spool(self):
+        if not self.spool or not os.path.exists(self.spool):
+            return
+        replaying = self.spool + '.replay'
+        if not os.path.exists(replaying):
+            os.rename(self.spool, replaying)
+        with open(replaying) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for row in rows:
+            row['time'] = datetime.strptime(row['time'], '%Y-%m-%dT%H:%M:%S.%f' if '.' in row['time']
+                                            else '%Y-%m-%dT%H:%M:%S')
+        if rows:
+            with self.engine.begin() as conn:
+                conn.execute(self.table.insert(), rows)
+        os.remove(replaying)
+        self._log('Replayed %d spooled scan log rows' % len(rows))
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger.warning(msg)
+        else:
+            print(msg)
@@ -0,0 +1,25 @@
+import re
+import unicodedata
+
+# Name search. Every user's name is split into normalized tokens (lowercase, accents stripped) kept in
+# an indexed table, so a search for any part of a name is a handful of index range scans rather than
+# an ILIKE over the whole users table.
+
+PAGE_SIZE = 20
+ACCESS_PAGE_SIZE = 10
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def name_tokens(name):
+    return sorted(set(t[:50] for t in re.split(r'[^0-9a-z]+', normalize(name)) if t))
+
+
+def parse_int(value):
+    try:
+        return int(value) if value not in (None, '') else None
+    except ValueError:
+        return None
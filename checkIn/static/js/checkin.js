@@ -8,5 +8,115 @@ function stopAudio(className) {
     }
 }
 
+/// Builds a Who's Here row the way layout.html does
+function staffRow(occupant) {
+    let row = $('<div class="list-group-item" style="min-height: 70px;"></div>')
+        .attr('data-sid', occupant.sid)
+        .attr('data-level', occupant.level);
+    $('<div class="pull-right"></div>')
+        .append($('<img style="max-height: 50px;" class="img-circle"/>')
+            .attr('src', occupant.photo || '/static/images/placeholder.png'))
+        .appendTo(row);
+    $('<h4></h4>')
+        .text(occupant.name + ' ')
+        .append($('<small></small>').text(occupant.type_name))
+        .appendTo(row);
+    return row;
+}
+
+function studentRow(occupant, checkoutUrl) {
+    let row = $('<tr></tr>')
+        .attr('data-sid', occupant.sid)
+        .attr('data-since', occupant.since)
+        .toggleClass('danger', !occupant.general_training);
+    $('<td style="vertical-align:middle"></td>')
+        .append('<span class="glyphicon glyphicon-user" aria-hidden="true">&nbsp;</span>')
+        .append(document.createTextNode(occupant.name))
+        .appendTo(row);
+    $('<td></td>')
+        .append($('<form method="post"></form>')
+            .attr('action', checkoutUrl + '?sid=' + encodeURIComponent(occupant.sid))
+            .append('<button type="submit" class="btn btn-danger">Checkout</button>'))
+        .appendTo(row);
+    return row;
+}
+
+/// Puts a row into a list kept sorted by key, after any rows with the same key
+function insertSorted(list, row, key) {
+    let after = list.children().filter(function () {
+        return key($(this)) <= key(row);
+    }).last();
+    if (after.length) {
+        row.insertAfter(after);
+    } else {
+        row.prependTo(list);
+    }
+}
+
+/// Adds an occupant to the sidebar, or moves and updates them if they're already there
+function addOccupant(occupant) {
+    removeOccupant(occupant.sid);
+    if (occupant.level > 0) {
+        // staff by level, highest first
+        insertSorted($('#roster-staff'), staffRow(occupant), function (row) {
+            return -Number(row.attr('data-level'));
+        });
+    } else {
+        // students by check in time
+        let students = $('#roster-students');
+        insertSorted(students, studentRow(occupant, students.attr('data-checkout-url')), function (row) {
+            return Number(row.attr('data-since'));
+        });
+    }
+}
+
+function removeOccupant(sid) {
+    $('#roster-staff, #roster-students').children().filter(function () {
+        return Number($(this).attr('data-sid')) === sid;
+    }).remove();
+}
+
+function replaceRoster(students, staff) {
+    $('#roster-staff, #roster-students').empty();
+    for (let occupant of staff.concat(students)) {
+        addOccupant(occupant);
+    }
+}
+
+/// Keeps the sidebar current from the server's 'roster' events, starting from the sequence number the
+/// page was rendered at. An event either adds or removes one occupant and must be the next in sequence,
+/// or carries the whole roster. After a gap the page asks for the whole roster and ignores single changes
+/// until it arrives. On every connect, the first included, it passes the server its sequence number and is
+/// sent the whole roster if changes were missed while it was disconnected or loading.
+function followRoster(socket, seq) {
+    let syncing = false;
+
+    function sync() {
+        syncing = true;
+        socket.emit('roster sync');
+    }
+
+    socket.on('connect', function () {
+        // a page waiting on a whole roster asks again, since the reply may have been lost with the connection
+        socket.emit('roster sync', syncing ? {} : {seq: seq});
+    });
+    socket.on('roster', function (data) {
+        if (data.students) {
+            replaceRoster(data.students, data.staff);
+            syncing = false;
+        } else if (syncing) {
+            return;
+        } else if (data.seq !== seq + 1) {
+            sync();
+            return;
+        } else if (data.added) {
+            addOccupant(data.added);
+        } else if (data.removed) {
+            removeOccupant(data.removed.sid);
+        }
+        seq = data.seq;
+    });
+}
+
 $(function() {
-});
\ No newline at end of file
+});
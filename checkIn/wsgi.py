@@ -2,7 +2,10 @@ if __name__ == '__main__' and __package__ is None:
     from os import sys, path
     sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from .checkIn import socketio, app as application
+from .checkIn import socketio, create_app
+
+# one app per worker process; see the README for running several behind a load balancer
+application = create_app()
 
 if __name__ == '__main__':
     socketio.run(application)
\ No newline at end of file
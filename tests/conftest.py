@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+import sqlalchemy as sa
+
+# the app imports its modules by their own names, as it does when run as `python checkIn.py`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'checkIn'))
+
+import checkIn  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = checkIn.create_app({'DB': 'sqlite:///%s' % (tmp_path / 'checkin.db'), 'SECRET_KEY': 'test',
+                              'TESTING': True, 'PBKDF2_ROUNDS': 1000}, background_tasks=False)
+    with app.app_context():
+        checkIn.migrations.migrate(checkIn.engine, checkIn.Base.metadata)
+        yield app
+        checkIn.db_session.remove()
+    checkIn.occupancy.invalidate()
+    checkIn.kiosk_heartbeats.clear()
+
+
+class QueryCounter:
+    # counts the SQL statements the engine runs while it's active
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        sa.event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        sa.event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+
+
+@pytest.fixture
+def count_queries():
+    return lambda: QueryCounter(checkIn.engine)
+
+
+@pytest.fixture
+def redis_url():
+    # a scratch Redis database for the tests of shared state, e.g. CHECKIN_TEST_REDIS=redis://localhost:6379/15;
+    # they're skipped without one
+    url = os.environ.get('CHECKIN_TEST_REDIS')
+    if not url:
+        pytest.skip('CHECKIN_TEST_REDIS is not set')
+    redis = pytest.importorskip('redis')
+    redis.StrictRedis.from_url(url).flushdb()
+    return url
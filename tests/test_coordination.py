@@ -0,0 +1,60 @@
+import time
+
+import coordination
+
+
+def test_claims_expire():
+    coordinator = coordination.MemoryCoordinator()
+    assert coordinator.claim('lookup:1:100', 0.05)
+    assert not coordinator.claim('lookup:1:100', 0.05)
+    time.sleep(0.1)
+    assert coordinator.claim('lookup:1:100', 0.05)
+
+
+def test_values_are_popped_once():
+    coordinator = coordination.MemoryCoordinator()
+    coordinator.put('lookup-outcome:1:100', '/register?card_id=100', 10)
+    assert coordinator.pop('lookup-outcome:1:100') == '/register?card_id=100'
+    assert coordinator.pop('lookup-outcome:1:100') is None
+
+
+def test_lists_take_every_append():
+    coordinator = coordination.MemoryCoordinator()
+    coordinator.append('group-trainees:a', [1, 'One'], 10)
+    coordinator.append('group-trainees:a', [2, 'Two'], 10)
+    assert coordinator.get_list('group-trainees:a') == [[1, 'One'], [2, 'Two']]
+    coordinator.release('group-trainees:a')
+    assert coordinator.get_list('group-trainees:a') == []
+
+
+def test_one_worker_leads(redis_url):
+    first, second = coordination.RedisCoordinator(redis_url), coordination.RedisCoordinator(redis_url)
+    assert first.elect()
+    assert not second.elect()
+    assert first.elect()
+    first.resign()
+    assert second.elect()
+    assert not first.elect()
+
+
+def test_leadership_moves_when_the_lease_runs_out(redis_url):
+    first, second = coordination.RedisCoordinator(redis_url, lease=0.2), coordination.RedisCoordinator(redis_url)
+    assert first.elect()
+    time.sleep(0.3)
+    assert second.elect()
+    assert not first.elect()
+
+
+def test_workers_share_values_and_messages(redis_url):
+    first, second = coordination.RedisCoordinator(redis_url), coordination.RedisCoordinator(redis_url)
+    assert first.claim('lookup:1:100', 10)
+    assert not second.claim('lookup:1:100', 10)
+    assert second.get('lookup:1:100') is not None
+    first.put('lookup-outcome:1:100', '/register?card_id=100', 10)
+    assert second.pop('lookup-outcome:1:100') == '/register?card_id=100'
+    assert first.pop('lookup-outcome:1:100') is None
+    second.send({'location_id': 1, 'method': 'test', 'args': [], 'urgent': False})
+    assert first.receive(timeout=1) == {'location_id': 1, 'method': 'test', 'args': [], 'urgent': False}
+    first.append('group-trainees:a', [1, 'One'], 10)
+    second.append('group-trainees:a', [2, 'Two'], 10)
+    assert first.get_list('group-trainees:a') == [[1, 'One'], [2, 'Two']]
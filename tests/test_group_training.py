@@ -0,0 +1,37 @@
+import checkIn
+
+from test_roster_queries import kiosk_client, seed_location
+
+
+def admin_kiosk(app, location_id, admin_sid):
+    # a fresh connection from the kiosk, as after a reload or from a different worker
+    client = kiosk_client(app, location_id)
+    with client.session_transaction() as session:
+        session['admin'] = admin_sid
+    return checkIn.socketio.test_client(app, flask_test_client=client)
+
+
+def test_a_session_survives_reconnecting_between_start_taps_and_finish(app):
+    location_id = seed_location('Group', students=3, staff=1)
+    admin = location_id * 100000 + 3
+    machine_id = checkIn.db_session().query(checkIn.Machine.id).filter_by(location_id=location_id).scalar()
+
+    kiosk = admin_kiosk(app, location_id, admin)
+    assert kiosk.emit('group training start', {'machine': machine_id}, callback=True) == \
+        {'machine_id': machine_id, 'trainees': []}
+    kiosk.disconnect()
+
+    for sid in (location_id * 100000, location_id * 100000 + 1, location_id * 100000):
+        kiosk = admin_kiosk(app, location_id, admin)
+        resp = kiosk.emit('group training tap', {'sid': sid}, callback=True)
+        kiosk.disconnect()
+    assert resp == {'trainees': ['User 0', 'User 1']}
+
+    kiosk = admin_kiosk(app, location_id, admin)
+    assert kiosk.emit('group training start', {'machine': machine_id}, callback=True)['trainees'] == \
+        ['User 0', 'User 1']
+    # User 1 was already trained on it
+    assert kiosk.emit('group training finish', {}, callback=True) == {'added': 1, 'skipped': 1}
+    assert kiosk.emit('group training tap', {'sid': location_id * 100000}, callback=True) == \
+        {'error': 'No group training in progress.'}
+    kiosk.disconnect()
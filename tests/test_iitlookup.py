@@ -0,0 +1,96 @@
+from pysimplesoap.client import SoapFault
+
+import iitlookup
+
+WSDL = '''<?xml version="1.0"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:tns="urn:lookup" xmlns:xsd="http://www.w3.org/2001/XMLSchema" targetNamespace="urn:lookup">
+  <message name="CardIn"><part name="cardNumber" type="xsd:string"/></message>
+  <message name="CardOut"><part name="PCSGetbyCardNumResult" type="xsd:string"/></message>
+  <portType name="Lookup">
+    <operation name="PCSGetbyCardNum"><input message="tns:CardIn"/><output message="tns:CardOut"/></operation>
+  </portType>
+  <binding name="LookupBinding" type="tns:Lookup">
+    <soap:binding style="rpc" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="PCSGetbyCardNum">
+      <soap:operation soapAction="urn:lookup#PCSGetbyCardNum"/>
+      <input><soap:body use="encoded" namespace="urn:lookup"/></input>
+      <output><soap:body use="encoded" namespace="urn:lookup"/></output>
+    </operation>
+  </binding>
+  <service name="LookupService">
+    <port name="LookupPort" binding="tns:LookupBinding"><soap:address location="http://localhost:1/"/></port>
+  </service>
+</definitions>
+'''
+
+
+class FakeService:
+    # stands in for the SoapClient, answering each card lookup with the next of `answers`
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    def PCSGetbyCardNum(self, cardNumber):
+        self.calls += 1
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return {'PCSGetbyCardNumResult': answer}
+
+
+def wsdl_url(tmp_path):
+    path = tmp_path / 'lookup.wsdl'
+    path.write_text(WSDL)
+    return 'file://' + str(path)
+
+
+def cached_lookup(tmp_path, *answers):
+    lookup = iitlookup.CachedIITLookup(wsdl_url(tmp_path), wsdl_cache=False)
+    lookup.sclient = FakeService(*answers)
+    return lookup
+
+
+def test_faults_are_not_cached(tmp_path):
+    lookup = cached_lookup(tmp_path, SoapFault('soap:Server', 'busy'), 'Doe,Jane,Q,A20123456')
+    assert lookup.nameIDByCard(1234) is None
+    assert lookup.nameIDByCard(1234)['idnumber'] == 'A20123456'
+    assert lookup.nameIDByCard(1234)['first_name'] == 'Jane'
+    assert lookup.sclient.calls == 2
+
+
+def test_not_found_is_cached(tmp_path):
+    lookup = cached_lookup(tmp_path, 'Not Found')
+    assert lookup.nameIDByCard(1234) is None
+    assert lookup.nameIDByCard(1234) is None
+    assert lookup.sclient.calls == 1
+
+
+def test_wsdl_is_reused(tmp_path):
+    cache = tmp_path / 'cache'
+    cache.mkdir()
+    url = wsdl_url(tmp_path)
+    first = iitlookup.IITLookup(url, wsdl_cache=str(cache))
+    (tmp_path / 'lookup.wsdl').unlink()
+    second = iitlookup.IITLookup(url, wsdl_cache=str(cache))
+    assert list(second.sclient.services) == list(first.sclient.services) == ['LookupService']
+    operations = second.sclient.services['LookupService']['ports']['LookupPort']['operations']
+    assert list(operations) == ['PCSGetbyCardNum']
+    # kept as the document itself, readable by this user only
+    (saved,) = cache.iterdir()
+    assert saved.read_text() == WSDL
+    assert saved.stat().st_mode & 0o777 == 0o600
+
+
+def test_wsdl_others_can_write_is_refetched(tmp_path):
+    cache = tmp_path / 'cache'
+    cache.mkdir(mode=0o700)
+    url = wsdl_url(tmp_path)
+    iitlookup.IITLookup(url, wsdl_cache=str(cache))
+    (saved,) = cache.iterdir()
+    saved.write_text(WSDL.replace('http://localhost:1/', 'http://attacker.example/'))
+    saved.chmod(0o666)
+
+    lookup = iitlookup.IITLookup(url, wsdl_cache=str(cache))
+    assert lookup.sclient.services['LookupService']['ports']['LookupPort']['location'] == 'http://localhost:1/'
+    assert saved.read_text() == WSDL
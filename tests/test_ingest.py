@@ -0,0 +1,50 @@
+import time
+
+import ingest
+
+
+def test_resent_batch_is_a_duplicate():
+    taps = ingest.TapFilter(window=2)
+    assert taps.check(1, 100, seq=5, boot='a', now=0) == ingest.ACCEPTED
+    assert taps.check(1, 100, seq=5, boot='a', now=10) == ingest.DUPLICATE
+
+
+def test_restarted_reader_starts_a_new_sequence():
+    taps = ingest.TapFilter(window=2)
+    assert taps.check(1, 100, seq=500, boot='a', now=0) == ingest.ACCEPTED
+    assert taps.check(1, 200, seq=1, boot='b', now=10) == ingest.ACCEPTED
+
+
+def test_sequence_without_boot_is_not_deduplicated():
+    taps = ingest.TapFilter(window=2)
+    assert taps.check(1, 100, seq=500, now=0) == ingest.ACCEPTED
+    assert taps.check(1, 200, seq=1, now=10) == ingest.ACCEPTED
+
+
+def test_held_card_is_debounced():
+    taps = ingest.TapFilter(window=2)
+    assert taps.check(1, 100, now=0) == ingest.ACCEPTED
+    assert taps.check(1, 100, now=1.5) == ingest.DEBOUNCED
+    assert taps.check(1, 100, now=3) == ingest.DEBOUNCED
+    assert taps.check(1, 100, now=6) == ingest.ACCEPTED
+
+
+def test_batch_without_boot_is_rejected(app):
+    resp = app.test_client().post('/card_read/1/batch', json={'reads': [{'seq': 1, 'facility': 1, 'cardnum': 100}]})
+    assert resp.status_code == 400
+
+
+def test_workers_share_debouncing(redis_url):
+    first, second = ingest.RedisTapFilter(redis_url, window=0.2), ingest.RedisTapFilter(redis_url, window=0.2)
+    assert first.check(1, 100) == ingest.ACCEPTED
+    assert second.check(1, 100) == ingest.DEBOUNCED
+    time.sleep(0.3)
+    assert second.check(1, 100) == ingest.ACCEPTED
+
+
+def test_workers_share_sequences(redis_url):
+    first, second = ingest.RedisTapFilter(redis_url), ingest.RedisTapFilter(redis_url)
+    assert first.check(1, 100, seq=5, boot='a') == ingest.ACCEPTED
+    assert second.check(1, 200, seq=5, boot='a') == ingest.DUPLICATE
+    assert second.check(1, 200, seq=6, boot='a') == ingest.ACCEPTED
+    assert first.check(1, 300, seq=1, boot='b') == ingest.ACCEPTED
@@ -0,0 +1,59 @@
+import time
+
+import checkIn
+
+from test_roster_queries import kiosk_client, seed_location
+
+
+class SlowLookup:
+    def nameIDByCard(self, cardnum):
+        time.sleep(0.05)
+        return None
+
+
+def test_unknown_card_goes_to_register_after_the_lookup(app, monkeypatch):
+    monkeypatch.setattr(checkIn, 'iit_client', SlowLookup())
+    location_id = seed_location('Lookup', students=0, staff=0)
+    kiosk = checkIn.socketio.test_client(app, flask_test_client=kiosk_client(app, location_id))
+    kiosk.emit('check in', {'card': 4242, 'facility': 1, 'location': location_id, 'hwid': location_id})
+    first = [event['args'][0]['to'] for event in kiosk.get_received() if event['name'] == 'go']
+    assert first == ['/looking_up?card=4242']
+
+    # finish() builds its URLs from the kiosk's request, outside any request of its own
+    deadline = time.monotonic() + 5
+    final = list()
+    while not final and time.monotonic() < deadline:
+        # yields to the lookup when Socket.IO runs on eventlet or gevent
+        checkIn.socketio.sleep(0.01)
+        final = [event['args'][0]['to'] for event in kiosk.get_received() if event['name'] == 'go']
+    kiosk.disconnect()
+    assert final == ['http://localhost/register?card_id=4242']
+
+
+class OfflineLookup:
+    def nameIDByCard(self, cardnum):
+        raise AssertionError('the registration page asked the lookup service')
+
+
+def test_register_fills_in_the_background_lookup_without_asking_the_service(app, monkeypatch):
+    monkeypatch.setattr(checkIn, 'iit_client', OfflineLookup())
+    location_id = seed_location('Register', students=0, staff=0)
+    client = kiosk_client(app, location_id)
+
+    page = client.get('/register?card_id=4242')
+    assert page.status_code == 200
+    assert 'Jane Doe' not in page.get_data(as_text=True)
+
+    checkIn.coordinator.put('lookup-student:%d:4242' % location_id,
+                            {'first_name': 'Jane', 'last_name': 'Doe', 'idnumber': 'A20123456'}, 60)
+    page = client.get('/register?card_id=4242').get_data(as_text=True)
+    assert 'Jane Doe' in page and '20123456' in page
+
+
+def test_lookup_status_without_a_card_number_goes_home(app):
+    location_id = seed_location('Status', students=0, staff=0)
+    kiosk = checkIn.socketio.test_client(app, flask_test_client=kiosk_client(app, location_id))
+    for data in ({}, {'card': None}, {'card': 'abc'}):
+        kiosk.emit('lookup status', data)
+        assert [event['args'][0]['to'] for event in kiosk.get_received() if event['name'] == 'go'] == ['/']
+    kiosk.disconnect()
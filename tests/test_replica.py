@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+import checkIn
+
+from test_roster_queries import kiosk_client
+
+
+def replica_app(tmp_path):
+    # a kiosk-local app on a SQLite replica of location 1 of another SQLite file; returns (app, central engine)
+    central = 'sqlite:///%s' % (tmp_path / 'central.db')
+    app = checkIn.create_app({'DB': 'sqlite:///%s' % (tmp_path / 'replica.db'), 'CENTRAL_DB': central,
+                              'REPLICA_LOCATION': 1, 'SECRET_KEY': 'test', 'TESTING': True,
+                              'PBKDF2_ROUNDS': 1000}, background_tasks=False)
+    checkIn.migrations.migrate(checkIn.engine, checkIn.Base.metadata)
+    checkIn.migrations.migrate(checkIn.replica.central, checkIn.Base.metadata)
+
+    db = sessionmaker(bind=checkIn.replica.central)()
+    location = checkIn.Location(id=1, name='Central')
+    location.set_secret('secret')
+    db.add(location)
+    db.flush()
+    users = checkIn.Type(level=0, name='Users', location_id=1)
+    db.add(users)
+    db.flush()
+    db.add(checkIn.User(sid=100, name='Replica User', location_id=1, type_id=users.id, waiverSigned=datetime.now()))
+    db.add(checkIn.HawkCard(card=4242, sid=100, location_id=1))
+    db.add(checkIn.Kiosk(location_id=1, hardware_id=1, token='token'))
+    db.commit()
+    db.close()
+    return app, checkIn.replica.central
+
+
+def scans(engine):
+    with engine.connect() as conn:
+        return conn.execute(sa.select([checkIn.CardScan.__table__.c.card_id])).fetchall()
+
+
+def test_a_kiosk_tap_is_logged_on_the_replica_and_synced_to_central(tmp_path):
+    app, central = replica_app(tmp_path)
+    with app.app_context():
+        assert checkIn.sync_replica()
+        kiosk = checkIn.socketio.test_client(app, flask_test_client=kiosk_client(app, 1))
+        kiosk.emit('check in', {'card': 4242, 'facility': 1, 'location': 1, 'hwid': 1})
+        kiosk.disconnect()
+
+        checkIn.scan_log.flush()
+        assert scans(checkIn.engine) == [(4242,)]
+
+        assert checkIn.sync_replica()
+        assert scans(central) == [(4242,)]
+        assert scans(checkIn.engine) == []
+        checkIn.db_session.remove()
+    checkIn.occupancy.invalidate()
+
+
+def test_migration_numbers_scan_log_rows_on_an_existing_replica(tmp_path):
+    app, _ = replica_app(tmp_path)
+    engine = checkIn.engine
+    # the scan log as replicas created before version 7 have it, with a row in it
+    with engine.begin() as conn:
+        conn.execute(sa.text('DROP TABLE "scanLog"'))
+        conn.execute(sa.text('CREATE TABLE "scanLog" (id BIGINT NOT NULL, card_id BIGINT NOT NULL, '
+                             'time DATETIME, location_id INTEGER NOT NULL, PRIMARY KEY (id))'))
+        conn.execute(sa.text('CREATE INDEX "ix_scanLog_location_time" ON "scanLog" (location_id, time)'))
+        conn.execute(sa.text('INSERT INTO "scanLog" VALUES (5, 4242, NULL, 1)'))
+        conn.execute(sa.text('UPDATE "schemaVersion" SET version = 6'))
+
+    assert checkIn.migrations.migrate(engine, checkIn.Base.metadata) == 7
+    with engine.begin() as conn:
+        conn.execute(checkIn.CardScan.__table__.insert(), [{'card_id': 4243, 'location_id': 1}])
+        rows = conn.execute(sa.text('SELECT id, card_id FROM "scanLog" ORDER BY id')).fetchall()
+        indexes = [index['name'] for index in sa.inspect(conn).get_indexes('scanLog')]
+    assert [tuple(row) for row in rows] == [(5, 4242), (6, 4243)]
+    assert indexes == ['ix_scanLog_location_time']
@@ -0,0 +1,67 @@
+from datetime import datetime
+
+import sqlalchemy as sa
+
+import checkIn
+
+from test_roster_queries import kiosk_client, seed_location
+
+
+def seed_cardholders(location_id, count):
+    # users with cards who aren't in the lab; their cards are their sids
+    db = checkIn.db_session()
+    users = db.query(checkIn.Type).filter_by(location_id=location_id, level=0).one()
+    sids = [location_id * 100000 + 50 + i for i in range(count)]
+    for sid in sids:
+        db.add(checkIn.User(sid=sid, name='Holder %d' % sid, location_id=location_id, type_id=users.id,
+                            waiverSigned=datetime.now()))
+        db.add(checkIn.HawkCard(card=sid, sid=sid, location_id=location_id))
+    db.commit()
+    return sids
+
+
+def tap(kiosk, location_id, card):
+    kiosk.emit('check in', {'card': card, 'facility': 1, 'location': location_id, 'hwid': location_id})
+
+
+def peaks(location_id):
+    return sorted(tuple(row) for row in checkIn.db_session().query(
+        checkIn.UsagePeak.day, checkIn.UsagePeak.hour, checkIn.UsagePeak.peak).filter_by(location_id=location_id))
+
+
+def test_rebuilt_peaks_count_visits_that_were_closed_automatically(app):
+    location_id = seed_location('Peaks', students=0, staff=1)
+    first, second = seed_cardholders(location_id, 2)
+    kiosk = checkIn.socketio.test_client(app, flask_test_client=kiosk_client(app, location_id))
+    tap(kiosk, location_id, first)
+    tap(kiosk, location_id, second)
+
+    admin = kiosk_client(app, location_id)
+    with admin.session_transaction() as session:
+        session['admin'] = location_id * 100000
+    admin.get('/admin/clear_lab')
+    tap(kiosk, location_id, first)
+    tap(kiosk, location_id, first)
+    kiosk.disconnect()
+
+    live = peaks(location_id)
+    # with the staff member seed_location checked in
+    assert [peak for day, hour, peak in live] == [3]
+    checkIn.rebuild_rollups(location_id)
+    assert peaks(location_id) == live
+
+
+def test_checking_out_a_closed_visit_again_counts_it_once(app):
+    location_id = seed_location('Twice', students=0, staff=0)
+    (sid,) = seed_cardholders(location_id, 1)
+    kiosk = checkIn.socketio.test_client(app, flask_test_client=kiosk_client(app, location_id))
+    tap(kiosk, location_id, sid)
+    kiosk.disconnect()
+    db = checkIn.db_session()
+    access_id = db.query(checkIn.Access.id).filter_by(location_id=location_id, sid=sid).scalar()
+
+    client = kiosk_client(app, location_id)
+    client.get('/checkout?aid=%d' % access_id)
+    client.get('/checkout?aid=%d' % access_id)
+    db.expire_all()
+    assert db.query(sa.func.sum(checkIn.UsageHourly.visits)).filter_by(location_id=location_id).scalar() == 1
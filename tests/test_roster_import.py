@@ -0,0 +1,46 @@
+import io
+
+import checkIn
+
+from test_roster_queries import kiosk_client
+
+
+def admin_client(app):
+    # a kiosk client with a level 100 admin of a new location signed in
+    db = checkIn.db_session()
+    location = checkIn.Location(name='Import')
+    location.set_secret('secret')
+    db.add(location)
+    db.flush()
+    admins = checkIn.Type(level=100, name='Admins', location_id=location.id)
+    db.add(admins)
+    db.flush()
+    db.add(checkIn.User(sid=1, name='Admin', location_id=location.id, type_id=admins.id))
+    db.commit()
+    client = kiosk_client(app, location.id)
+    with client.session_transaction() as session:
+        session['admin'] = 1
+    return client, location.id
+
+
+def upload(client, data):
+    return client.post('/admin/roster', data={'roster': (io.BytesIO(data), 'roster.csv')},
+                       content_type='multipart/form-data')
+
+
+def test_import_reads_a_large_upload(app):
+    # big enough that the upload is spooled to a temporary file rather than kept in memory
+    client, location_id = admin_client(app)
+    rows = ''.join('A%d,Student %d,%d\r\n' % (20000000 + i, i, 500000 + i) for i in range(20000))
+    resp = upload(client, ('﻿sid,name,card\r\n' + rows).encode('utf-8'))
+    assert resp.status_code == 200
+    db = checkIn.db_session()
+    assert db.query(checkIn.User).filter_by(location_id=location_id).count() == 20001
+    assert db.query(checkIn.HawkCard).filter_by(location_id=location_id).count() == 20000
+
+
+def test_import_reports_a_file_that_is_not_utf8(app):
+    client, location_id = admin_client(app)
+    resp = upload(client, 'sid,name\r\nA20000001,Zo\xeb\r\n'.encode('latin-1'))
+    assert resp.status_code == 200
+    assert 'codec' in resp.get_data(as_text=True)
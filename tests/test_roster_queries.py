@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+import checkIn
+
+
+def seed_location(name, students, staff):
+    # a location with `students` and `staff` people checked in, every other student trained
+    db = checkIn.db_session()
+    location = checkIn.Location(name=name)
+    location.set_secret('secret')
+    db.add(location)
+    db.flush()
+    users = checkIn.Type(level=0, name='Users', location_id=location.id)
+    mentors = checkIn.Type(level=10, name='Mentors', location_id=location.id)
+    general = checkIn.Machine(name='General Safety Training', location_id=location.id)
+    db.add_all([users, mentors, general])
+    db.flush()
+    now = datetime.now()
+    for i in range(students + staff):
+        sid = location.id * 100000 + i
+        db.add(checkIn.User(sid=sid, name='User %d' % i, location_id=location.id, waiverSigned=now,
+                            type_id=(users if i < students else mentors).id))
+        db.add(checkIn.Access(sid=sid, location_id=location.id, timeIn=now - timedelta(minutes=i)))
+        if i % 2:
+            db.add(checkIn.Training(trainee_id=sid, trainer_id=sid, machine_id=general.id, date=now))
+    db.commit()
+    return location.id
+
+
+def kiosk_client(app, location_id):
+    # a client with the session /auth gives a kiosk
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['location_id'] = location_id
+        session['hardware_id'] = location_id
+        session['token'] = 'token'
+    return client
+
+
+def index_queries(app, count_queries, location_id):
+    # renders the kiosk home page with a cold roster cache; returns (queries, page)
+    checkIn.occupancy.invalidate()
+    client = kiosk_client(app, location_id)
+    with count_queries() as queries:
+        resp = client.get('/')
+    assert resp.status_code == 200
+    return queries.count, resp.get_data(as_text=True)
+
+
+def test_index_queries_do_not_grow_with_the_roster(app, count_queries):
+    small = seed_location('Small', students=3, staff=1)
+    large = seed_location('Large', students=60, staff=8)
+
+    small_queries, page = index_queries(app, count_queries, small)
+    large_queries, page = index_queries(app, count_queries, large)
+
+    assert 'User 67' in page and 'User 0' in page
+    assert large_queries == small_queries
+    # location, kiosk heartbeat, occupants and their general training
+    assert large_queries <= 4
+
+
+def test_index_reads_a_warm_roster_without_querying_it(app, count_queries):
+    location_id = seed_location('Warm', students=10, staff=2)
+    cold, page = index_queries(app, count_queries, location_id)
+
+    client = kiosk_client(app, location_id)
+    with count_queries() as queries:
+        assert client.get('/').status_code == 200
+    # the roster comes from the cache and the heartbeat isn't due yet, which leaves the location
+    assert queries.count == 1 < cold
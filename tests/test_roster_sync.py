@@ -0,0 +1,34 @@
+import checkIn
+
+from test_roster_queries import kiosk_client, seed_location
+
+
+def roster_sync(app, location_id, data):
+    # what a kiosk page connected to location_id is sent in reply to 'roster sync' with data
+    client = checkIn.socketio.test_client(app, flask_test_client=kiosk_client(app, location_id))
+    client.get_received()
+    client.emit('roster sync', data)
+    received = client.get_received()
+    client.disconnect()
+    return [message['args'][0] for message in received if message['name'] == 'roster']
+
+
+def test_connect_at_current_sequence_gets_nothing(app):
+    location_id = seed_location('Current', students=2, staff=1)
+    seq = checkIn.occupancy.sequence(location_id)
+    assert roster_sync(app, location_id, {'seq': seq}) == []
+
+
+def test_connect_behind_gets_whole_roster(app):
+    location_id = seed_location('Behind', students=2, staff=1)
+    seq = checkIn.occupancy.sequence(location_id)
+    checkIn.roster_changed(location_id, removed={'sid': location_id * 100000})
+    [roster] = roster_sync(app, location_id, {'seq': seq})
+    assert roster['seq'] == seq + 1
+    assert len(roster['students']) + len(roster['staff']) == 3
+
+
+def test_sync_without_sequence_gets_whole_roster(app):
+    location_id = seed_location('Gap', students=1, staff=0)
+    [roster] = roster_sync(app, location_id, {})
+    assert len(roster['students']) == 1
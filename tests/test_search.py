@@ -0,0 +1,12 @@
+from test_roster_queries import kiosk_client, seed_location
+
+
+def test_admin_lookup_with_a_bad_location_searches_the_admins_own(app):
+    location_id = seed_location('Lookup Location', students=2, staff=1)
+    client = kiosk_client(app, location_id)
+    with client.session_transaction() as session:
+        session['admin'] = location_id * 100000 + 2
+    for query in ('location=', 'location=abc', 'location=%d' % location_id):
+        resp = client.get('/admin/lookup?name=User&' + query)
+        assert resp.status_code == 200
+        assert 'User 1' in resp.get_data(as_text=True)